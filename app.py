@@ -8,307 +8,3058 @@ Feishu (Lark) business card generator – local Flask server
 """
 import os
 import io
+import sys
 import re
 import json
 import time
 import math
 import base64
-import textwrap
+import hashlib
+import sqlite3
+import queue
+import atexit
+import threading
+import uuid
+import random
+import logging
+import logging.handlers
+import contextvars
+import multiprocessing
+from collections import OrderedDict, deque
+from contextlib import ExitStack, contextmanager
+from functools import lru_cache
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
-from typing import Dict, Any, Optional
+from typing import Dict, Any, NamedTuple, Optional, Tuple
 
 import requests
-from flask import Flask, request, jsonify, send_file
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from flask import Flask, g, request, jsonify, send_file, stream_with_context
 from urllib.parse import quote, unquote
-from PIL import Image, ImageDraw, ImageFont, ImageOps
+from PIL import Image, ImageColor, ImageDraw, ImageFont
 try:
     import qrcode
 except Exception:
     qrcode = None
 
+from pdf_writer import JpegPdfWriter, mm_to_points
+from png_stream import DeflateSegment, iter_png, iter_png_segments, strip_segment
+from layout import fit_text
+from metrics import MetricsRegistry
+
 APP_ID = os.getenv("FEISHU_APP_ID", "")
 APP_SECRET = os.getenv("FEISHU_APP_SECRET", "")
 # If you want to force-send to a specific open_id for testing, set FEISHU_DEBUG_OPEN_ID
 DEBUG_OPEN_ID = os.getenv("FEISHU_DEBUG_OPEN_ID", "").strip()
+# 飞书开放平台HTTP客户端：接口根地址（可指向本地stub服务做测试）、连接池与超时、重试次数
+FEISHU_BASE_URL = os.getenv("FEISHU_BASE_URL", "https://open.feishu.cn/open-apis").rstrip("/")
+FEISHU_POOL_SIZE = int(os.getenv("FEISHU_POOL_SIZE", "16"))
+FEISHU_CONNECT_TIMEOUT = float(os.getenv("FEISHU_CONNECT_TIMEOUT", "3.05"))
+FEISHU_MAX_RETRIES = int(os.getenv("FEISHU_MAX_RETRIES", "3"))
+# tenant_access_token 提前多少秒后台刷新（飞书在剩余不足30分钟时才会签发新token）
+FEISHU_TOKEN_REFRESH_MARGIN = int(os.getenv("FEISHU_TOKEN_REFRESH_MARGIN", "1800"))
+
+# Output directory for saving cards for printing
+OUTPUT_DIR = os.getenv("OUTPUT_DIR", "./output")
+# 本地缓存（结果缓存、联系人缓存、图片代理缓存）存放目录；不能放在 OUTPUT_DIR 下，/image/ 会公开提供 OUTPUT_DIR 中的文件
+STATE_DIR = os.getenv("STATE_DIR", "./state")
+ASSETS_DIR = os.getenv("ASSETS_DIR", "./assets")
+TEMPLATE_PATH = os.getenv("TEMPLATE_PATH", os.path.join(ASSETS_DIR, "template.png"))
+
+# MBTI底图缓存：内存预算(MB)，以及启动时预加载的模板（"all" 或 "INFP,ENFP"）
+TEMPLATE_CACHE_MB = int(os.getenv("TEMPLATE_CACHE_MB", "1024"))
+TEMPLATE_PRELOAD = os.getenv("TEMPLATE_PRELOAD", "").strip()
+
+# 名片排版规格：LAYOUT_DIR/default.json 覆盖内置默认排版，LAYOUT_DIR/<MBTI>.json 覆盖单个底图
+# 文件修改后最多 LAYOUT_RELOAD_INTERVAL 秒内自动重新加载（0 表示不检查）
+LAYOUT_DIR = os.getenv("LAYOUT_DIR", os.path.join(ASSETS_DIR, "layouts"))
+LAYOUT_RELOAD_INTERVAL = float(os.getenv("LAYOUT_RELOAD_INTERVAL", "2"))
+
+# 渲染档位：print为原始印刷分辨率，message/preview按比例缩小，用于飞书消息和预览
+# 可通过 RENDER_PROFILE 设置部署默认值，或在 /hook?profile=message 中按请求指定
+# 编码参数：印刷档位固定输出PNG；消息/预览档位可改用JPEG/WebP（MESSAGE_IMAGE_FORMAT）
+PNG_COMPRESS_LEVEL = int(os.getenv("PNG_COMPRESS_LEVEL", "6"))
+PNG_OPTIMIZE = os.getenv("PNG_OPTIMIZE", "").strip().lower()  # 留空时按档位默认
+# 流式编码：PNG按条带（PNG_STRIP_ROWS行）压缩，名片边编码边写盘/发送，上传时从文件流式读取，内存中不保留完整的编码结果
+STREAM_ENCODE = os.getenv("STREAM_ENCODE", "1") != "0"
+PNG_STRIP_ROWS = int(os.getenv("PNG_STRIP_ROWS", "64"))
+# 底图条带预压缩缓存(MB)：每个底图按条带压缩一次，名片只合成、压缩有文字/二维码的条带，其余条带直接复用；0 关闭（需 STREAM_ENCODE）
+PNG_BAND_CACHE_MB = int(os.getenv("PNG_BAND_CACHE_MB", "64"))
+MESSAGE_IMAGE_FORMAT = os.getenv("MESSAGE_IMAGE_FORMAT", "png").strip().lower()
+MESSAGE_IMAGE_QUALITY = int(os.getenv("MESSAGE_IMAGE_QUALITY", "85"))
+if MESSAGE_IMAGE_FORMAT not in ("png", "jpeg", "webp"):
+    MESSAGE_IMAGE_FORMAT = "png"
+# /feishu-image 代理缓存：内存LRU预算(MB)，以及 STATE_DIR 下的磁盘缓存
+FEISHU_IMAGE_CACHE_MB = int(os.getenv("FEISHU_IMAGE_CACHE_MB", "128"))
+FEISHU_IMAGE_DISK_CACHE = os.getenv("FEISHU_IMAGE_DISK_CACHE", "1") != "0"
+# 磁盘缓存上限(MB)：超出时按最近访问时间（mtime）删除最久未用的图片；0 表示不限制（需自行定期清理）
+FEISHU_IMAGE_DISK_CACHE_MB = int(os.getenv("FEISHU_IMAGE_DISK_CACHE_MB", "1024"))
+# 流式转发图片时每块的大小
+STREAM_CHUNK_SIZE = int(os.getenv("STREAM_CHUNK_SIZE", str(64 * 1024)))
+# 微信二维码附件：解析到附件ID后立即后台下载（线程数），解码结果按附件ID缓存(MB)，渲染时最多等待的秒数
+QR_PREFETCH_WORKERS = int(os.getenv("QR_PREFETCH_WORKERS", "4"))
+QR_CACHE_MB = int(os.getenv("QR_CACHE_MB", "64"))
+QR_WAIT_TIMEOUT = float(os.getenv("QR_WAIT_TIMEOUT", "20"))
+# 渲染结果缓存（幂等）：相同内容的重复提交直接返回已有名片，不再渲染和上传
+RESULT_CACHE_ENABLED = os.getenv("RESULT_CACHE", "1") != "0"
+RESULT_CACHE_PATH = os.getenv("RESULT_CACHE_PATH", os.path.join(STATE_DIR, "result_cache.sqlite3"))
+RESULT_CACHE_TTL = int(os.getenv("RESULT_CACHE_TTL", str(7 * 24 * 3600)))
+RESULT_CACHE_MAX = int(os.getenv("RESULT_CACHE_MAX", "5000"))
+# 相同内容的并发提交（包括落在其他worker上的飞书重试）只处理一次，其余最多等待这么多秒；持有者崩溃留下的占用也在此后失效
+RESULT_CLAIM_TIMEOUT = float(os.getenv("RESULT_CLAIM_TIMEOUT", "120"))
+# 联系人缓存（邮箱/手机号 -> open_id）：本地SQLite，按TTL过期，通讯录中查不到的按 CONTACT_MISS_TTL 过期
+# 未缓存的查询等待 CONTACT_BATCH_WINDOW 秒，与同时到达的查询合并为一次 batch_get_id；活动前可用 preload_contacts.py 导入名单
+CONTACT_CACHE_PATH = os.getenv("CONTACT_CACHE_PATH", os.path.join(STATE_DIR, "contacts.sqlite3"))
+CONTACT_CACHE_TTL = int(os.getenv("CONTACT_CACHE_TTL", str(30 * 24 * 3600)))
+CONTACT_MISS_TTL = int(os.getenv("CONTACT_MISS_TTL", "600"))
+CONTACT_BATCH_WINDOW = float(os.getenv("CONTACT_BATCH_WINDOW", "0.05"))
+# 排版或绘制逻辑变化时递增，使旧的缓存结果失效
+RENDER_VERSION = "1"
+# 本地保存是否由后台线程异步写盘
+CARD_WRITE_ASYNC = os.getenv("CARD_WRITE_ASYNC", "1") != "0"
+
+RENDER_PROFILES = {
+    "print": {"scale": 1.0, "optimize": True, "format": "png"},
+    "message": {"scale": 0.35, "optimize": False, "format": MESSAGE_IMAGE_FORMAT},
+    "preview": {"scale": 0.16, "optimize": False, "format": MESSAGE_IMAGE_FORMAT},
+}
+if PNG_OPTIMIZE in ("0", "1", "true", "false"):
+    for _settings in RENDER_PROFILES.values():
+        _settings["optimize"] = PNG_OPTIMIZE in ("1", "true")
+RENDER_PROFILE = os.getenv("RENDER_PROFILE", "print").strip().lower()
+if RENDER_PROFILE not in RENDER_PROFILES:
+    RENDER_PROFILE = "print"
+
+IMAGE_FORMATS = {
+    # format -> (文件扩展名, mimetype)
+    "png": ("png", "image/png"),
+    "jpeg": ("jpg", "image/jpeg"),
+    "webp": ("webp", "image/webp"),
+}
+
+# 异步 /hook：HOOK_ASYNC=1 时默认入队返回202（也可用 ?async=1 / ?async=0 按请求切换）
+HOOK_ASYNC = os.getenv("HOOK_ASYNC", "0") == "1"
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", "32"))
+JOB_TTL = int(os.getenv("JOB_TTL", "3600"))
+# 任务状态存放在 STATE_DIR 下的SQLite中：多个gunicorn worker时，GET /jobs/<id> 落在任意worker上都能查到
+JOB_STORE_PATH = os.getenv("JOB_STORE_PATH", os.path.join(STATE_DIR, "jobs.sqlite3"))
+JOB_RETRY_AFTER = int(os.getenv("JOB_RETRY_AFTER", "5"))
+
+# 渲染进程池：RENDER_WORKERS>0 时 /hook 的渲染在预先fork的子进程中执行（0表示在请求线程内渲染）
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", "0"))
+RENDER_TIMEOUT = float(os.getenv("RENDER_TIMEOUT", "60"))
+# 渲染内存预算(MB)：在途渲染按估算的峰值内存占用预算，预算不足时排队等待（0表示不限制）
+# 单次渲染峰值估算（不含共享的底图缓存）：print约 157MB（输出图像 4961×7016×4字节 + 编码缓冲），message约 26MB，preview约 12MB；
+# PNG复用底图条带（PNG_BAND_CACHE_MB）时不合成整张图，print约 27MB，message约 11MB
+# 实测值见 python bench.py --scenario memory（print约 150MB，复用条带时约 19MB）
+RENDER_MEMORY_MB = int(os.getenv("RENDER_MEMORY_MB", "512"))
+# RENDER_MEMORY_MB 是整个服务的总预算，由各个进程均分：gunicorn.conf.py 把 RENDER_MEMORY_PROCESSES 设为worker数
+RENDER_MEMORY_PROCESSES = max(1, int(os.getenv("RENDER_MEMORY_PROCESSES", "1")))
+# 生产服务：请求体大小上限(MB)，收到SIGTERM后等待在途任务完成的最长时间(秒)
+MAX_REQUEST_MB = int(os.getenv("MAX_REQUEST_MB", "16"))
+GRACEFUL_TIMEOUT = int(os.getenv("GRACEFUL_TIMEOUT", "30"))
+# 批量生成：工作进程数（默认CPU核数），合并PDF时每页JPEG质量
+BATCH_WORKERS = int(os.getenv("BATCH_WORKERS", "0")) or (os.cpu_count() or 1)
+BATCH_PDF_JPEG_QUALITY = int(os.getenv("BATCH_PDF_JPEG_QUALITY", "92"))
+# 名片实际尺寸（毫米），用于PDF页面大小：印刷档位 4961×7016 像素即 600DPI 的 A4
+CARD_SIZE_MM = (210, 297)
+# 日志：级别、输出格式（json/text）、按请求抽样输出DEBUG细节的比例(0~1)、日志队列长度（满时丢弃）
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").strip().upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").strip().lower()
+LOG_DEBUG_SAMPLE = float(os.getenv("LOG_DEBUG_SAMPLE", "0"))
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+# 在响应头 Server-Timing 中返回各阶段耗时（浏览器开发者工具可直接查看）
+SERVER_TIMING = os.getenv("SERVER_TIMING", "0") == "1"
+
+MBTI_TYPES = ("ENFJ", "ENFP", "ENTJ", "ENTP", "ESFJ", "ESFP", "ESTJ", "ESTP",
+              "INFJ", "INFP", "INTJ", "INTP", "ISFJ", "ISFP", "ISTJ", "ISTP")
+
+app = Flask(__name__)
+app.config["MAX_CONTENT_LENGTH"] = MAX_REQUEST_MB * 1024 * 1024
+
+# ----------------------- Logging -----------------------
+# 每个请求的关联ID，以及该请求是否被抽中输出DEBUG细节；通过 contextvars 传到后台线程
+request_id_var: contextvars.ContextVar = contextvars.ContextVar("request_id", default="-")
+debug_sampled_var: contextvars.ContextVar = contextvars.ContextVar("debug_sampled", default=False)
+
+_level = logging.getLevelName(LOG_LEVEL)
+LOG_LEVEL_NO = _level if isinstance(_level, int) else logging.INFO
+
+# LogRecord 自带的属性；其余属性（logger.info(..., extra={...}) 传入）作为结构化字段输出
+_LOG_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "request_id"}
+
+class JsonLogFormatter(logging.Formatter):
+    """每条日志一行JSON：时间、级别、消息、关联ID，以及 extra 传入的字段"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            "request_id": getattr(record, "request_id", "-"),
+            "pid": record.process,
+        }
+        for key, value in vars(record).items():
+            if key not in _LOG_RECORD_ATTRS:
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class RequestContextFilter(logging.Filter):
+    """补上关联ID；低于 LOG_LEVEL 的记录只在被抽样的请求中保留"""
+
+    def __init__(self, level: int):
+        super().__init__()
+        self.level = level
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id_var.get()
+        return record.levelno >= self.level or debug_sampled_var.get()
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """日志记录放入有界队列，由后台线程写stdout；队列满时丢弃并计数，不阻塞请求线程
+
+    与其他后台线程一样按进程重建：fork出的子进程（gunicorn worker、渲染进程）各自启动写日志线程。
+    """
+
+    def __init__(self, target: logging.Handler, maxsize: int):
+        super().__init__(queue.Queue(maxsize=maxsize))
+        self.target = target
+        self.maxsize = maxsize
+        self.dropped = 0
+        self._listener: Optional[logging.handlers.QueueListener] = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_listener(self):
+        if self._listener is not None:
+            return
+        with self._start_lock:
+            if self._listener is None:
+                self.queue = queue.Queue(maxsize=self.maxsize)
+                self._listener = logging.handlers.QueueListener(self.queue, self.target)
+                self._listener.start()
+
+    def after_fork(self):
+        # 后台写出线程不会随fork复制，子进程首次记录日志时重新启动
+        self._start_lock = threading.Lock()
+        self._listener = None
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # 消息参数在这里定型（只有通过过滤的记录才会走到这里），JSON序列化和写stdout在后台线程
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_text = self.target.formatter.formatException(record.exc_info) if record.exc_info else None
+        record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        self._ensure_listener()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def stop(self):
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
+
+def setup_logging(level: int = LOG_LEVEL_NO) -> logging.Logger:
+    target = logging.StreamHandler(sys.stdout)
+    if LOG_FORMAT == "text":
+        target.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [%(request_id)s] %(message)s"))
+    else:
+        target.setFormatter(JsonLogFormatter())
+    handler = NonBlockingQueueHandler(target, LOG_QUEUE_SIZE)
+    handler.addFilter(RequestContextFilter(level))
+
+    log = logging.getLogger("mbti_card")
+    log.handlers[:] = [handler]
+    log.propagate = False
+    # 开启抽样时放行DEBUG，由过滤器按请求决定是否输出；否则低于 LOG_LEVEL 的调用直接返回，不构造日志记录
+    log.setLevel(min(level, logging.DEBUG) if LOG_DEBUG_SAMPLE > 0 else level)
+    atexit.register(handler.stop)
+    return log
+
+logger = setup_logging()
+
+def debug_enabled() -> bool:
+    """当前请求会不会输出DEBUG日志（用于跳过构造代价较高的调试信息）"""
+    return logger.isEnabledFor(logging.DEBUG) and (LOG_LEVEL_NO <= logging.DEBUG or debug_sampled_var.get())
+
+def begin_request_context(request_id: Optional[str] = None) -> str:
+    """为当前请求设置关联ID并决定是否抽样输出DEBUG细节"""
+    request_id = request_id or uuid.uuid4().hex[:16]
+    request_id_var.set(request_id)
+    debug_sampled_var.set(LOG_DEBUG_SAMPLE > 0 and random.random() < LOG_DEBUG_SAMPLE)
+    request_timings_var.set([])
+    return request_id
+
+# ----------------------- Metrics -----------------------
+# 指标保存在各进程内存中：gunicorn 多worker时 /metrics 反映处理本次抓取的worker
+metrics = MetricsRegistry()
+STAGE_SECONDS = metrics.histogram(
+    "mbti_card_stage_seconds", "Time spent in each stage of the card pipeline", ["stage"])
+REQUEST_SECONDS = metrics.histogram(
+    "mbti_card_request_seconds", "HTTP request latency", ["endpoint"])
+REQUESTS_TOTAL = metrics.counter(
+    "mbti_card_requests_total", "HTTP requests", ["endpoint", "method", "status"])
+RENDERS_TOTAL = metrics.counter(
+    "mbti_card_renders_total", "Cards rendered", ["profile", "result"])
+RENDERS_IN_FLIGHT = metrics.gauge(
+    "mbti_card_renders_in_flight", "Cards currently being rendered")
+CACHE_LOOKUPS = metrics.counter(
+    "mbti_card_cache_lookups_total", "Cache lookups by cache and result", ["cache", "result"])
+CONTACT_BATCHES = metrics.counter(
+    "mbti_card_contact_batches_total", "batch_get_id calls made by the contact resolver", ["result"])
+
+def _cache_hit_ratios():
+    ratios = {}
+    for cache in ("template", "png_bands", "result", "feishu_image", "qr", "contact"):
+        hits = CACHE_LOOKUPS.value(cache=cache, result="hit")
+        misses = CACHE_LOOKUPS.value(cache=cache, result="miss")
+        if hits + misses:
+            ratios[(cache,)] = hits / (hits + misses)
+    return ratios
+
+metrics.gauge("mbti_card_cache_hit_ratio", "Cache hit ratio since process start", ["cache"], fn=_cache_hit_ratios)
+metrics.gauge("mbti_card_log_records_dropped", "Log records dropped because the log queue was full",
+              fn=lambda: sum(getattr(h, "dropped", 0) for h in logger.handlers))
+
+# 当前请求各阶段耗时 [(阶段, 秒)]，用于 Server-Timing；后台线程通过 contextvars 共享同一个列表
+request_timings_var: contextvars.ContextVar = contextvars.ContextVar("request_timings", default=None)
+
+def record_stage(stage: str, seconds: float):
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    timings = request_timings_var.get()
+    if timings is not None:
+        timings.append((stage, seconds))
+
+@contextmanager
+def timed_stage(stage: str):
+    """记录一个阶段的耗时（也可作为装饰器使用）"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start)
+
+def server_timing_header(timings) -> str:
+    """同名阶段合并，按首次出现顺序输出：stage;dur=毫秒"""
+    totals: Dict[str, float] = {}
+    for stage, seconds in list(timings):
+        totals[stage] = totals.get(stage, 0.0) + seconds
+    return ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in totals.items())
+
+# ----------------------- Feishu helpers -----------------------
+class FeishuRetry(Retry):
+    """429对任意方法都重试（请求未被处理）；5xx只重试幂等方法；等待时间优先参考飞书限流头"""
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if status_code == 429 and self.total:
+            return True
+        return super().is_retry(method, status_code, has_retry_after)
+
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        if retry_after is not None:
+            return retry_after
+        # 飞书网关限流头：x-ogw-ratelimit-reset 为距离配额重置的秒数
+        reset = response.headers.get("x-ogw-ratelimit-reset")
+        if reset:
+            try:
+                return max(float(reset), 0.0)
+            except ValueError:
+                return None
+        return None
+
+class FeishuClient:
+    """飞书开放平台HTTP客户端：共享 requests.Session 连接池（keep-alive），连接/读取超时分离，429/5xx退避重试"""
+
+    def __init__(self, base_url: str, pool_size: int, connect_timeout: float, max_retries: int):
+        self.base_url = base_url
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.max_retries = max_retries
+        self._session: Optional[requests.Session] = None
+        self._lock = threading.Lock()
+
+    def _build_session(self) -> requests.Session:
+        retry = FeishuRetry(
+            total=self.max_retries,
+            connect=self.max_retries,
+            read=self.max_retries,
+            status=self.max_retries,
+            backoff_factor=0.5,
+            status_forcelist=(429, 500, 502, 503, 504),
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_size, max_retries=retry)
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    @property
+    def session(self) -> requests.Session:
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    self._session = self._build_session()
+        return self._session
+
+    def after_fork(self):
+        # 子进程不能复用父进程的连接，首次请求时重建连接池
+        self._lock = threading.Lock()
+        self._session = None
+
+    def request(self, method: str, path: str, read_timeout: float = 10, **kwargs) -> requests.Response:
+        url = path if path.startswith("http") else f"{self.base_url}{path}"
+        kwargs.setdefault("timeout", (self.connect_timeout, read_timeout))
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, path: str, **kwargs) -> requests.Response:
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path: str, **kwargs) -> requests.Response:
+        return self.request("POST", path, **kwargs)
+
+feishu = FeishuClient(FEISHU_BASE_URL, FEISHU_POOL_SIZE, FEISHU_CONNECT_TIMEOUT, FEISHU_MAX_RETRIES)
+
+# 飞书返回这些错误码时说明 tenant_access_token 已失效，需要刷新后重试
+FEISHU_TOKEN_INVALID_CODES = {99991661, 99991663, 99991677}
+
+class FeishuTokenExpired(RuntimeError):
+    """飞书接口返回token失效"""
+
+def check_feishu_token(r: requests.Response):
+    """飞书接口返回token失效错误码时抛出 FeishuTokenExpired"""
+    if r.status_code not in (400, 401, 403):
+        return
+    try:
+        code = r.json().get("code")
+    except ValueError:
+        return
+    if code in FEISHU_TOKEN_INVALID_CODES:
+        raise FeishuTokenExpired(f"tenant_access_token invalid: code={code}")
+
+@timed_stage("token")
+def fetch_tenant_access_token() -> (str, int):
+    """请求新的 tenant_access_token，返回 (token, 有效秒数)"""
+    payload = {"app_id": APP_ID, "app_secret": APP_SECRET}
+    r = feishu.post("/auth/v3/tenant_access_token/internal/", json=payload, read_timeout=10)
+    r.raise_for_status()
+    data = r.json()
+    if data.get("code") != 0:
+        raise RuntimeError(f"get_tenant_access_token failed: {data}")
+    return data["tenant_access_token"], int(data.get("expire", 7200))
+
+class TokenManager:
+    """tenant_access_token 缓存：按 expire 缓存、到期前后台刷新，并发请求只触发一次刷新
+
+    飞书在token剩余有效期不足30分钟时才会签发新token，因此默认提前 FEISHU_TOKEN_REFRESH_MARGIN 秒刷新。
+    """
+
+    def __init__(self, fetch, refresh_margin: int):
+        self._fetch = fetch
+        self.refresh_margin = refresh_margin
+        self._token: Optional[str] = None
+        self._expires_at = 0.0
+        self._lock = threading.Lock()
+        self._timer: Optional[threading.Timer] = None
+
+    def _valid(self) -> bool:
+        # 留出请求耗时的余量，避免拿到马上过期的token
+        return self._token is not None and time.time() < self._expires_at - 60
+
+    def get(self) -> str:
+        token = self._token
+        if token is not None and self._valid():
+            return token
+        with self._lock:
+            # single-flight：排队等锁的请求直接复用刚刷新好的token
+            if not self._valid():
+                self._refresh_locked()
+            return self._token
+
+    def _refresh_locked(self):
+        token, expire = self._fetch()
+        self._token = token
+        self._expires_at = time.time() + expire
+        self._schedule(max(expire - self.refresh_margin, 30))
+
+    def _schedule(self, delay: float):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = threading.Timer(delay, self._background_refresh)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _background_refresh(self):
+        try:
+            with self._lock:
+                self._refresh_locked()
+        except Exception as e:
+            logger.warning("后台刷新tenant_access_token失败: %s", e)
+            self._schedule(30)
+
+    def invalidate(self, token: Optional[str] = None):
+        """丢弃缓存的token；传入token时只在它仍是当前token时才丢弃"""
+        with self._lock:
+            if token is None or token == self._token:
+                self._token = None
+                self._expires_at = 0.0
+
+    def after_fork(self):
+        # 刷新定时器线程不会随fork复制：子进程沿用已缓存的token，过期时在 get() 中刷新
+        self._lock = threading.Lock()
+        self._timer = None
+
+token_manager = TokenManager(fetch_tenant_access_token, FEISHU_TOKEN_REFRESH_MARGIN)
+
+def get_tenant_access_token() -> str:
+    return token_manager.get()
+
+def call_with_token(fn, *args, **kwargs):
+    """以当前token调用飞书接口；token失效时刷新并重试一次"""
+    token = token_manager.get()
+    try:
+        return fn(token, *args, **kwargs)
+    except FeishuTokenExpired:
+        token_manager.invalidate(token)
+        return fn(token_manager.get(), *args, **kwargs)
+
+# batch_get_id 单次最多查询的邮箱、手机号个数（各自计算）
+CONTACT_BATCH_MAX = 50
+
+@timed_stage("resolve_open_id")
+def batch_get_open_ids(token: str, emails=(), mobiles=()) -> Dict[Tuple[str, str], Optional[str]]:
+    """
+    Use Feishu contact-v3 batch_get_id to resolve open_ids for up to 50 emails and 50 mobiles at once
+
+    返回 {("email" 或 "mobile", 值): open_id}，通讯录中查不到的为None；接口报错时抛出异常（不能当作查不到）。
+    """
+    emails, mobiles = list(emails), list(mobiles)
+    if not emails and not mobiles:
+        return {}
+    body = {}
+    if emails:
+        body["emails"] = emails
+    if mobiles:
+        body["mobiles"] = mobiles
+    headers = {"Authorization": f"Bearer {token}"}
+    r = feishu.post("/contact/v3/users/batch_get_id", headers=headers, params={"user_id_type": "open_id"},
+                    json=body, read_timeout=10)
+    check_feishu_token(r)
+    r.raise_for_status()
+    data = r.json()
+    if data.get("code") != 0:
+        raise RuntimeError(f"batch_get_id failed: code={data.get('code')} msg={data.get('msg')}")
+    found = {("email", email): None for email in emails}
+    found.update({("mobile", mobile): None for mobile in mobiles})
+    for item in (data.get("data") or {}).get("user_list") or []:
+        open_id = item.get("user_id") or item.get("open_id")
+        if item.get("email") in emails:
+            found[("email", item["email"])] = open_id
+        if item.get("mobile") in mobiles:
+            found[("mobile", item["mobile"])] = open_id
+    return found
+
+def batch_get_open_id_by_email_or_mobile(token: str, email: Optional[str]=None, mobile: Optional[str]=None) -> Optional[str]:
+    """
+    Use Feishu contact-v3 API to get open_id by email or mobile（单个联系人，不经过缓存；hook 使用 contact_resolver）
+    """
+    found = batch_get_open_ids(token, [email] if email else [], [mobile] if mobile else [])
+    return found.get(("email", email)) or found.get(("mobile", mobile))
+
+class MultipartFileBody:
+    """multipart/form-data 请求体：若干表单字段 + 一个文件，文件内容发送时才从磁盘分块读取
+
+    长度事先可知（Content-Length，不用分块传输）；支持 seek/tell，429/5xx 重试时 urllib3 会回到起点重新发送。
+    """
+
+    def __init__(self, path: str, fields: Dict[str, str], file_field: str, filename: str, mimetype: str):
+        boundary = uuid.uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={boundary}"
+        head = "".join(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'
+            for name, value in fields.items()
+        )
+        head += (f'--{boundary}\r\nContent-Disposition: form-data; name="{file_field}"; filename="{filename}"\r\n'
+                 f"Content-Type: {mimetype}\r\n\r\n")
+        self._head = head.encode("utf-8")
+        self._tail = f"\r\n--{boundary}--\r\n".encode("ascii")
+        self._file = open(path, "rb")
+        self._file_size = os.fstat(self._file.fileno()).st_size
+        self._size = len(self._head) + self._file_size + len(self._tail)
+        self._pos = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._pos, io.SEEK_END: self._size}[whence]
+        self._pos = max(0, min(self._size, base + offset))
+        return self._pos
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            size = self._size - self._pos
+        file_start = len(self._head)
+        file_end = file_start + self._file_size
+        pieces = []
+        while size > 0 and self._pos < self._size:
+            pos = self._pos
+            if pos < file_start:
+                piece = self._head[pos:pos + size]
+            elif pos < file_end:
+                self._file.seek(pos - file_start)
+                piece = self._file.read(min(size, file_end - pos))
+                if not piece:
+                    raise IOError("上传过程中文件被截断")
+            else:
+                piece = self._tail[pos - file_end:pos - file_end + size]
+            pieces.append(piece)
+            self._pos += len(piece)
+            size -= len(piece)
+        return b"".join(pieces)
+
+    def close(self):
+        self._file.close()
+
+@timed_stage("upload")
+def upload_image_to_feishu(token: str, image, mimetype: str = "image/png") -> str:
+    """上传图片，image 为图片字节或本地文件路径（路径时从磁盘流式发送，不整体读入内存）"""
+    headers = {"Authorization": f"Bearer {token}"}
+    
+    # 修复：image_type应该作为form-data字段，不是URL参数
+    data = {"image_type": "message"}
+    ext = mimetype.split("/")[-1].replace("jpeg", "jpg")
+    if isinstance(image, (bytes, bytearray)):
+        files = {"image": (f"card.{ext}", image, mimetype)}
+        size = len(image)
+        r = feishu.post("/im/v1/images", headers=headers, files=files, data=data, read_timeout=20)
+    else:
+        body = MultipartFileBody(image, data, "image", f"card.{ext}", mimetype)
+        size = len(body)
+        try:
+            r = feishu.post("/im/v1/images", headers={**headers, "Content-Type": body.content_type},
+                            data=body, read_timeout=20)
+        finally:
+            body.close()
+    # 只记录状态码和大小，不记录响应内容
+    logger.debug("上传图片到飞书", extra={"bytes": size, "mimetype": mimetype, "status": r.status_code})
+    check_feishu_token(r)
+    
+    try:
+        response_data = r.json()
+        if response_data.get("code") != 0:
+            raise RuntimeError(f"Upload image failed - Code: {response_data.get('code')}, Message: {response_data.get('msg')}, Details: {response_data}")
+        return response_data["data"]["image_key"]
+    except ValueError as e:
+        # 如果响应不是JSON格式
+        raise RuntimeError(f"Upload image failed - Invalid JSON response: {r.text}, Status: {r.status_code}")
+    except Exception as e:
+        raise RuntimeError(f"Upload image failed - Status: {r.status_code}, Response: {r.text}, Error: {str(e)}")
+
+@timed_stage("send")
+def send_image_message_to_open_id(token: str, open_id: str, image_key: str) -> Dict[str, Any]:
+    headers = {"Authorization": f"Bearer {token}"}
+    payload = {
+        "receive_id": open_id,
+        "msg_type": "image",
+        "content": json.dumps({"image_key": image_key}, ensure_ascii=False)
+    }
+    r = feishu.post("/im/v1/messages", headers=headers, params={"receive_id_type": "open_id"}, json=payload, read_timeout=10)
+    check_feishu_token(r)
+    r.raise_for_status()
+    return r.json()
+
+def download_feishu_image(token: str, image_key: str) -> requests.Response:
+    """以流式方式请求飞书图片，调用方负责 iter_content 读取并关闭响应"""
+    headers = {"Authorization": f"Bearer {token}"}
+    r = feishu.get(f"/im/v1/images/{image_key}", headers=headers, read_timeout=15, stream=True)
+    check_feishu_token(r)
+    return r
+
+# ----------------------- Utilities -----------------------
+def image_nbytes(im: Image.Image) -> int:
+    """Pillow中图像实际占用的内存：单通道每像素1字节，多通道（包括RGB）每像素4字节"""
+    return im.width * im.height * (1 if im.mode in ("1", "L", "P") else 4)
+
+def safe_filename(s: str) -> str:
+    s = s.strip().replace(" ", "_")
+    return re.sub(r"[^a-zA-Z0-9_\-\u4e00-\u9fa5]", "", s)
+
+class FontRegistry:
+    """字体注册表：字体路径只解析一次，FreeType字体对象按字号缓存（字形宽度由 layout 模块缓存）"""
+
+    def __init__(self, candidates):
+        self._candidates = candidates
+        self._path: Optional[str] = None
+        self._resolved = False
+        self._fonts: Dict[int, Any] = {}
+        self._lock = threading.Lock()
+
+    def resolve(self) -> Optional[str]:
+        """找到第一个可用的字体文件；都不可用时返回None（使用Pillow默认字体）"""
+        with self._lock:
+            if not self._resolved:
+                for path in self._candidates:
+                    if not os.path.exists(path):
+                        continue
+                    try:
+                        ImageFont.truetype(path, size=12)
+                    except Exception:
+                        continue
+                    self._path = path
+                    break
+                self._resolved = True
+            return self._path
+
+    def get(self, size: int):
+        font = self._fonts.get(size)
+        if font is not None:
+            return font
+        path = self.resolve()
+        font = ImageFont.truetype(path, size=size) if path else ImageFont.load_default()
+        with self._lock:
+            return self._fonts.setdefault(size, font)
+
+    def after_fork(self):
+        self._lock = threading.Lock()
+
+font_registry = FontRegistry([
+    # 优先使用项目字体文件
+    os.path.join(ASSETS_DIR, "font.ttf"),
+    # 备用系统字体
+    "/System/Library/Fonts/PingFang.ttc",  # macOS
+    "/usr/share/fonts/truetype/noto/NotoSansSC-Regular.ttf",  # Linux
+])
+
+def try_load_font(size: int):
+    return font_registry.get(size)
+
+@timed_stage("qr_download")
+def get_wechat_qr_from_attachment(token: str, attachment_id: str) -> Optional[Image.Image]:
+    """通过飞书附件ID获取微信二维码图片（居中裁成正方形，保持原分辨率，渲染时只缩放一次）"""
+    try:
+        headers = {"Authorization": f"Bearer {token}"}
+        r = feishu.get(f"/drive/v1/files/{attachment_id}/content", headers=headers, read_timeout=15)
+        check_feishu_token(r)
+        r.raise_for_status()
+        
+        # 转换为PIL图片对象：只有带透明度的图片才保留alpha，合成时alpha作为单独的蒙版
+        im = Image.open(io.BytesIO(r.content))
+        im = im.convert("RGBA" if im.mode in ("RGBA", "LA", "PA") or "transparency" in im.info else "RGB")
+        # 裁成方形，适合放在名片上（只裁剪不重采样）
+        w, h = im.size
+        side = min(w, h)
+        left, top = (w - side) // 2, (h - side) // 2
+        if (w, h) != (side, side):
+            im = im.crop((left, top, left + side, top + side))
+        return im
+    except FeishuTokenExpired:
+        raise
+    except Exception as e:
+        logger.warning("获取微信二维码失败: %s", e)
+        return None
+
+def card_image_path(filename: str) -> Optional[str]:
+    """/image/ 可访问的本地名片路径：只允许 OUTPUT_DIR 顶层、名片格式扩展名、不以点开头的文件，其余返回None"""
+    name = os.path.basename(filename)
+    ext = os.path.splitext(name)[1].lower().lstrip(".")
+    if name != filename or name.startswith(".") or ext not in {file_ext for file_ext, _ in IMAGE_FORMATS.values()}:
+        return None
+    path = os.path.join(OUTPUT_DIR, name)
+    # 不跟随指向 OUTPUT_DIR 之外的符号链接
+    if os.path.dirname(os.path.realpath(path)) != os.path.realpath(OUTPUT_DIR):
+        return None
+    return path
+
+def guess_image_mimetype(filename: str) -> str:
+    ext = os.path.splitext(filename)[1].lower().lstrip(".")
+    for file_ext, mimetype in IMAGE_FORMATS.values():
+        if ext == file_ext:
+            return mimetype
+    return "image/png"
+
+def sniff_image_mimetype(data: bytes) -> str:
+    if data[:3] == b"\xff\xd8\xff":
+        return "image/jpeg"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return "image/png"
+
+def _encode_whole(im: Image.Image, settings: Dict[str, Any]) -> bytes:
+    """用Pillow一次编码完整张图"""
+    buf = io.BytesIO()
+    fmt = settings.get("format", "png")
+    if fmt == "jpeg":
+        im.save(buf, "JPEG", quality=MESSAGE_IMAGE_QUALITY, optimize=settings["optimize"])
+    elif fmt == "webp":
+        im.save(buf, "WEBP", quality=MESSAGE_IMAGE_QUALITY, method=4)
+    else:
+        im.save(buf, "PNG", optimize=settings["optimize"], compress_level=PNG_COMPRESS_LEVEL)
+    return buf.getvalue()
+
+def iter_card_chunks(card, settings: Dict[str, Any]):
+    """按档位参数编码名片（RGB图像或 CardLayers），逐块产出编码结果
+
+    PNG按条带流式压缩（STREAM_ENCODE），图层只压缩有前景的条带、其余复用底图的预压缩片段；
+    其他格式先合成整张图再一次编码完。
+    """
+    if settings.get("format", "png") == "png" and STREAM_ENCODE:
+        # 与Pillow一致：optimize 时使用最高压缩级别
+        level = 9 if settings["optimize"] else PNG_COMPRESS_LEVEL
+        if isinstance(card, CardLayers) and card.key and band_cache.enabled:
+            return iter_layer_chunks(card, level)
+        return iter_png(card.flatten() if isinstance(card, CardLayers) else card, level, PNG_STRIP_ROWS)
+    return iter((_encode_whole(card.flatten() if isinstance(card, CardLayers) else card, settings),))
+
+@timed_stage("encode")
+def encode_card(card, settings: Dict[str, Any]) -> bytes:
+    """按档位参数把名片编码一次，返回的字节同时用于落盘、上传和响应"""
+    return b"".join(iter_card_chunks(card, settings))
+
+def temp_path(path: str) -> str:
+    """写入 path 前使用的临时文件：多个worker进程同时写同名名片时互不覆盖"""
+    return f"{path}.{uuid.uuid4().hex}.tmp"
+
+@timed_stage("encode")
+def write_card_file(card, settings: Dict[str, Any], path: str) -> int:
+    """边编码边写入文件（先写临时文件再改名），内存中不保留完整的编码结果；返回文件大小"""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = temp_path(path)
+    size = 0
+    try:
+        with open(tmp_path, "wb") as f:
+            for chunk in iter_card_chunks(card, settings):
+                f.write(chunk)
+                size += len(chunk)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return size
+
+class CardWriter:
+    """后台写盘：渲染线程只提交字节，写入由单独线程完成；写完前可从 pending 读取"""
+
+    def __init__(self):
+        self.after_fork()
+
+    def after_fork(self):
+        # fork出的子进程（批量渲染）没有写盘线程，继承来的队列计数也不可靠；父进程排队的写入仍由父进程完成
+        self._queue: "queue.Queue[Optional[tuple]]" = queue.Queue()
+        self._pending: Dict[str, bytes] = {}
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="card-writer", daemon=True)
+            self._thread.start()
+
+    @staticmethod
+    @timed_stage("disk_write")
+    def _write_file(path: str, data: bytes):
+        tmp_path = temp_path(path)
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                path, data = item
+                try:
+                    self._write_file(path, data)
+                except Exception as e:
+                    logger.error("名片写盘失败: %s", e, extra={"path": path})
+                finally:
+                    with self._lock:
+                        self._pending.pop(path, None)
+            finally:
+                self._queue.task_done()
+
+    def write(self, path: str, data: bytes, wait: bool = not CARD_WRITE_ASYNC):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        if wait:
+            self._write_file(path, data)
+            return
+        with self._lock:
+            self._pending[path] = data
+            self._ensure_thread()
+        self._queue.put((path, data))
+
+    def pending(self, path: str) -> Optional[bytes]:
+        """尚未写完的文件内容（写完后返回None）"""
+        with self._lock:
+            return self._pending.get(path)
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """等待所有排队的写入完成；给出 timeout 时最多等待这么久，超时返回False"""
+        if timeout is None:
+            self._queue.join()
+            return True
+        deadline = time.time() + timeout
+        while self._queue.unfinished_tasks and time.time() < deadline:
+            time.sleep(0.05)
+        return not self._queue.unfinished_tasks
+
+card_writer = CardWriter()
+atexit.register(card_writer.flush)
+
+# ----------------------- Feishu image cache -----------------------
+class FeishuImageCache:
+    """/feishu-image 代理的内容缓存，image_key 不可变，按 key 缓存即可
+
+    查找顺序：内存LRU → /hook 本地保存的名片（image_key → saved_path 映射）→ 磁盘缓存 → 回源飞书。
+    磁盘缓存按 disk_budget_bytes 淘汰：命中时更新文件mtime，超出预算时删除mtime最早的图片。
+    """
+
+    KEY_RE = re.compile(r"^[A-Za-z0-9_\-]+$")
+
+    def __init__(self, budget_bytes: int, disk_dir: Optional[str], disk_budget_bytes: int = 0):
+        self.budget_bytes = budget_bytes
+        self.disk_dir = disk_dir
+        self.disk_budget_bytes = disk_budget_bytes
+        self._items: "OrderedDict[str, bytes]" = OrderedDict()
+        self._size = 0
+        self._local: Dict[str, str] = {}
+        self._lock = threading.Lock()
+        self._disk_lock = threading.Lock()
+        self._disk_size: Optional[int] = None  # 首次写入时扫描目录得到；多个进程共用目录，超出预算时重新扫描校正
+
+    def after_fork(self):
+        self._lock = threading.Lock()
+        self._disk_lock = threading.Lock()
+
+    def _disk_path(self, image_key: str, suffix: str = "") -> Optional[str]:
+        if not self.disk_dir or not self.KEY_RE.match(image_key):
+            return None
+        return os.path.join(self.disk_dir, f"{image_key}{suffix}")
+
+    def _remember(self, image_key: str, data: bytes):
+        if len(data) > self.budget_bytes:
+            return
+        with self._lock:
+            if image_key in self._items:
+                self._items.move_to_end(image_key)
+                return
+            while self._items and self._size + len(data) > self.budget_bytes:
+                _, old = self._items.popitem(last=False)
+                self._size -= len(old)
+            self._items[image_key] = data
+            self._size += len(data)
+
+    def register_local(self, image_key: str, saved_path: str):
+        """记录 /hook 上传后的 image_key 对应的本地名片，代理时直接读本地文件"""
+        with self._lock:
+            self._local[image_key] = saved_path
+        index_path = self._disk_path(image_key, ".path")
+        if index_path:
+            card_writer.write(index_path, os.path.abspath(saved_path).encode("utf-8"))
+
+    def local_path(self, image_key: str) -> Optional[str]:
+        with self._lock:
+            path = self._local.get(image_key)
+        if path is None and result_cache is not None:
+            path = result_cache.image_path(image_key)
+        if path is None:
+            index_path = self._disk_path(image_key, ".path")
+            if index_path and os.path.exists(index_path):
+                with open(index_path, "r", encoding="utf-8") as f:
+                    path = f.read().strip()
+                with self._lock:
+                    self._local[image_key] = path
+        return path
+
+    def get(self, image_key: str) -> (Optional[bytes], Optional[str], str):
+        """返回 (内存内容, 本地文件路径, 命中层级)；文件层命中时只返回路径，由调用方流式发送"""
+        with self._lock:
+            data = self._items.get(image_key)
+            if data is not None:
+                self._items.move_to_end(image_key)
+                return data, None, "memory"
+
+        path = self.local_path(image_key)
+        if path:
+            data = card_writer.pending(path)
+            if data is not None:
+                return data, None, "local"
+            if os.path.exists(path):
+                return None, path, "local"
+
+        disk_path = self._disk_path(image_key)
+        if disk_path and os.path.exists(disk_path):
+            try:
+                os.utime(disk_path)  # 记录访问时间，淘汰时按mtime排序
+            except OSError:
+                pass
+            return None, disk_path, "disk"
+        return None, None, "miss"
+
+    def _disk_entries(self):
+        """磁盘缓存中的图片 [(mtime, 路径, 字节数)]（不含 .path 索引和写入中的 .part 文件）"""
+        entries = []
+        try:
+            with os.scandir(self.disk_dir) as it:
+                for entry in it:
+                    if not entry.is_file() or entry.name.endswith((".path", ".part")):
+                        continue
+                    try:
+                        st = entry.stat()
+                    except OSError:
+                        continue
+                    entries.append((st.st_mtime, entry.path, st.st_size))
+        except FileNotFoundError:
+            pass
+        return entries
+
+    def _trim_disk(self, added: int):
+        """新写入 added 字节后检查磁盘预算，超出时删除最久未用的图片"""
+        if self.disk_budget_bytes <= 0:
+            return
+        with self._disk_lock:
+            if self._disk_size is None:
+                self._disk_size = sum(size for _, _, size in self._disk_entries())
+            else:
+                self._disk_size += added
+            if self._disk_size <= self.disk_budget_bytes:
+                return
+            entries = sorted(self._disk_entries())
+            total = sum(size for _, _, size in entries)
+            for _, path, size in entries:
+                if total <= self.disk_budget_bytes:
+                    break
+                try:
+                    os.remove(path)
+                    total -= size
+                except FileNotFoundError:
+                    total -= size  # 已被其他进程删除
+                except OSError as e:
+                    logger.warning("清理图片磁盘缓存失败: %s", e, extra={"path": path})
+            self._disk_size = total
+
+    def stream_through(self, image_key: str, chunks):
+        """边转发边缓存回源内容：写入磁盘临时文件，较小的图片同时放进内存LRU"""
+        disk_path = self._disk_path(image_key)
+        part_path = f"{disk_path}.{uuid.uuid4().hex}.part" if disk_path else None
+        max_item = self.budget_bytes // 4
+        buffered = []
+        size = 0
+        complete = False
+        f = None
+        try:
+            if part_path:
+                os.makedirs(self.disk_dir, exist_ok=True)
+                f = open(part_path, "wb")
+            for chunk in chunks:
+                if not chunk:
+                    continue
+                size += len(chunk)
+                if f is not None:
+                    f.write(chunk)
+                if buffered is not None:
+                    buffered.append(chunk)
+                    if size > max_item:
+                        buffered = None
+                yield chunk
+            complete = True
+        finally:
+            if f is not None:
+                f.close()
+                if complete:
+                    os.replace(part_path, disk_path)
+                    self._trim_disk(size)
+                else:
+                    os.remove(part_path)
+            if complete and buffered is not None:
+                self._remember(image_key, b"".join(buffered))
+
+feishu_image_cache = FeishuImageCache(
+    FEISHU_IMAGE_CACHE_MB * 1024 * 1024,
+    os.path.join(STATE_DIR, "feishu-image-cache") if FEISHU_IMAGE_DISK_CACHE else None,
+    FEISHU_IMAGE_DISK_CACHE_MB * 1024 * 1024,
+)
+
+# ----------------------- WeChat QR -----------------------
+class QRPrefetcher:
+    """微信二维码附件：解析出附件ID后立即在后台下载解码，与底图加载、文字排版并行；解码结果按附件ID缓存
+
+    同一附件的并发请求共用一次下载；下载失败不缓存，下次提交会重试。
+    """
+
+    def __init__(self, workers: int, budget: int):
+        self.workers = max(1, workers)
+        self.budget = budget
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, Future]" = OrderedDict()
+        self._sizes: Dict[str, int] = {}
+        self._bytes = 0
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def _ensure_executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="qr-prefetch")
+
+    def after_fork(self):
+        # fork出的子进程（渲染进程池、批量渲染）不继承线程，线程池延迟重建；父进程中未完成的下载也丢弃
+        self._lock = threading.Lock()
+        self._executor = None
+        for key, future in list(self._entries.items()):
+            if not future.done():
+                del self._entries[key]
+                self._bytes -= self._sizes.pop(key, 0)
+
+    def prefetch(self, attachment_id: str) -> Future:
+        """开始（或复用）某个附件的下载，返回 Future[Optional[Image]]"""
+        with self._lock:
+            self._ensure_executor()
+            future = self._entries.get(attachment_id)
+            if future is not None:
+                self._entries.move_to_end(attachment_id)
+                CACHE_LOOKUPS.inc(cache="qr", result="hit")
+                return future
+            CACHE_LOOKUPS.inc(cache="qr", result="miss")
+            future = self._executor.submit(contextvars.copy_context().run,
+                                           call_with_token, get_wechat_qr_from_attachment, attachment_id)
+            self._entries[attachment_id] = future
+        future.add_done_callback(lambda f: self._done(attachment_id, f))
+        return future
+
+    def _done(self, attachment_id: str, future: Future):
+        im = None if future.cancelled() or future.exception() else future.result()
+        with self._lock:
+            if self._entries.get(attachment_id) is not future:
+                return
+            if im is None:
+                del self._entries[attachment_id]
+                return
+            size = image_nbytes(im)
+            self._sizes[attachment_id] = size
+            self._bytes += size
+            # 按LRU淘汰已完成的条目，直到回到预算以内（至少保留刚完成的这一个）
+            for key in list(self._entries):
+                if self._bytes <= self.budget:
+                    break
+                if key == attachment_id or key not in self._sizes:
+                    continue
+                del self._entries[key]
+                self._bytes -= self._sizes.pop(key)
+
+    def start(self, user: Dict[str, Any]):
+        """若提交中带二维码附件且尚未开始下载，则开始后台下载（结果以 Future 形式放入 user）"""
+        if user.get("qr_text") and qrcode is not None:
+            return  # 本地生成，不需要下载附件
+        if user.get("wechat_qr_image") is None and user.get("wechatQrAttachmentId") and APP_ID and APP_SECRET:
+            user["wechat_qr_image"] = self.prefetch(user["wechatQrAttachmentId"])
+
+    @staticmethod
+    def resolve(value, timeout: float = QR_WAIT_TIMEOUT) -> Optional[Image.Image]:
+        """等待后台下载完成；失败或超时返回None（名片不带二维码）"""
+        if not isinstance(value, Future):
+            return value
+        try:
+            with timed_stage("qr_wait"):
+                return value.result(timeout=timeout)
+        except FutureTimeoutError:
+            logger.warning("获取微信二维码超时（>%ss）", timeout)
+        except Exception as e:
+            logger.warning("获取微信二维码失败: %s", e)
+        return None
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"entries": len(self._sizes), "bytes": self._bytes}
+
+qr_prefetcher = QRPrefetcher(QR_PREFETCH_WORKERS, QR_CACHE_MB * 1024 * 1024)
+
+@lru_cache(maxsize=1024)
+def qr_matrix(text: str) -> (int, bytes):
+    """按内容缓存的二维码矩阵：(含静区的边长, 每个模块一个字节的灰度数据，黑0白255)"""
+    qr = qrcode.QRCode(error_correction=qrcode.constants.ERROR_CORRECT_M, border=4)
+    qr.add_data(text)
+    qr.make(fit=True)
+    matrix = qr.get_matrix()
+    return len(matrix), bytes(0 if cell else 255 for row in matrix for cell in row)
+
+@timed_stage("qr_generate")
+def render_qr_code(text: str, size: int) -> Image.Image:
+    """在本地生成二维码并直接画成 size×size：每个模块放大为整数像素的方块（最近邻），剩余像素均分到四周白边"""
+    n, data = qr_matrix(text)
+    module = max(1, size // n)
+    im = Image.frombytes("L", (n, n), data).resize((n * module, n * module), Image.NEAREST)
+    if im.width != size:
+        canvas = Image.new("L", (size, size), 255)
+        offset = (size - im.width) // 2
+        canvas.paste(im, (offset, offset))
+        im = canvas
+    return im.convert("RGB")
+
+
+# ----------------------- Template cache -----------------------
+class TemplateCache:
+    """进程内MBTI底图缓存：每个模板只解码一次，按内存预算做LRU淘汰，每次渲染拿到一份 copy()
+
+    缓存键为 (mbti, profile)，非print档位的底图由原图缩放一次后缓存。
+    """
+
+    def __init__(self, budget_bytes: int):
+        self.budget_bytes = budget_bytes
+        self._items: "OrderedDict[tuple, Image.Image]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._load_locks: Dict[tuple, threading.Lock] = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _nbytes(im: Image.Image) -> int:
+        return image_nbytes(im)
+
+    @staticmethod
+    def _read(mbti: str) -> Image.Image:
+        """解码原始底图为RGB：名片输出为RGB，alpha在合成时本来就会丢弃
+
+        底图本身是RGB（PNG颜色类型2）时直接使用解码结果，不再额外转换出一份RGBA；
+        渲染时复制底图即可，不需要整图转换。
+        """
+        template_path = os.path.join(ASSETS_DIR, f"{mbti}.png")
+        if not os.path.exists(template_path):
+            raise RuntimeError(f"MBTI底图不存在: {template_path}")
+        with Image.open(template_path) as im:
+            im.load()
+            return im if im.mode == "RGB" else im.convert("RGB")
+
+    def _decode(self, mbti: str, profile: str) -> Image.Image:
+        scale = RENDER_PROFILES[profile]["scale"]
+        if scale == 1.0:
+            return self._read(mbti)
+        # 原图已缓存时直接缩放；否则临时解码，缩放后即释放，不为缩放把印刷原图放进缓存（否则会挤掉已缓存的小图）
+        with self._lock:
+            full = self._items.get((mbti, "print"))
+        if full is None:
+            full = self._read(mbti)
+        size = (round(full.width * scale), round(full.height * scale))
+        return full.resize(size, Image.LANCZOS, reducing_gap=3.0)
+
+    def _load(self, mbti: str, profile: str = "print") -> Image.Image:
+        """返回缓存中的解码结果（只读，不要直接在上面绘制）"""
+        key = (mbti, profile)
+        with self._lock:
+            im = self._items.get(key)
+            if im is not None:
+                self._items.move_to_end(key)
+                self.hits += 1
+                CACHE_LOOKUPS.inc(cache="template", result="hit")
+                return im
+            load_lock = self._load_locks.setdefault(key, threading.Lock())
+
+        # 同一模板并发未命中时只解码一次
+        with load_lock:
+            with self._lock:
+                im = self._items.get(key)
+                if im is not None:
+                    self._items.move_to_end(key)
+                    self.hits += 1
+                    CACHE_LOOKUPS.inc(cache="template", result="hit")
+                    return im
+                self.misses += 1
+                CACHE_LOOKUPS.inc(cache="template", result="miss")
+            im = self._decode(mbti, profile)
+            self._put(key, im)
+            return im
+
+    def after_fork(self):
+        self._lock = threading.Lock()
+        self._load_locks = {}
+
+    def _put(self, key: tuple, im: Image.Image):
+        nbytes = self._nbytes(im)
+        if nbytes > self.budget_bytes:
+            return  # 预算装不下单个模板，不缓存
+        with self._lock:
+            if key in self._items:
+                return
+            while self._items and self._size + nbytes > self.budget_bytes:
+                _, old = self._items.popitem(last=False)
+                self._size -= self._nbytes(old)
+            self._items[key] = im
+            self._size += nbytes
+
+    def get(self, mbti: str, profile: str = "print") -> Image.Image:
+        """获取可绘制的底图副本"""
+        return self._load(mbti, profile).copy()
+
+    def shared(self, mbti: str, profile: str = "print") -> Image.Image:
+        """获取缓存中的底图本身（只读，多个渲染共享，不能在上面绘制）"""
+        return self._load(mbti, profile)
+
+    def preload(self, mbtis, profiles=("print",)):
+        for mbti in mbtis:
+            for profile in profiles:
+                try:
+                    self._load(mbti, profile)
+                except Exception as e:
+                    logger.warning("预加载底图失败: %s", e, extra={"mbti": mbti, "profile": profile})
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "templates": [f"{mbti}@{profile}" for mbti, profile in self._items],
+                "bytes": self._size,
+                "budget_bytes": self.budget_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+template_cache = TemplateCache(TEMPLATE_CACHE_MB * 1024 * 1024)
+metrics.gauge("mbti_card_template_cache_bytes", "Decoded template bytes held in memory",
+              fn=lambda: template_cache.stats()["bytes"])
+
+def preload_templates(spec: str = TEMPLATE_PRELOAD):
+    """按 TEMPLATE_PRELOAD 预热底图缓存"""
+    if not spec:
+        return
+    if spec.lower() == "all":
+        mbtis = MBTI_TYPES
+    else:
+        mbtis = [m.strip().upper() for m in spec.split(",") if m.strip().upper() in MBTI_TYPES]
+    template_cache.preload(mbtis, profiles=tuple(dict.fromkeys(("print", RENDER_PROFILE))))
+    if PNG_BAND_CACHE_MB > 0 and STREAM_ENCODE:
+        band_cache.preload(mbtis, profiles=tuple(dict.fromkeys(("print", RENDER_PROFILE))))
+    logger.info("底图预加载完成", extra={"templates": template_cache.stats()["templates"]})
+
+
+# ----------------------- PNG band cache -----------------------
+class BandCache:
+    """底图条带的预压缩结果：每个 (mbti, profile, 压缩级别) 按 strip_rows 行一条压缩一次，按压缩后字节数做LRU淘汰
+
+    名片的大部分条带与底图逐像素相同，编码时直接复用这些片段，只有前景所在的条带需要合成和压缩（见 iter_layer_chunks）。
+    """
+
+    def __init__(self, budget_bytes: int, strip_rows: int):
+        self.budget_bytes = budget_bytes
+        self.strip_rows = max(1, strip_rows)
+        self._items: "OrderedDict[tuple, Tuple[DeflateSegment, ...]]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._load_locks: Dict[tuple, threading.Lock] = {}
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.budget_bytes > 0
+
+    @staticmethod
+    def _nbytes(segments) -> int:
+        return sum(len(segment.data) for segment in segments)
+
+    def _compress(self, base: Image.Image, level: int) -> Tuple[DeflateSegment, ...]:
+        W, H = base.size
+        with timed_stage("band_compress"):
+            return tuple(strip_segment(base.crop((0, y, W, min(H, y + self.strip_rows))), level)
+                         for y in range(0, H, self.strip_rows))
+
+    def get(self, key: tuple, base: Image.Image, level: int) -> Tuple[DeflateSegment, ...]:
+        """底图 base（键 key=(mbti, profile)）各条带的压缩片段；未命中时压缩一次（同一底图并发未命中只压缩一次）"""
+        key = key + (level,)
+        with self._lock:
+            segments = self._items.get(key)
+            if segments is not None:
+                self._items.move_to_end(key)
+                self.hits += 1
+                CACHE_LOOKUPS.inc(cache="png_bands", result="hit")
+                return segments
+            load_lock = self._load_locks.setdefault(key, threading.Lock())
+
+        with load_lock:
+            with self._lock:
+                segments = self._items.get(key)
+                if segments is not None:
+                    self._items.move_to_end(key)
+                    self.hits += 1
+                    CACHE_LOOKUPS.inc(cache="png_bands", result="hit")
+                    return segments
+                self.misses += 1
+                CACHE_LOOKUPS.inc(cache="png_bands", result="miss")
+            segments = self._compress(base, level)
+            self._put(key, segments)
+            return segments
+
+    def after_fork(self):
+        self._lock = threading.Lock()
+        self._load_locks = {}
+
+    def _put(self, key: tuple, segments):
+        nbytes = self._nbytes(segments)
+        if nbytes > self.budget_bytes:
+            return
+        with self._lock:
+            if key in self._items:
+                return
+            while self._items and self._size + nbytes > self.budget_bytes:
+                _, old = self._items.popitem(last=False)
+                self._size -= self._nbytes(old)
+            self._items[key] = segments
+            self._size += nbytes
+
+    def preload(self, mbtis, profiles=("print",)):
+        """按各档位的编码参数预先压缩底图条带（只处理输出PNG的档位）"""
+        for profile in profiles:
+            settings = RENDER_PROFILES[profile]
+            if settings["format"] != "png":
+                continue
+            level = 9 if settings["optimize"] else PNG_COMPRESS_LEVEL
+            for mbti in mbtis:
+                try:
+                    self.get((mbti, profile), template_cache.shared(mbti, profile), level)
+                except Exception as e:
+                    logger.warning("预压缩底图条带失败: %s", e, extra={"mbti": mbti, "profile": profile})
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "templates": [f"{mbti}@{profile}/{level}" for mbti, profile, level in self._items],
+                "bytes": self._size,
+                "budget_bytes": self.budget_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+band_cache = BandCache(PNG_BAND_CACHE_MB * 1024 * 1024 if STREAM_ENCODE else 0, PNG_STRIP_ROWS)
+metrics.gauge("mbti_card_png_band_cache_bytes", "Precompressed template strip bytes held in memory",
+              fn=lambda: band_cache.stats()["bytes"])
+
+def iter_layer_chunks(layers: "CardLayers", level: int):
+    """把图层编码成PNG：与底图相同的条带复用预压缩片段，只合成、压缩与前景相交的条带，不合成整张名片"""
+    segments = band_cache.get(layers.key, layers.base, level)
+    rows = band_cache.strip_rows
+    W, H = layers.size
+    dirty = layers.dirty_bands()
+
+    def card_segments():
+        for i, segment in enumerate(segments):
+            y0, y1 = i * rows, min(H, (i + 1) * rows)
+            if any(b0 < y1 and y0 < b1 for b0, b1 in dirty):
+                strip = layers.base.crop((0, y0, W, y1))
+                layers.paste_into(strip, (0, y0))
+                segment = strip_segment(strip, level)
+            yield segment
+
+    return iter_png_segments(W, H, layers.base.mode, card_segments(), level)
+
+
+# ----------------------- Card layers -----------------------
+class CardLayers:
+    """名片图层：共享的只读底图 + 若干小块前景（文字蒙版、二维码）
+
+    文字只绘制到与其外框等大的 "L" 蒙版上，合成时按蒙版着色粘贴，效果与直接在底图上 draw.text 相同；
+    底图本身不复制也不修改，dirty_bands() 给出与底图不同的行区间。
+    key 标识底图（(mbti, profile)），编码PNG时据此复用底图条带的预压缩结果。
+    """
+
+    def __init__(self, base: Image.Image, key: Optional[tuple] = None):
+        self.base = base
+        self.key = key
+        self.tiles = []  # [(box, 前景图 或 颜色, 蒙版)]
+
+    @property
+    def size(self):
+        return self.base.size
+
+    def _clip(self, box):
+        W, H = self.base.size
+        x0, y0, x1, y1 = box
+        return (max(0, x0), max(0, y0), min(W, x1), min(H, y1))
+
+    def add_text(self, xy, text: str, font, fill: str):
+        """在 xy 处绘制一行文字（与 ImageDraw.text 默认锚点一致）"""
+        if not text:
+            return
+        x, y = xy
+        left, top, right, bottom = font.getbbox(text)
+        box = self._clip((x + left, y + top, x + right, y + bottom))
+        if box[2] <= box[0] or box[3] <= box[1]:
+            return
+        mask = Image.new("L", (box[2] - box[0], box[3] - box[1]), 0)
+        ImageDraw.Draw(mask).text((x - box[0], y - box[1]), text, font=font, fill=255)
+        self.tiles.append((box, ImageColor.getrgb(fill), mask))
+
+    def add_image(self, xy, im: Image.Image):
+        """粘贴图片（带alpha时按alpha合成）：alpha拆成单独的蒙版，图片转为底图的模式，合成时不再转换"""
+        x, y = xy
+        box = self._clip((x, y, x + im.width, y + im.height))
+        if box[2] <= box[0] or box[3] <= box[1]:
+            return
+        if box != (x, y, x + im.width, y + im.height):
+            im = im.crop((box[0] - x, box[1] - y, box[2] - x, box[3] - y))
+        mask = None
+        if im.mode in ("RGBA", "LA"):
+            mask = im.getchannel("A")
+            if mask.getextrema() == (255, 255):
+                mask = None  # 完全不透明，直接覆盖
+        if im.mode != self.base.mode:
+            im = im.convert(self.base.mode)
+        self.tiles.append((box, im, mask))
+
+    def dirty_bands(self):
+        """与底图不同的行区间 [(y0, y1)]，已排序并合并重叠区间"""
+        bands = []
+        for (x0, y0, x1, y1), _, _ in sorted(self.tiles, key=lambda t: t[0][1]):
+            if bands and y0 <= bands[-1][1]:
+                bands[-1] = (bands[-1][0], max(bands[-1][1], y1))
+            else:
+                bands.append((y0, y1))
+        return bands
+
+    def paste_into(self, im: Image.Image, offset=(0, 0)):
+        """把前景合成到 im 上；offset 为 im 左上角在整张名片中的坐标"""
+        ox, oy = offset
+        for (x0, y0, x1, y1), source, mask in self.tiles:
+            box = (x0 - ox, y0 - oy, x1 - ox, y1 - oy)
+            if box[2] <= 0 or box[3] <= 0 or box[0] >= im.width or box[1] >= im.height:
+                continue  # 不在 im 范围内
+            if isinstance(source, Image.Image) and source.mode != im.mode:
+                source = source.convert(im.mode)
+            if isinstance(source, tuple) and im.mode == "RGBA":
+                source = source + (255,)
+            im.paste(source, box, mask)
+
+    def flatten(self) -> Image.Image:
+        """合成完整的RGB名片：复制一份底图（底图已是RGB，不需要整图转换），再粘贴各个前景小块"""
+        out = self.base.convert("RGB") if self.base.mode != "RGB" else self.base.copy()
+        self.paste_into(out)
+        return out
+
+# ----------------------- Layout specs -----------------------
+# 坐标和宽度是底图宽/高的比例；字号按1050像素宽的名片计，渲染时按底图宽度等比换算
+# min_size 为放不下时允许缩小到的最小字号，max_lines 为最多行数（0 不限），default 为字段为空时显示的文字
+DEFAULT_LAYOUT = {
+    "fields": {
+        "nickname": {"x": 0.23, "y": 0.25, "width": 0.46, "size": 90, "max_lines": 1, "color": "#3B536A", "default": "未命名"},
+        "gender": {"x": 0.23, "y": 0.33, "width": 0.46, "size": 90, "max_lines": 1, "color": "#3B536A"},
+        "profession": {"x": 0.23, "y": 0.41, "width": 0.46, "size": 90, "max_lines": 1, "color": "#3B536A"},
+        # 下方是横幅，最多两行
+        "interests": {"x": 0.08, "y": 0.56, "width": 0.84, "size": 80, "max_lines": 2, "color": "#3B536A"},
+        # 右下角有标志，宽度收窄
+        "introduction": {"x": 0.08, "y": 0.87, "width": 0.78, "size": 80, "max_lines": 2, "color": "#34495E"},
+    },
+    "qr": {"x": 0.71, "y": 0.28, "size": 0.22},
+}
+LAYOUT_TEXT_FIELDS = ("nickname", "gender", "profession", "interests", "introduction")
+LAYOUT_BASE_WIDTH = 1050
+LAYOUT_LINE_SPACING = 90 / 80   # 多行文本行距（与原先 90/80 的比例一致）
+LAYOUT_MIN_SCALE = 0.7          # 未指定 min_size 时允许缩小到的比例
+
+class LayoutSpecError(ValueError):
+    pass
+
+class TextBox(NamedTuple):
+    field: str
+    x: int
+    y: int
+    width: int
+    size: int
+    min_size: int
+    max_lines: int
+    line_spacing: float
+    color: str
+    default: str
+
+class CompiledLayout(NamedTuple):
+    texts: Tuple[TextBox, ...]
+    qr: Optional[Tuple[int, int, int]]  # (x, y, 边长)
+
+def _merge_layout(base: Dict[str, Any], override: Dict[str, Any]) -> Dict[str, Any]:
+    """按字段合并覆盖规格；字段值为 null 表示该底图不显示此字段"""
+    merged = {"fields": dict(base.get("fields", {})), "qr": base.get("qr")}
+    for name, field in (override.get("fields") or {}).items():
+        if field is None:
+            merged["fields"].pop(name, None)
+        elif isinstance(field, dict):
+            merged["fields"][name] = {**merged["fields"].get(name, {}), **field}
+        else:
+            merged["fields"][name] = field  # 留给校验报告
+    if "qr" in override:
+        qr = override["qr"]
+        merged["qr"] = {**(merged["qr"] or {}), **qr} if isinstance(qr, dict) else qr
+    for key in set(override) - {"fields", "qr"}:
+        merged[key] = override[key]
+    return merged
+
+def _check_fraction(where: str, spec: Dict[str, Any], key: str, errors: list):
+    value = spec.get(key)
+    if value is None:
+        errors.append(f"{where}: 缺少 {key}")
+    elif not isinstance(value, (int, float)) or isinstance(value, bool) or not 0 <= value <= 1:
+        errors.append(f"{where}.{key}: 应为0到1之间的比例，实际为 {value!r}")
+
+def validate_layout(spec: Dict[str, Any], where: str) -> list:
+    """返回规格中的错误列表（空列表表示有效）"""
+    errors = []
+    unknown = set(spec) - {"fields", "qr"}
+    if unknown:
+        errors.append(f"{where}: 未知配置项 {sorted(unknown)}")
+    for name, field in (spec.get("fields") or {}).items():
+        at = f"{where}.fields.{name}"
+        if name not in LAYOUT_TEXT_FIELDS:
+            errors.append(f"{at}: 未知字段，可选 {', '.join(LAYOUT_TEXT_FIELDS)}")
+            continue
+        if not isinstance(field, dict):
+            errors.append(f"{at}: 应为对象")
+            continue
+        unknown = set(field) - {"x", "y", "width", "size", "min_size", "max_lines", "line_spacing", "color", "default"}
+        if unknown:
+            errors.append(f"{at}: 未知配置项 {sorted(unknown)}")
+        for key in ("x", "y", "width"):
+            _check_fraction(at, field, key, errors)
+        size = field.get("size")
+        if not isinstance(size, (int, float)) or size <= 0:
+            errors.append(f"{at}.size: 应为正数，实际为 {size!r}")
+        min_size = field.get("min_size")
+        if min_size is not None and (not isinstance(min_size, (int, float)) or min_size <= 0):
+            errors.append(f"{at}.min_size: 应为正数，实际为 {min_size!r}")
+        max_lines = field.get("max_lines", 0)
+        if not isinstance(max_lines, int) or isinstance(max_lines, bool) or max_lines < 0:
+            errors.append(f"{at}.max_lines: 应为非负整数，实际为 {max_lines!r}")
+        line_spacing = field.get("line_spacing", LAYOUT_LINE_SPACING)
+        if not isinstance(line_spacing, (int, float)) or line_spacing <= 0:
+            errors.append(f"{at}.line_spacing: 应为正数，实际为 {line_spacing!r}")
+        try:
+            ImageColor.getrgb(field.get("color", ""))
+        except (ValueError, AttributeError):
+            errors.append(f"{at}.color: 无法识别的颜色 {field.get('color')!r}")
+        if not isinstance(field.get("default", ""), str):
+            errors.append(f"{at}.default: 应为字符串")
+    qr = spec.get("qr")
+    if qr is not None:
+        if not isinstance(qr, dict):
+            errors.append(f"{where}.qr: 应为对象或null")
+        else:
+            for key in ("x", "y", "size"):
+                _check_fraction(f"{where}.qr", qr, key, errors)
+    return errors
+
+def compile_layout(spec: Dict[str, Any], width: int, height: int) -> CompiledLayout:
+    """把比例规格换算为某个底图尺寸下的像素坐标和字号"""
+    scale = width / LAYOUT_BASE_WIDTH
+    texts = []
+    for name, field in spec["fields"].items():
+        size = max(1, int(field["size"] * scale))
+        min_size = field.get("min_size")
+        min_size = max(1, int(min_size * scale)) if min_size else int(size * LAYOUT_MIN_SCALE)
+        texts.append(TextBox(
+            field=name,
+            x=int(width * field["x"]),
+            y=int(height * field["y"]),
+            width=int(width * field["width"]),
+            size=size,
+            min_size=min(size, min_size),
+            max_lines=field.get("max_lines", 0),
+            line_spacing=float(field.get("line_spacing", LAYOUT_LINE_SPACING)),
+            color=field["color"],
+            default=field.get("default", ""),
+        ))
+    qr = spec.get("qr")
+    qr_box = (int(width * qr["x"]), int(height * qr["y"]), int(width * qr["size"])) if qr else None
+    return CompiledLayout(tuple(texts), qr_box)
+
+class LayoutRegistry:
+    """各MBTI底图的排版规格：启动时加载并校验，按底图尺寸编译为像素坐标后缓存；规格文件变化时自动重新加载"""
+
+    def __init__(self, directory: str, reload_interval: float):
+        self.directory = directory
+        self.reload_interval = reload_interval
+        self._lock = threading.Lock()
+        self._specs: Optional[Dict[str, Dict[str, Any]]] = None
+        self._compiled: Dict[tuple, CompiledLayout] = {}
+        self._stamp = None
+        self._checked = 0.0
+        self._version = ""
+
+    def after_fork(self):
+        self._lock = threading.Lock()
+
+    def _files(self) -> Dict[str, str]:
+        return {name: os.path.join(self.directory, f"{name}.json") for name in ["default", *MBTI_TYPES]}
+
+    def _scan(self) -> tuple:
+        stamp = []
+        for name, path in self._files().items():
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            stamp.append((name, st.st_mtime_ns, st.st_size))
+        return tuple(stamp)
+
+    def _read(self):
+        """读取并校验全部规格文件；所有错误合并为一个 LayoutSpecError"""
+        overrides = {}
+        errors = []
+        h = hashlib.sha1()
+        for name, path in self._files().items():
+            if not os.path.exists(path):
+                continue
+            try:
+                with open(path, "rb") as f:
+                    raw = f.read()
+                override = json.loads(raw.decode("utf-8"))
+            except (OSError, ValueError) as e:
+                errors.append(f"{path}: {e}")
+                continue
+            if not isinstance(override, dict):
+                errors.append(f"{path}: 顶层应为对象")
+                continue
+            overrides[name] = override
+            h.update(name.encode() + b"\0" + raw + b"\0")
+        if errors:
+            raise LayoutSpecError("\n".join(errors))
+
+        base = _merge_layout(DEFAULT_LAYOUT, overrides.get("default", {}))
+        errors = validate_layout(base, "default.json")
+        if errors:
+            raise LayoutSpecError("\n".join(errors))
+        specs = {}
+        for mbti in MBTI_TYPES:
+            if mbti in overrides:
+                specs[mbti] = _merge_layout(base, overrides[mbti])
+                errors.extend(validate_layout(specs[mbti], f"{mbti}.json"))
+            else:
+                specs[mbti] = base
+        if errors:
+            raise LayoutSpecError("\n".join(errors))
+        return specs, h.hexdigest()[:12] if overrides else "builtin"
+
+    def load(self):
+        """（重新）加载规格；规格无效时抛出 LayoutSpecError，已加载的规格保持不变"""
+        with self._lock:
+            stamp = self._scan()
+            specs, version = self._read()
+            self._specs, self._version, self._stamp = specs, version, stamp
+            self._compiled = {}
+            self._checked = time.time()
+
+    def _ensure_current(self):
+        if self._specs is None:
+            self.load()
+            return
+        if self.reload_interval <= 0 or time.time() - self._checked < self.reload_interval:
+            return
+        self._checked = time.time()
+        stamp = self._scan()
+        if stamp == self._stamp:
+            return
+        try:
+            self.load()
+            logger.info("排版规格已重新加载", extra={"layout_version": self._version})
+        except LayoutSpecError as e:
+            self._stamp = stamp  # 同一份有问题的文件只报告一次
+            logger.warning("排版规格无效，继续使用之前的版本:\n%s", e)
+
+    def get(self, mbti: str, size: Tuple[int, int]) -> CompiledLayout:
+        """某个底图在某个尺寸下编译好的排版"""
+        self._ensure_current()
+        key = (mbti, size)
+        compiled = self._compiled.get(key)
+        if compiled is None:
+            compiled = compile_layout(self._specs[mbti], *size)
+            self._compiled[key] = compiled
+        return compiled
+
+    def version(self) -> str:
+        """规格指纹（计入结果缓存键，规格变化后旧结果自动失效）"""
+        self._ensure_current()
+        return self._version
+
+layout_registry = LayoutRegistry(LAYOUT_DIR, LAYOUT_RELOAD_INTERVAL)
+
+# ----------------------- Card generator -----------------------
+def resolve_render_profile(name: Any) -> str:
+    """校验渲染档位名称，未指定时使用部署默认值；不是字符串（如JSON中的数字、列表）时按无效档位处理"""
+    if name is None or name == "":
+        return RENDER_PROFILE
+    if not isinstance(name, str):
+        raise ValueError(f"渲染档位必须是字符串: {name!r}，可选: {', '.join(RENDER_PROFILES)}")
+    name = name.strip().lower()
+    if name not in RENDER_PROFILES:
+        raise ValueError(f"未知渲染档位: {name}，可选: {', '.join(RENDER_PROFILES)}")
+    return name
+
+def normalize_mbti(value: Optional[str]) -> str:
+    mbti = (value or "INFP").upper().strip()
+    return mbti if mbti in MBTI_TYPES else "INFP"  # 默认类型
+
+def render_card_layers(user: Dict[str, Any], profile: str) -> CardLayers:
+    """根据用户信息和MBTI排版名片，返回图层（共享底图 + 各字段的小块前景）
+
+    profile 选择渲染档位（print/message/preview），坐标和字号来自排版规格，按底图尺寸换算。
+    """
+    # 获取MBTI类型并选择对应底图
+    mbti = normalize_mbti(user.get("mbti"))
+    
+    # 加载MBTI底图（缓存中已解码，各渲染共享，不复制）
+    with timed_stage("template"):
+        layers = CardLayers(template_cache.shared(mbti, profile), key=(mbti, profile))
+    W, H = layers.size
+    
+    # 排版规格已按底图尺寸编译为像素坐标和字号
+    layout = layout_registry.get(mbti, (W, H))
+    
+    # 文字字段 - 按字形实际宽度排版，放不下时缩小字号，仍放不下则以省略号截断
+    with timed_stage("text"):
+        for box in layout.texts:
+            text = user.get(box.field) or box.default
+            if not text:
+                continue
+            block = fit_text(text, font_registry.get, box.size, box.width, box.max_lines,
+                             box.min_size, box.line_spacing)
+            for i, line in enumerate(block.lines):
+                layers.add_text((box.x, box.y + i * block.line_height), line, font=block.font, fill=box.color)
+    
+    # 微信二维码（1:1比例，覆盖蓝色区域）
+    if layout.qr and user.get("qr_text") and qrcode is not None:
+        # 提交中带微信链接：本地生成，直接画成目标尺寸
+        qr_x, qr_y, qr_size = layout.qr
+        try:
+            layers.add_image((qr_x, qr_y), render_qr_code(user["qr_text"], qr_size))
+        except (ValueError, qrcode.exceptions.DataOverflowError) as e:
+            # 链接超出二维码容量：名片照常生成，只是不带二维码
+            logger.warning("微信链接无法生成二维码: %s", e, extra={"chars": len(user["qr_text"])})
+    else:
+        # PIL图片，或仍在后台下载的 Future：排到这里才等待，下载与上面的底图加载、文字排版并行
+        wechat_qr = QRPrefetcher.resolve(user.get("wechat_qr_image"))
+        if wechat_qr and layout.qr:
+            qr_x, qr_y, qr_size = layout.qr
+            # 附件原图直接缩放到目标尺寸，只重采样一次
+            if wechat_qr.size != (qr_size, qr_size):
+                with timed_stage("qr_resize"):
+                    wechat_qr = wechat_qr.resize((qr_size, qr_size), Image.LANCZOS)
+            layers.add_image((qr_x, qr_y), wechat_qr)
+    
+    return layers
+
+def render_card_image(user: Dict[str, Any], profile: str) -> Image.Image:
+    """绘制名片，返回未编码的RGB图像（底图只转换一次，后续编码都基于这份图像）"""
+    layers = render_card_layers(user, profile)
+    with timed_stage("compose"):
+        return layers.flatten()
+
+def uses_band_cache(profile: str) -> bool:
+    """该档位编码时能否复用底图条带的预压缩结果"""
+    return STREAM_ENCODE and band_cache.enabled and RENDER_PROFILES[profile]["format"] == "png"
+
+def render_card(user: Dict[str, Any], profile: str):
+    """绘制名片，返回交给编码的对象：能复用底图条带时返回图层（编码时只合成有前景的条带），否则返回合成好的RGB图像"""
+    if uses_band_cache(profile):
+        return render_card_layers(user, profile)
+    return render_card_image(user, profile)
+
+def card_output_path(nickname: str, profile: str, seq: Optional[int] = None) -> str:
+    """名片保存路径；seq 用于批量生成时按顺序排列，随机后缀保证同一秒内同名（或昵称为空）的名片不会互相覆盖"""
+    ts = datetime.now().strftime("%Y%m%d-%H%M%S")
+    prefix = f"{ts}_{seq:04d}" if seq is not None else ts
+    suffix = "" if profile == "print" else f"_{profile}"
+    ext = IMAGE_FORMATS[RENDER_PROFILES[profile]["format"]][0]
+    base_filename = f"{prefix}_{safe_filename(nickname)}{suffix}_{uuid.uuid4().hex[:8]}.{ext}"
+    return os.path.join(OUTPUT_DIR, base_filename)
+
+def save_card(image_bytes: bytes, nickname: str, profile: str, seq: Optional[int] = None) -> str:
+    """把编码好的名片交给后台线程写盘，返回保存路径"""
+    out_path = card_output_path(nickname, profile, seq)
+    card_writer.write(out_path, image_bytes)
+    return out_path
+
+def store_card(card, nickname: str, profile: str, seq: Optional[int] = None) -> (Optional[bytes], str):
+    """编码并保存名片（RGB图像或图层，见 render_card），返回 (图片字节, 保存路径)
+
+    STREAM_ENCODE 时边编码边写盘，完整的编码结果不经过内存，图片字节为None（使用保存路径）；
+    否则只编码一次，同一份字节既返回给调用方，也交给后台线程写盘。
+    """
+    if STREAM_ENCODE:
+        out_path = card_output_path(nickname, profile, seq)
+        write_card_file(card, RENDER_PROFILES[profile], out_path)
+        return None, out_path
+    image_bytes = encode_card(card, RENDER_PROFILES[profile])
+    return image_bytes, save_card(image_bytes, nickname, profile, seq)
+
+def generate_card(user: Dict[str, Any], profile: Optional[str] = None) -> (Optional[bytes], str):
+    """根据用户信息和MBTI生成个性化名片，返回 (图片字节, 保存路径)；STREAM_ENCODE 时图片字节为None"""
+    profile = resolve_render_profile(profile)
+    card = render_card(user, profile)
+    return store_card(card, user.get("nickname", "未命名"), profile)
+
+# ----------------------- Payload parser -----------------------
+def extract_user_info(payload: Dict[str, Any]) -> Dict[str, Any]:
+    """简化的用户信息提取，直接处理6字段JSON格式"""
+    # 直接从JSON中提取所需字段
+    user_info = {
+        "nickname": payload.get("nickname", "").strip(),
+        "gender": payload.get("gender", "").strip(), 
+        "profession": payload.get("profession", "").strip(),
+        "interests": payload.get("interests", "").strip(),
+        "mbti": payload.get("mbti", "").strip(),
+        "introduction": payload.get("introduction", "").strip(),
+        "wechatQrAttachmentId": payload.get("wechatQrAttachmentId", "").strip(),
+        # 微信名片链接（或任意二维码内容）：有则本地生成二维码，不再下载附件
+        "qr_text": (payload.get("wechat_url") or payload.get("qr_text") or "").strip(),
+        # 私信接收人：open_id，或用于查询 open_id 的邮箱/手机号
+        "open_id": (payload.get("open_id") or "").strip(),
+        "email": (payload.get("email") or "").strip(),
+        "mobile": str(payload.get("mobile") or "").strip(),
+    }
+    return user_info
+
+def get_feishu_setup_suggestions(send_result):
+    """根据飞书API响应生成智能配置建议"""
+    if not send_result or "warn" not in send_result:
+        return "飞书集成正常工作"
+    
+    error_message = send_result.get("warn", "")
+    
+    # 分析不同的错误代码并提供对应建议
+    if "99991672" in error_message:
+        return "需要权限: 访问 https://open.feishu.cn/app/ → 权限管理 → 添加 im:resource:upload 权限"
+    elif "234001" in error_message:
+        return "参数错误: 系统已自动修复，请重试"
+    elif "234007" in error_message:
+        return "机器人未启用: 访问 https://open.feishu.cn/app/ → 应用功能 → 机器人 → 启用机器人"
+    elif "feishu_disabled" in error_message:
+        return "飞书未配置: 请设置环境变量 FEISHU_APP_ID 和 FEISHU_APP_SECRET"
+    else:
+        return f"飞书配置需要完善: {error_message[:100]}..."
+
+# ----------------------- Result cache -----------------------
+def template_version() -> str:
+    """底图版本：TEMPLATE_VERSION 环境变量，或由底图文件大小/修改时间计算的指纹"""
+    version = os.getenv("TEMPLATE_VERSION", "").strip()
+    if version:
+        return f"{RENDER_VERSION}:{version}"
+    h = hashlib.sha1()
+    for mbti in MBTI_TYPES:
+        path = os.path.join(ASSETS_DIR, f"{mbti}.png")
+        if os.path.exists(path):
+            st = os.stat(path)
+            h.update(f"{mbti}:{st.st_size}:{int(st.st_mtime)};".encode())
+    return f"{RENDER_VERSION}:{h.hexdigest()[:12]}"
+
+def result_cache_key(user: Dict[str, Any], profile: str) -> str:
+    """规范化的提交内容 + 二维码附件ID + 私信接收人 + 底图版本 + 渲染档位 的稳定哈希
+
+    接收人计入键：不同的人提交相同内容时各自都能收到私信。
+    """
+    normalized = {
+        field: (user.get(field) or "").strip()
+        for field in ("nickname", "gender", "profession", "interests", "introduction", "wechatQrAttachmentId", "qr_text",
+                      "open_id", "email", "mobile")
+    }
+    normalized["mbti"] = normalize_mbti(user.get("mbti"))
+    normalized["profile"] = profile
+    normalized["template_version"] = TEMPLATE_VERSION
+    normalized["layout_version"] = layout_registry.version()
+    raw = json.dumps(normalized, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+class ResultCache:
+    """已渲染名片的索引（SQLite，重启后仍有效），按TTL过期，条目数超过上限时淘汰最久未用的"""
+
+    def __init__(self, path: str, ttl: int, max_entries: int):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def after_fork(self):
+        # SQLite连接不能跨fork使用，子进程重新打开
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                " key TEXT PRIMARY KEY, saved_path TEXT NOT NULL, image_key TEXT,"
+                " profile TEXT, created_at REAL NOT NULL, last_used REAL NOT NULL, delivered INTEGER NOT NULL DEFAULT 1)"
+            )
+            # 旧版本创建的表没有 delivered 列，已有条目视为已发送
+            if "delivered" not in {row[1] for row in conn.execute("PRAGMA table_info(results)")}:
+                conn.execute("ALTER TABLE results ADD COLUMN delivered INTEGER NOT NULL DEFAULT 1")
+            conn.execute("CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)")
+            # 正在渲染/发送的键（见 SingleFlight），所有worker进程共用
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS claims (key TEXT PRIMARY KEY, token TEXT NOT NULL, claimed_at REAL NOT NULL)"
+            )
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            row = db.execute(
+                "SELECT saved_path, image_key, profile, created_at, delivered FROM results WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            saved_path, image_key, profile, created_at, delivered = row
+            # 过期或本地文件已被清理的结果视为未命中
+            if created_at < now - self.ttl or not (os.path.exists(saved_path) or card_writer.pending(saved_path)):
+                db.execute("DELETE FROM results WHERE key = ?", (key,))
+                db.commit()
+                return None
+            db.execute("UPDATE results SET last_used = ? WHERE key = ?", (now, key))
+            db.commit()
+        return {"saved_path": saved_path, "image_key": image_key, "profile": profile, "created_at": created_at,
+                "delivered": bool(delivered)}
+
+    def put(self, key: str, saved_path: str, image_key: Optional[str], profile: str, delivered: bool = True):
+        """delivered=False：名片已生成（可能已上传）但私信未发出，再次提交时重试私信"""
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            db.execute(
+                "INSERT OR REPLACE INTO results (key, saved_path, image_key, profile, created_at, last_used, delivered)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, os.path.abspath(saved_path), image_key, profile, now, now, int(delivered)),
+            )
+            db.execute("DELETE FROM results WHERE created_at < ?", (now - self.ttl,))
+            db.execute(
+                "DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            db.commit()
+
+    def claim(self, key: str, token: str, ttl: float) -> bool:
+        """占用 key 的执行权；已被占用且占用时间不超过 ttl 秒时返回False"""
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            db.execute("DELETE FROM claims WHERE key = ? AND claimed_at < ?", (key, now - ttl))
+            inserted = db.execute(
+                "INSERT OR IGNORE INTO claims (key, token, claimed_at) VALUES (?, ?, ?)", (key, token, now)
+            ).rowcount
+            db.commit()
+        return inserted == 1
+
+    def unclaim(self, key: str, token: str):
+        with self._lock:
+            db = self._db()
+            db.execute("DELETE FROM claims WHERE key = ? AND token = ?", (key, token))
+            db.commit()
+
+    def image_path(self, image_key: str) -> Optional[str]:
+        """image_key 对应的本地名片（供 /feishu-image 代理使用）"""
+        with self._lock:
+            row = self._db().execute(
+                "SELECT saved_path FROM results WHERE image_key = ? ORDER BY last_used DESC LIMIT 1", (image_key,)
+            ).fetchone()
+        return row[0] if row else None
+
+class SingleFlight:
+    """同一缓存键同时只允许一个请求渲染和发送，相同内容的并发请求等它完成后按缓存命中处理
+
+    执行权以 INSERT OR IGNORE 记录在结果缓存的SQLite中，同一台机器上的所有gunicorn worker共用；
+    等待超过 timeout 秒时不再等待、直接处理，持有者崩溃留下的记录也在 timeout 秒后失效。
+    """
+
+    def __init__(self, cache: Optional[ResultCache], timeout: float, poll_interval: float = 0.05):
+        self.cache = cache
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+
+    def acquire(self, key: str) -> Tuple[Optional[str], bool]:
+        """取得 key 的执行权，返回 (执行权标识, 是否等待过)；等待过说明结果缓存可能已更新，应重新查询
+
+        等待超时时标识为None（没有取得执行权，release 时什么也不做）。
+        """
+        token = uuid.uuid4().hex
+        deadline = time.time() + self.timeout
+        waited = False
+        while not self.cache.claim(key, token, self.timeout):
+            if time.time() >= deadline:
+                logger.warning("等待相同内容的名片处理超时，直接处理", extra={"cache_key": key[:12]})
+                return None, True
+            waited = True
+            time.sleep(self.poll_interval)
+        return token, waited
+
+    def release(self, key: str, token: Optional[str]):
+        """可由其他线程释放"""
+        if token is not None:
+            self.cache.unclaim(key, token)
+
+    @contextmanager
+    def hold(self, key: Optional[str]):
+        if not key:
+            yield False
+            return
+        token, waited = self.acquire(key)
+        try:
+            yield waited
+        finally:
+            self.release(key, token)
+
+TEMPLATE_VERSION = template_version()
+result_cache = ResultCache(RESULT_CACHE_PATH, RESULT_CACHE_TTL, RESULT_CACHE_MAX) if RESULT_CACHE_ENABLED else None
+result_flight = SingleFlight(result_cache, RESULT_CLAIM_TIMEOUT)
+
+# ----------------------- Contact resolver -----------------------
+class ContactResolver:
+    """邮箱/手机号 -> open_id：结果存在本地SQLite（重启后仍有效，按TTL过期），已知联系人不再调用通讯录接口
+
+    未缓存的查询先等待 window 秒，期间到达的其他查询合并进同一次 batch_get_id（每批最多50个邮箱、50个手机号），
+    同一联系人的并发查询共用一次结果；通讯录中查不到的联系人也记录下来，miss_ttl 秒内不再重复查询。
+    """
+
+    def __init__(self, path: str, ttl: int, miss_ttl: int, window: float, fetch):
+        self.path = path
+        self.ttl = ttl
+        self.miss_ttl = miss_ttl
+        self.window = window
+        self._fetch = fetch  # (emails, mobiles) -> {(kind, value): open_id 或 None}
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._batch_lock = threading.Lock()
+        self._pending: Dict[Tuple[str, str], Future] = {}
+        self._batch: Optional[list] = None
+        self._batch_full: Optional[threading.Event] = None
+
+    @staticmethod
+    def normalize(kind: str, value: Optional[str]) -> str:
+        value = (value or "").strip()
+        if kind == "email":
+            return value.lower()
+        return re.sub(r"[\s\-()]", "", value)
+
+    @classmethod
+    def contact_keys(cls, email: Optional[str] = None, mobile: Optional[str] = None) -> list:
+        """[(kind, 规范化的值)]，邮箱在前"""
+        keys = [("email", cls.normalize("email", email)), ("mobile", cls.normalize("mobile", mobile))]
+        return [key for key in keys if key[1]]
+
+    def after_fork(self):
+        # 子进程重新打开连接，也不继承父进程中等待合并的查询
+        self._conn = None
+        self._lock = threading.Lock()
+        self._batch_lock = threading.Lock()
+        self._pending = {}
+        self._batch = None
+        self._batch_full = None
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS contacts ("
+                " kind TEXT NOT NULL, value TEXT NOT NULL, open_id TEXT, updated_at REAL NOT NULL,"
+                " PRIMARY KEY (kind, value))"
+            )
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def cached(self, keys) -> Dict[Tuple[str, str], Optional[str]]:
+        """只查本地缓存：返回未过期的条目（值为None表示查过、通讯录中没有）"""
+        now = time.time()
+        found = {}
+        with self._lock:
+            db = self._db()
+            for key in keys:
+                row = db.execute("SELECT open_id, updated_at FROM contacts WHERE kind = ? AND value = ?", key).fetchone()
+                if row is None:
+                    continue
+                open_id, updated_at = row
+                if updated_at >= now - (self.ttl if open_id else self.miss_ttl):
+                    found[key] = open_id
+        return found
+
+    def store(self, entries: Dict[Tuple[str, str], Optional[str]]):
+        if not entries:
+            return
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            db.executemany(
+                "INSERT OR REPLACE INTO contacts (kind, value, open_id, updated_at) VALUES (?, ?, ?, ?)",
+                [(kind, value, open_id, now) for (kind, value), open_id in entries.items()],
+            )
+            db.execute("DELETE FROM contacts WHERE updated_at < ?", (now - max(self.ttl, self.miss_ttl),))
+            db.commit()
+
+    def resolve(self, email: Optional[str] = None, mobile: Optional[str] = None, timeout: float = 30) -> Optional[str]:
+        """按邮箱、手机号的顺序返回第一个查到的 open_id；都查不到返回None，通讯录接口出错时抛出异常"""
+        keys = self.contact_keys(email, mobile)
+        if not keys:
+            return None
+        known = self.cached(keys)
+        missing = [key for key in keys if key not in known]
+        if not missing or any(known.get(key) for key in keys):
+            CACHE_LOOKUPS.inc(cache="contact", result="hit")
+            return next((known[key] for key in keys if known.get(key)), None)
+        CACHE_LOOKUPS.inc(cache="contact", result="miss")
+        futures = self._enqueue(missing)
+        for key in keys:
+            open_id = known[key] if key in known else futures[key].result(timeout)
+            if open_id:
+                return open_id
+        return None
+
+    def _batch_is_full(self) -> bool:
+        emails = sum(1 for kind, _ in self._batch if kind == "email")
+        return emails >= CONTACT_BATCH_MAX or len(self._batch) - emails >= CONTACT_BATCH_MAX
+
+    def _enqueue(self, keys) -> Dict[Tuple[str, str], Future]:
+        """把查询放进当前批次；开启新批次的调用方负责在窗口结束时发出这一批"""
+        futures, opened = {}, []
+        with self._batch_lock:
+            for key in keys:
+                future = self._pending.get(key)
+                if future is None:
+                    if self._batch is None:
+                        self._batch, self._batch_full = [], threading.Event()
+                        opened.append((self._batch, self._batch_full))
+                    future = self._pending[key] = Future()
+                    self._batch.append(key)
+                    if self._batch_is_full():
+                        self._batch_full.set()
+                        self._batch = None
+                futures[key] = future
+        for batch, full in opened:
+            self._run_batch(batch, full)
+        return futures
+
+    def _run_batch(self, batch: list, full: threading.Event):
+        full.wait(self.window)
+        with self._batch_lock:
+            if self._batch is batch:
+                self._batch = None  # 之后到达的查询进入下一批
+        emails = [value for kind, value in batch if kind == "email"]
+        mobiles = [value for kind, value in batch if kind == "mobile"]
+        try:
+            found = self._fetch(emails, mobiles)
+            CONTACT_BATCHES.inc(result="ok")
+        except Exception as e:
+            CONTACT_BATCHES.inc(result="error")
+            logger.warning("批量查询open_id失败: %s", e, extra={"contacts": len(batch)})
+            self._settle(batch, error=e)
+            return
+        logger.debug("批量查询open_id", extra={"contacts": len(batch)})
+        try:
+            self.store(found)
+        except Exception as e:
+            logger.warning("写入联系人缓存失败: %s", e)
+        self._settle(batch, found=found)
+
+    def _settle(self, batch: list, found: Optional[Dict[Tuple[str, str], Optional[str]]] = None,
+                error: Optional[Exception] = None):
+        with self._batch_lock:
+            futures = [(key, self._pending.pop(key)) for key in batch]
+        for key, future in futures:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(found.get(key))
+
+    def preload(self, records) -> Dict[str, int]:
+        """活动前预先解析整份名单：记录中已带 open_id 的直接写入缓存，其余未缓存的联系人按每批50个查询"""
+        provided, wanted = {}, []
+        for record in records:
+            keys = self.contact_keys(record.get("email"), record.get("mobile"))
+            open_id = (record.get("open_id") or "").strip()
+            if open_id:
+                provided.update((key, open_id) for key in keys)
+            else:
+                wanted.extend(keys)
+        self.store(provided)
+        wanted = [key for key in dict.fromkeys(wanted) if key not in provided]
+        known = self.cached(wanted)
+        emails = [value for kind, value in wanted if kind == "email" and (kind, value) not in known]
+        mobiles = [value for kind, value in wanted if kind == "mobile" and (kind, value) not in known]
+        found = {}
+        for i in range(0, max(len(emails), len(mobiles)), CONTACT_BATCH_MAX):
+            part = self._fetch(emails[i:i + CONTACT_BATCH_MAX], mobiles[i:i + CONTACT_BATCH_MAX])
+            CONTACT_BATCHES.inc(result="ok")
+            self.store(part)
+            found.update(part)
+        return {
+            "records": len(records),
+            "provided": len(provided),
+            "cached": len(known),
+            "resolved": sum(1 for open_id in found.values() if open_id),
+            "not_found": sum(1 for open_id in found.values() if not open_id),
+        }
+
+def fetch_open_ids(emails, mobiles) -> Dict[Tuple[str, str], Optional[str]]:
+    return call_with_token(batch_get_open_ids, emails, mobiles)
+
+contact_resolver = ContactResolver(CONTACT_CACHE_PATH, CONTACT_CACHE_TTL, CONTACT_MISS_TTL, CONTACT_BATCH_WINDOW,
+                                   fetch_open_ids)
+
+# ----------------------- Card pipeline -----------------------
+class RenderError(RuntimeError):
+    """名片渲染失败"""
+
+def public_base_url() -> str:
+    """当前请求对外可访问的根URL（ngrok隧道强制https）"""
+    if 'ngrok' in request.host:
+        return f"https://{request.host}"
+    return request.url_root.rstrip('/')
+
+def lookup_result(user: Dict[str, Any], profile: str) -> (Optional[str], Optional[Dict[str, Any]]):
+    """幂等：相同内容（含二维码附件、底图版本、档位）已生成过时返回缓存的结果，返回 (缓存键, 缓存结果)"""
+    cache_key = result_cache_key(user, profile) if result_cache is not None else None
+    cached = result_cache.get(cache_key) if cache_key else None
+    if cache_key:
+        CACHE_LOOKUPS.inc(cache="result", result="hit" if cached else "miss")
+    return cache_key, cached
+
+def process_card(user: Dict[str, Any], profile: str, base_url: str, lookup: Optional[tuple] = None) -> Dict[str, Any]:
+    """二维码获取 → 渲染 → 上传飞书 → 私信，同步 /hook 与异步任务共用
+
+    返回 {"response": 响应JSON, "card_bytes": 图片字节或None, "saved_path": ..., "mimetype": ...}；
+    card_bytes 为None时名片只在磁盘上（流式编码，或命中缓存且已写完），按 saved_path 读取。
+    lookup 为调用方已查过的 lookup_result() 结果。渲染失败抛出 RenderError。
+    """
+    # 0) 幂等：已生成过时直接复用，不再渲染和上传
+    cache_key, cached = lookup or lookup_result(user, profile)
+    # 相同内容的并发请求只有一个渲染、上传和私信，其余等它完成后复用结果
+    with result_flight.hold(None if cached and cached["delivered"] else cache_key) as waited:
+        if waited:
+            cache_key, cached = lookup_result(user, profile)
+        if cached:
+            saved_path = cached["saved_path"]
+            card_bytes = card_writer.pending(saved_path)
+            logger.info("命中渲染结果缓存", extra={"cache_key": cache_key[:12]})
+        else:
+            # 1) 微信二维码：/hook 解析后已在后台开始下载，其他入口在这里开始
+            qr_prefetcher.start(user)
+
+            # 2) Generate card（启用渲染进程池时在子进程中渲染）
+            try:
+                card_bytes, saved_path = render_engine.generate(user, profile)
+            except RenderError:
+                raise
+            except Exception as e:
+                raise RenderError(str(e)) from e
+
+        return deliver_card(user, profile, base_url, saved_path, card_bytes, cache_key, cached)
+
+def deliver_card(user: Dict[str, Any], profile: str, base_url: str, saved_path: str,
+                 card_bytes: Optional[bytes], cache_key: Optional[str], cached: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """名片已保存后：上传飞书、私信、记录结果缓存，返回与 process_card 相同的结构
+
+    缓存条目在私信发出（或没有接收人）后才标记为已发送；命中未发送的条目时复用已上传的图片重试私信。
+    """
+    image_key = cached["image_key"] if cached else None
+    delivered = False
+    card_mimetype = guess_image_mimetype(saved_path)
+
+    # 3) 生成本地备用URL
+    image_filename = os.path.basename(saved_path)
+    # URL编码文件名以支持中文
+    encoded_filename = quote(image_filename)
+    # 生成本地访问URL作为备用
+    local_image_url = f"{base_url}/image/{encoded_filename}"
+
+    # 4) 尝试上传到飞书并生成飞书代理URL（推荐）
+    image_url = local_image_url  # 默认使用本地URL
+    send_result = None
+    feishu_enabled = bool(APP_ID and APP_SECRET)
+    
+    if feishu_enabled and image_key and cached["delivered"]:
+        # 重复提交：名片已上传并发送过
+        image_url = f"{base_url}/feishu-image/{image_key}"
+        send_result = {"info": "cached_result: 相同名片已上传过，未重复上传和发送"}
+        delivered = True
+    elif feishu_enabled:
+        try:
+            if not image_key:
+                # 流式编码的名片直接从文件分块上传
+                image_key = call_with_token(upload_image_to_feishu,
+                                            card_bytes if card_bytes is not None else saved_path, card_mimetype)
+                feishu_image_cache.register_local(image_key, saved_path)
+                logger.debug("名片已上传飞书", extra={"image_key": image_key})
+
+            # 生成飞书代理URL（优先使用）
+            image_url = f"{base_url}/feishu-image/{image_key}"
+
+            # Determine receiver open_id
+            recv_open_id = DEBUG_OPEN_ID or user.get("open_id")
+            if not recv_open_id and (user.get("email") or user.get("mobile")):
+                # 本地缓存命中时不调用通讯录接口；未命中的与同时到达的查询合并为一次批量查询
+                with timed_stage("contact"):
+                    recv_open_id = contact_resolver.resolve(email=user.get("email"), mobile=user.get("mobile"))
+
+            if recv_open_id:
+                send_result = call_with_token(send_image_message_to_open_id, recv_open_id, image_key)
+            delivered = True
+        except Exception as e:
+            send_result = {"warn": f"feishu_upload_failed: {e}"}
+    else:
+        send_result = {"info": "feishu_disabled: APP_ID or APP_SECRET not configured"}
+        delivered = True
+
+    if cache_key and (not cached or image_key != cached["image_key"] or delivered != cached["delivered"]):
+        result_cache.put(cache_key, saved_path, image_key, profile, delivered)
+
+    # 构建响应数据
+    response_data = {
+        "status": "ok",
+        "saved_path": os.path.abspath(saved_path),
+        "profile": profile,
+        "cached": bool(cached),
+        "image_url": image_url,  # 优先使用飞书代理URL
+        "image_key": image_key,
+        "send_result": send_result,
+        "suggestions": {
+            "view_image": f"访问 {image_url} 查看生成的名片",
+            "feishu_setup": get_feishu_setup_suggestions(send_result)
+        }
+    }
+    
+    # 如果有飞书代理URL，提供更多选项
+    if image_key and feishu_enabled:
+        response_data["local_image_url"] = local_image_url  # 本地备用URL
+        response_data["suggestions"].update({
+            "feishu_cloud": f"访问 {image_url} 查看云端名片（推荐）",
+            "local_backup": f"访问 {local_image_url} 查看本地备份",
+            "download_png": f"访问 {local_image_url}?format=png 下载名片"
+        })
+    else:
+        # 无飞书时使用本地URL
+        response_data["suggestions"]["download_png"] = f"访问 {image_url}?format=png 下载名片"
+    
+    return {"response": response_data, "card_bytes": card_bytes, "saved_path": saved_path, "mimetype": card_mimetype}
+
+def stream_card_response(user: Dict[str, Any], profile: str, base_url: str, cache_key: Optional[str]):
+    """?format=png：在请求线程中渲染，然后边编码边发送（同时写盘），客户端不必等整张图编码完
+
+    发送结束后（客户端中途断开时先把剩余部分写完），仍在请求线程中上传飞书、私信并记录结果缓存：
+    此时客户端已收到完整图片；不交给异步任务队列，避免等待同一执行权的异步任务占满队列线程后无法发送。
+    渲染失败抛出 RenderError；名片图像在发送结束前一直占用渲染内存预算。
+    等待相同内容的并发请求期间名片已生成时返回None，由调用方按缓存命中处理。
+    """
+    settings = RENDER_PROFILES[profile]
+    # 相同内容只由一个请求渲染和发送，执行权在私信完成后才释放
+    claim = None
+    if cache_key:
+        claim, waited = result_flight.acquire(cache_key)
+        if waited and result_cache.get(cache_key):
+            result_flight.release(cache_key, claim)
+            return None
+    qr_prefetcher.start(user)
+    out_path = card_output_path(user.get("nickname", "未命名"), profile)
+    tmp_path = temp_path(out_path)
+    resources = ExitStack()
+
+    def release_flight():
+        if cache_key:
+            result_flight.release(cache_key, claim)
+
+    try:
+        resources.enter_context(render_memory.reserve(estimate_render_bytes(normalize_mbti(user.get("mbti")), profile)))
+        with track_render(profile):
+            card = render_card(user, profile)
+        os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+        f = resources.enter_context(open(tmp_path, "wb"))
+    except Exception as e:
+        resources.close()
+        release_flight()
+        if isinstance(e, RenderError):
+            raise
+        raise RenderError(str(e)) from e
+    chunks = iter_card_chunks(card, settings)
+    del card  # 之后只由编码器持有
+    failed = []
+
+    def generate():
+        try:
+            for chunk in chunks:
+                f.write(chunk)
+                yield chunk
+        except Exception as e:
+            failed.append(e)
+            raise
+
+    def finish():
+        try:
+            if not failed:
+                for chunk in chunks:
+                    f.write(chunk)
+        except Exception as e:
+            failed.append(e)
+        finally:
+            resources.close()  # 关闭文件，释放内存预算
+        if failed:
+            logger.error("流式编码名片失败: %s", failed[0], extra={"path": out_path})
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            release_flight()
+            return
+        os.replace(tmp_path, out_path)
+        try:
+            deliver_card(user, profile, base_url, out_path, None, cache_key, None)
+        except Exception as e:
+            logger.error("发送流式返回的名片失败: %s", e, extra={"path": out_path})
+        finally:
+            release_flight()
+
+    response = app.response_class(generate(), mimetype=IMAGE_FORMATS[settings["format"]][1])
+    response.headers["Content-Disposition"] = f"inline; filename*=UTF-8''{quote(os.path.basename(out_path))}"
+    response.call_on_close(finish)
+    return response
+
+# ----------------------- Render engine -----------------------
+def warm_render_worker():
+    """渲染子进程初始化：字体和底图在fork前已由父进程加载，这里只补齐未预热的部分"""
+    font_registry.resolve()
+    preload_templates()
+
+def render_card_bytes(user: Dict[str, Any], profile: str, out_path: Optional[str] = None) -> (Optional[bytes], list):
+    """在渲染子进程中执行：绘制并编码名片；各阶段耗时一并返回，由父进程计入指标
+
+    STREAM_ENCODE 且给出 out_path 时子进程直接边编码边写盘，返回的字节为None；否则返回编码结果，写盘由父进程完成。
+    """
+    timings = []
+    token = request_timings_var.set(timings)
+    try:
+        card = render_card(user, profile)
+        if out_path and STREAM_ENCODE:
+            write_card_file(card, RENDER_PROFILES[profile], out_path)
+            return None, timings
+        return encode_card(card, RENDER_PROFILES[profile]), timings
+    finally:
+        request_timings_var.reset(token)
+
+@contextmanager
+def track_render(profile: str):
+    """渲染计数：在途渲染数、渲染阶段耗时，以及成功/失败次数"""
+    RENDERS_IN_FLIGHT.inc()
+    try:
+        with timed_stage("render"):
+            yield
+    except Exception:
+        RENDERS_TOTAL.inc(profile=profile, result="error")
+        raise
+    finally:
+        RENDERS_IN_FLIGHT.dec()
+    RENDERS_TOTAL.inc(profile=profile, result="ok")
+
+# 单次渲染的固定开销：字形、文字蒙版、二维码等小块
+RENDER_MEMORY_OVERHEAD = 8 * 1024 * 1024
+
+def estimate_render_bytes(mbti: str, profile: str, full_image: bool = False) -> int:
+    """单次渲染的峰值内存估算（不含缓存中共享的底图和条带压缩结果）
+
+    复用底图条带时（见 render_card）只合成单个条带，否则为整张名片；full_image 表示调用方需要整张图。
+    """
+    W, H = template_cache.shared(mbti, profile).size
+    if uses_band_cache(profile) and not full_image:
+        # 一个条带 + 编码缓冲；前景小块（文字蒙版、二维码）不随整图合成，按整图像素的1/8计
+        strip = W * min(H, band_cache.strip_rows) * 4
+        return strip + strip // 8 + W * H * 4 // 8 + RENDER_MEMORY_OVERHEAD
+    output = W * H * 4  # Pillow中RGB图像每像素占4字节
+    # 编码缓冲按原始像素的1/8计（名片大面积纯色，实际压缩后远小于此）
+    return output + output // 8 + RENDER_MEMORY_OVERHEAD
+
+class RenderMemoryBudget:
+    """进程内的渲染内存预算：每次渲染按估算峰值占用预算，预算不足时等待，并发渲染不会耗尽内存
+
+    单次估算超过总预算时按总预算计（独占执行），大尺寸名片仍能渲染而不会永远等待。
+    """
+
+    def __init__(self, budget_bytes: int, timeout: float):
+        self.budget_bytes = budget_bytes
+        self.timeout = timeout
+        self.after_fork()
+
+    def after_fork(self):
+        # fork出的子进程（批量渲染）各自独立计算，不继承父进程在途渲染的占用
+        self._cond = threading.Condition()
+        self._used = 0
+
+    @contextmanager
+    def reserve(self, nbytes: int):
+        if self.budget_bytes <= 0:
+            yield
+            return
+        nbytes = min(nbytes, self.budget_bytes)
+        with self._cond:
+            if self._used + nbytes > self.budget_bytes:
+                with timed_stage("memory_wait"):
+                    if not self._cond.wait_for(lambda: self._used + nbytes <= self.budget_bytes, self.timeout):
+                        raise RenderError(f"渲染内存预算已满（{self.budget_bytes // 2**20}MB），等待超过 {self.timeout}s")
+            self._used += nbytes
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._used -= nbytes
+                self._cond.notify_all()
 
-# Output directory for saving cards for printing
-OUTPUT_DIR = os.getenv("OUTPUT_DIR", "./output")
-ASSETS_DIR = os.getenv("ASSETS_DIR", "./assets")
-TEMPLATE_PATH = os.getenv("TEMPLATE_PATH", os.path.join(ASSETS_DIR, "template.png"))
+    def in_use(self) -> int:
+        return self._used
 
-app = Flask(__name__)
+render_memory = RenderMemoryBudget(RENDER_MEMORY_MB * 1024 * 1024 // RENDER_MEMORY_PROCESSES, RENDER_TIMEOUT)
+metrics.gauge("mbti_card_render_memory_bytes", "Estimated peak memory reserved by in-flight renders",
+              fn=render_memory.in_use)
 
-# ----------------------- Feishu helpers -----------------------
-def get_tenant_access_token() -> str:
-    url = "https://open.feishu.cn/open-apis/auth/v3/tenant_access_token/internal/"
-    payload = {"app_id": APP_ID, "app_secret": APP_SECRET}
-    r = requests.post(url, json=payload, timeout=10)
-    r.raise_for_status()
-    data = r.json()
-    if data.get("code") != 0:
-        raise RuntimeError(f"get_tenant_access_token failed: {data}")
-    return data["tenant_access_token"]
+class RenderEngine:
+    """预先fork的渲染进程池：Pillow合成与PNG编码不再占用请求线程的GIL
 
-def batch_get_open_id_by_email_or_mobile(token: str, email: Optional[str]=None, mobile: Optional[str]=None) -> Optional[str]:
+    - submit()/render() 提交与等待任务，超过 timeout 的任务会回收整个进程池
+    - 子进程崩溃（BrokenProcessPool）只让当前任务失败，进程池自动重建，Web服务不受影响
     """
-    Use Feishu contact-v3 API to get open_id by email or mobile
-    """
-    if not email and not mobile:
-        return None
-    url = "https://open.feishu.cn/open-apis/contact/v3/users/batch_get_id"
-    params = {}
-    if email:
-        params["emails"] = email
-    if mobile:
-        params["mobiles"] = mobile
-    headers = {"Authorization": f"Bearer {token}"}
-    r = requests.get(url, headers=headers, params=params, timeout=10)
-    r.raise_for_status()
-    data = r.json()
-    if data.get("code") != 0:
-        return None
-    user_list = data.get("data", {}).get("user_list", [])
-    if user_list:
-        return user_list[0].get("open_id")
-    return None
 
-def upload_image_to_feishu(token: str, image_bytes: bytes) -> str:
-    url = "https://open.feishu.cn/open-apis/im/v1/images"
-    headers = {"Authorization": f"Bearer {token}"}
-    
-    # 修复：image_type应该作为form-data字段，不是URL参数
-    data = {"image_type": "message"}
-    files = {"image": ("card.png", image_bytes, "image/png")}
-    
-    # 记录请求详细信息用于调试
-    print(f"Debug: 上传图片到飞书 - 图片大小: {len(image_bytes)} bytes")
-    print(f"Debug: 修复参数格式 - image_type作为form-data字段")
-    
-    r = requests.post(url, headers=headers, files=files, data=data, timeout=20)
-    
-    # 详细记录响应信息
-    print(f"Debug: 飞书API响应状态码: {r.status_code}")
-    print(f"Debug: 飞书API响应内容: {r.text}")
-    
+    def __init__(self, workers: int, timeout: float):
+        self.workers = workers
+        self.timeout = timeout
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+        self.restarts = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.workers > 0
+
+    def _new_pool(self) -> ProcessPoolExecutor:
+        methods = multiprocessing.get_all_start_methods()
+        ctx = multiprocessing.get_context("fork") if "fork" in methods else None
+        pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=ctx, initializer=warm_render_worker)
+        # fork模式下首次提交即拉起全部子进程
+        pool.submit(int)
+        return pool
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                self._pool = self._new_pool()
+            return self._pool
+
+    def after_fork(self):
+        # 父进程的渲染进程池在子进程中不可用（管理线程不存在），需要时重新创建
+        self._lock = threading.Lock()
+        self._pool = None
+
+    def start(self):
+        """预先拉起子进程（在父进程完成底图预加载之后调用）"""
+        if self.enabled:
+            self._get_pool()
+
+    def _restart(self, pool: ProcessPoolExecutor):
+        with self._lock:
+            if self._pool is not pool:
+                return  # 其他线程已经重建过
+            self._pool = None
+            self.restarts += 1
+        # 卡死或崩溃的子进程直接终止，排队中的任务一并取消
+        for process in list(getattr(pool, "_processes", {}).values()):
+            process.terminate()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def _submit(self, user: Dict[str, Any], profile: str, out_path: Optional[str] = None):
+        pool = self._get_pool()
+        try:
+            return pool, pool.submit(render_card_bytes, user, profile, out_path)
+        except BrokenProcessPool:
+            # 之前的任务把进程池弄坏了，与本任务无关：重建后重新提交
+            self._restart(pool)
+            pool = self._get_pool()
+            return pool, pool.submit(render_card_bytes, user, profile, out_path)
+
+    def submit(self, user: Dict[str, Any], profile: str, out_path: Optional[str] = None):
+        """提交渲染任务，返回 Future（结果为 (编码后的图片字节或None, 各阶段耗时)，见 render_card_bytes）"""
+        return self._submit(user, profile, out_path)[1]
+
+    def render(self, user: Dict[str, Any], profile: str, timeout: Optional[float] = None,
+               out_path: Optional[str] = None) -> Optional[bytes]:
+        """提交并等待渲染结果；超时或子进程崩溃时抛出 RenderError"""
+        timeout = timeout or self.timeout
+        pool, future = self._submit(user, profile, out_path)
+        try:
+            image_bytes, timings = future.result(timeout=timeout)
+        except FutureTimeoutError:
+            self._restart(pool)
+            raise RenderError(f"渲染超时（>{timeout}s），渲染进程已重启")
+        except BrokenProcessPool:
+            self._restart(pool)
+            raise RenderError("渲染进程异常退出，渲染进程已重启")
+        for stage, seconds in timings:
+            record_stage(stage, seconds)
+        return image_bytes
+
+    def generate(self, user: Dict[str, Any], profile: Optional[str] = None) -> (Optional[bytes], str):
+        """与 generate_card 相同的返回值；未启用进程池时直接在当前线程渲染"""
+        profile = resolve_render_profile(profile)
+        # 预算按本进程计：进程池模式下子进程的渲染也由提交它的请求线程占用预算
+        with render_memory.reserve(estimate_render_bytes(normalize_mbti(user.get("mbti")), profile)), \
+                track_render(profile):
+            if not self.enabled:
+                return generate_card(user, profile)
+            # 子进程拿不到本进程的下载任务，提交前先等二维码下载完成
+            user = {**user, "wechat_qr_image": QRPrefetcher.resolve(user.get("wechat_qr_image"))}
+            out_path = card_output_path(user.get("nickname", "未命名"), profile)
+            image_bytes = self.render(user, profile, out_path=out_path)
+            if image_bytes is not None:
+                card_writer.write(out_path, image_bytes)
+            return image_bytes, out_path
+
+    def shutdown(self, wait: bool = True):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=wait, cancel_futures=not wait)
+
+render_engine = RenderEngine(RENDER_WORKERS, RENDER_TIMEOUT)
+atexit.register(render_engine.shutdown, False)
+
+# ----------------------- Batch rendering -----------------------
+def parse_batch_records(text: str) -> list:
+    """解析批量请求：JSON数组，或JSONL（每行一个JSON对象）"""
+    text = text.strip()
+    if not text:
+        return []
+    if text.startswith("["):
+        records = json.loads(text)
+    else:
+        records = [json.loads(line) for line in text.splitlines() if line.strip()]
+    if not all(isinstance(record, dict) for record in records):
+        raise ValueError("每条记录必须是JSON对象")
+    return records
+
+def render_batch_record(index: int, payload: Dict[str, Any], profile: str, pdf_page: bool = False) -> Dict[str, Any]:
+    """批量渲染单条记录（在工作进程中执行），失败时返回错误信息而不是抛出"""
+    user = extract_user_info(payload)
+    result = {"index": index, "nickname": user["nickname"], "mbti": normalize_mbti(user["mbti"])}
     try:
-        response_data = r.json()
-        if response_data.get("code") != 0:
-            raise RuntimeError(f"Upload image failed - Code: {response_data.get('code')}, Message: {response_data.get('msg')}, Details: {response_data}")
-        return response_data["data"]["image_key"]
-    except ValueError as e:
-        # 如果响应不是JSON格式
-        raise RuntimeError(f"Upload image failed - Invalid JSON response: {r.text}, Status: {r.status_code}")
+        qr_prefetcher.start(user)
+        with render_memory.reserve(estimate_render_bytes(result["mbti"], profile, full_image=pdf_page)):
+            # PDF页面需要合成好的整张图
+            card = render_card_image(user, profile) if pdf_page else render_card(user, profile)
+            _, saved_path = store_card(card, user.get("nickname", "未命名"), profile, seq=index)
+            if pdf_page:
+                buf = io.BytesIO()
+                card.save(buf, "JPEG", quality=BATCH_PDF_JPEG_QUALITY)
+                result["pdf_page"] = (buf.getvalue(), card.width, card.height)
+            del card
+        # 工作进程退出时不会执行atexit，这里等写盘完成再返回
+        card_writer.flush()
+        result.update(status="ok", saved_path=os.path.abspath(saved_path))
     except Exception as e:
-        raise RuntimeError(f"Upload image failed - Status: {r.status_code}, Response: {r.text}, Error: {str(e)}")
+        result.update(status="error", error=str(e))
+    return result
 
-def send_image_message_to_open_id(token: str, open_id: str, image_key: str) -> Dict[str, Any]:
-    url = "https://open.feishu.cn/open-apis/im/v1/messages?receive_id_type=open_id"
-    headers = {"Authorization": f"Bearer {token}"}
-    payload = {
-        "receive_id": open_id,
-        "msg_type": "image",
-        "content": json.dumps({"image_key": image_key}, ensure_ascii=False)
-    }
-    r = requests.post(url, headers=headers, json=payload, timeout=10)
-    r.raise_for_status()
-    return r.json()
+def iter_batch_results(records: list, profile: str, workers: int = BATCH_WORKERS, pdf_pages: bool = False):
+    """按输入顺序逐条产出渲染结果；多进程渲染，同时在途的任务数有上限，内存占用不随名单长度增长"""
+    # fork之前预热本批次用到的底图和字体，子进程以copy-on-write方式共享（与渲染进程池相同）
+    font_registry.resolve()
+    mbtis = sorted({normalize_mbti(record.get("mbti")) for record in records})
+    template_cache.preload(mbtis, profiles=tuple(dict.fromkeys(("print", profile))))
+    if not pdf_pages:
+        band_cache.preload(mbtis, profiles=(profile,))
 
-# ----------------------- Utilities -----------------------
-def safe_filename(s: str) -> str:
-    s = s.strip().replace(" ", "_")
-    return re.sub(r"[^a-zA-Z0-9_\-\u4e00-\u9fa5]", "", s)
+    if workers <= 1:
+        for index, record in enumerate(records):
+            yield render_batch_record(index, record, profile, pdf_pages)
+        return
 
-def try_load_font(size: int):
-    # 优先使用项目字体文件，简化字体加载逻辑
-    font_path = os.path.join(ASSETS_DIR, "font.ttf")
-    if os.path.exists(font_path):
-        try:
-            return ImageFont.truetype(font_path, size=size)
-        except Exception:
-            pass
-    # 备用系统字体
-    system_fonts = [
-        "/System/Library/Fonts/PingFang.ttc",  # macOS
-        "/usr/share/fonts/truetype/noto/NotoSansSC-Regular.ttf",  # Linux
-    ]
-    for path in system_fonts:
-        if os.path.exists(path):
+    methods = multiprocessing.get_all_start_methods()
+    ctx = multiprocessing.get_context("fork") if "fork" in methods else None
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx, initializer=warm_render_worker) as pool:
+        pending = deque()
+        todo = iter(enumerate(records))
+
+        def submit_next():
+            item = next(todo, None)
+            if item is not None:
+                index, record = item
+                pending.append((index, pool.submit(render_batch_record, index, record, profile, pdf_pages)))
+
+        for _ in range(workers * 2):
+            submit_next()
+        while pending:
+            index, future = pending.popleft()
             try:
-                return ImageFont.truetype(path, size=size)
-            except Exception:
-                continue
-    return ImageFont.load_default()
+                result = future.result()
+            except Exception as e:
+                result = {"index": index, "status": "error", "error": str(e)}
+            submit_next()
+            yield result
 
-def get_wechat_qr_from_attachment(token: str, attachment_id: str) -> Optional[Image.Image]:
-    """通过飞书附件ID获取微信二维码图片"""
+def run_batch(records: list, profile: str, workers: int = BATCH_WORKERS, pdf_path: Optional[str] = None):
+    """批量生成名片，逐条产出结果，最后产出一条汇总；指定 pdf_path 时合并为一份多页印刷PDF"""
+    started = time.time()
+    ok = failed = 0
+    writer = None
+    pdf_file = None
     try:
-        url = f"https://open.feishu.cn/open-apis/drive/v1/files/{attachment_id}/content"
-        headers = {"Authorization": f"Bearer {token}"}
-        r = requests.get(url, headers=headers, timeout=15)
-        r.raise_for_status()
-        
-        # 转换为PIL图片对象
-        im = Image.open(io.BytesIO(r.content)).convert("RGBA")
-        # 调整为方形，适合放在名片上
-        size = 200  # 固定二维码大小
-        im = ImageOps.fit(im, (size, size), method=Image.LANCZOS, centering=(0.5, 0.5))
-        return im
-    except Exception as e:
-        print(f"获取微信二维码失败: {e}")
-        return None
+        if pdf_path:
+            os.makedirs(os.path.dirname(os.path.abspath(pdf_path)), exist_ok=True)
+            pdf_file = open(pdf_path, "wb")
+            writer = JpegPdfWriter(pdf_file, (mm_to_points(CARD_SIZE_MM[0]), mm_to_points(CARD_SIZE_MM[1])))
+        for result in iter_batch_results(records, profile, workers, pdf_pages=writer is not None):
+            page = result.pop("pdf_page", None)
+            if writer is not None and page is not None:
+                writer.add_page(*page)
+            if result["status"] == "ok":
+                ok += 1
+            else:
+                failed += 1
+            yield result
+        if writer is not None:
+            writer.close()
+    finally:
+        if pdf_file is not None:
+            pdf_file.close()
+    summary = {"total": len(records), "ok": ok, "failed": failed, "profile": profile,
+               "workers": workers, "elapsed_seconds": round(time.time() - started, 3)}
+    if pdf_path:
+        summary["pdf_path"] = os.path.abspath(pdf_path)
+    yield {"summary": summary}
 
+# ----------------------- Async jobs -----------------------
+class JobStore:
+    """异步任务的状态和结果（SQLite），所有worker进程共用，完成后保留 ttl 秒"""
 
-# ----------------------- Card generator -----------------------
-def generate_card(user: Dict[str, Any]) -> (bytes, str):
-    """根据用户信息和MBTI生成个性化名片"""
-    # 获取MBTI类型并选择对应底图
-    mbti = user.get("mbti", "INFP").upper().strip()
-    if mbti not in ["ENFJ", "ENFP", "ENTJ", "ENTP", "ESFJ", "ESFP", "ESTJ", "ESTP", 
-                   "INFJ", "INFP", "INTJ", "INTP", "ISFJ", "ISFP", "ISTJ", "ISTP"]:
-        mbti = "INFP"  # 默认类型
-    
-    # 加载MBTI底图
-    template_path = os.path.join(ASSETS_DIR, f"{mbti}.png")
-    if not os.path.exists(template_path):
-        raise RuntimeError(f"MBTI底图不存在: {template_path}")
-    
-    base = Image.open(template_path).convert("RGBA")
-    W, H = base.size
-    draw = ImageDraw.Draw(base)
-    
-    # 根据高分辨率底图(4961x7016)调整字体大小
-    # 字体需要与底图标题字体大小完全匹配
-    scale_factor = W / 1050
-    # 按照底图标签字体实际大小调整
-    title_font = try_load_font(int(90 * scale_factor))    # 昵称/性别/职业标签字体大小
-    content_font = try_load_font(int(80 * scale_factor))  # 兴趣爱好内容字体
-    intro_font = try_load_font(int(80 * scale_factor))    # 一句话介绍字体
-    
-    # 提取字段信息
-    nickname = user.get("nickname", "未命名")
-    gender = user.get("gender", "")
-    profession = user.get("profession", "")
-    interests = user.get("interests", "")
-    introduction = user.get("introduction", "")
-    wechat_qr = user.get("wechat_qr_image")  # PIL图片对象
-    
-    # 基于底图实际布局的精确坐标（4961x7016分辨率）
-    # 根据对比模板图片调整，精确定位到标签右侧
-    
-    # 左侧字段区域 - 紧贴标签右侧，精确对齐
-    nickname_x = int(W * 0.23)  # "昵称"标签右侧紧贴位置
-    nickname_y = int(H * 0.25) # "昵称"标签垂直中心对齐
-    
-    gender_x = int(W * 0.23)    # "性别"标签右侧紧贴位置  
-    gender_y = int(H * 0.33)   # "性别"标签垂直中心对齐
-    
-    profession_x = int(W * 0.23) # "职业"标签右侧紧贴位置
-    profession_y = int(H * 0.41) # "职业"标签垂直中心对齐
-    
-    # 兴趣爱好区域 - 紧贴"兴趣爱好/在做的创业项目"标签下方
-    interests_x = int(W * 0.08)
-    interests_y = int(H * 0.56)  # 紧贴标签下方，大幅向上调整
-    interests_width = int(W * 1.2)  # 可用宽度
-    
-    # 一句话介绍区域 - 紧贴"一句话介绍你自己"标签下方  
-    intro_x = int(W * 0.08)
-    intro_y = int(H * 0.87)    # 紧贴标签下方，避免重合
-    intro_width = int(W * 1.2) # 可用宽度
-    
-    # 微信二维码区域 - 精确覆盖右侧蓝绿色山丘区域
-    qr_x = int(W * 0.71)        # 山丘区域中心偏左
-    qr_y = int(H * 0.28)        # 山丘区域顶部
-    qr_size = int(W * 0.22)     # 适中的正方形尺寸，不超出边界
-    
-    # 绘制内容 - 使用更大的字体
-    # 1. 昵称 - 使用大字体
-    draw.text((nickname_x, nickname_y), nickname, font=title_font, fill="#3B536A")
-    
-    # 2. 性别 - 使用大字体
-    if gender:
-        draw.text((gender_x, gender_y), gender, font=title_font, fill="#3B536A")
-    
-    # 3. 职业 - 使用大字体
-    if profession:
-        draw.text((profession_x, profession_y), profession, font=title_font, fill="#3B536A")
-    
-    # 4. 兴趣爱好（多行文本，自动换行）- 使用中等字体
-    if interests:
-        # 计算合适的字符宽度用于换行
-        avg_char_width = draw.textlength("测", font=content_font)
-        chars_per_line = int(interests_width // avg_char_width)
-        wrapped_interests = textwrap.fill(interests, width=chars_per_line)
-        
-        lines = wrapped_interests.split('\n')
-        for i, line in enumerate(lines):
-            line_y = interests_y + i * int(90 * scale_factor)  # 增加行间距
-            draw.text((interests_x, line_y), line, font=content_font, fill="#3B536A")
-    
-    # 5. 一句话介绍（多行文本）- 使用专用字体
-    if introduction:
-        avg_char_width = draw.textlength("测", font=intro_font)
-        chars_per_line = int(intro_width // avg_char_width)
-        wrapped_intro = textwrap.fill(introduction, width=chars_per_line)
-        
-        lines = wrapped_intro.split('\n')
-        for i, line in enumerate(lines):
-            line_y = intro_y + i * int(90 * scale_factor)  # 增加行间距
-            draw.text((intro_x, line_y), line, font=intro_font, fill="#34495E")
-    
-    # 6. 微信二维码（1:1比例，覆盖蓝色区域）
-    if wechat_qr:
-        # 调整二维码尺寸为正方形
-        qr_resized = wechat_qr.resize((qr_size, qr_size), Image.LANCZOS)
-        base.paste(qr_resized, (qr_x, qr_y), qr_resized)
-    
-    # 保存文件
-    os.makedirs(OUTPUT_DIR, exist_ok=True)
-    ts = datetime.now().strftime("%Y%m%d-%H%M%S")
-    base_filename = f"{ts}_{safe_filename(nickname)}.png"
-    out_path = os.path.join(OUTPUT_DIR, base_filename)
-    base.convert("RGB").save(out_path, "PNG", optimize=True)
-    
-    # 返回字节流
-    buf = io.BytesIO()
-    base.convert("RGB").save(buf, "PNG", optimize=True)
-    buf.seek(0)
-    return buf.read(), out_path
+    FIELDS = ("id", "status", "created_at", "started_at", "finished_at", "result", "error")
 
-# ----------------------- Payload parser -----------------------
-def extract_user_info(payload: Dict[str, Any]) -> Dict[str, Any]:
-    """简化的用户信息提取，直接处理6字段JSON格式"""
-    # 直接从JSON中提取所需字段
-    user_info = {
-        "nickname": payload.get("nickname", "").strip(),
-        "gender": payload.get("gender", "").strip(), 
-        "profession": payload.get("profession", "").strip(),
-        "interests": payload.get("interests", "").strip(),
-        "mbti": payload.get("mbti", "").strip(),
-        "introduction": payload.get("introduction", "").strip(),
-        "wechatQrAttachmentId": payload.get("wechatQrAttachmentId", "").strip()
-    }
-    return user_info
+    def __init__(self, path: str, ttl: int):
+        self.path = path
+        self.ttl = ttl
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
 
-def get_feishu_setup_suggestions(send_result):
-    """根据飞书API响应生成智能配置建议"""
-    if not send_result or "warn" not in send_result:
-        return "飞书集成正常工作"
-    
-    error_message = send_result.get("warn", "")
-    
-    # 分析不同的错误代码并提供对应建议
-    if "99991672" in error_message:
-        return "需要权限: 访问 https://open.feishu.cn/app/ → 权限管理 → 添加 im:resource:upload 权限"
-    elif "234001" in error_message:
-        return "参数错误: 系统已自动修复，请重试"
-    elif "234007" in error_message:
-        return "机器人未启用: 访问 https://open.feishu.cn/app/ → 应用功能 → 机器人 → 启用机器人"
-    elif "feishu_disabled" in error_message:
-        return "飞书未配置: 请设置环境变量 FEISHU_APP_ID 和 FEISHU_APP_SECRET"
-    else:
-        return f"飞书配置需要完善: {error_message[:100]}..."
+    def after_fork(self):
+        # SQLite连接不能跨fork使用，子进程重新打开
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " id TEXT PRIMARY KEY, status TEXT NOT NULL, created_at REAL NOT NULL,"
+                " started_at REAL, finished_at REAL, result TEXT, error TEXT)"
+            )
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def add(self, job: Dict[str, Any]):
+        with self._lock:
+            db = self._db()
+            # 完成超过 ttl 的任务，以及所在worker已退出、超过 ttl 仍未完成的任务
+            db.execute("DELETE FROM jobs WHERE COALESCE(finished_at, created_at) < ?", (time.time() - self.ttl,))
+            db.execute(
+                "INSERT INTO jobs (id, status, created_at) VALUES (?, ?, ?)", (job["id"], job["status"], job["created_at"])
+            )
+            db.commit()
+
+    def update(self, job_id: str, **fields):
+        if "result" in fields:
+            fields["result"] = json.dumps(fields["result"], ensure_ascii=False)
+        with self._lock:
+            db = self._db()
+            db.execute(f"UPDATE jobs SET {', '.join(f'{name} = ?' for name in fields)} WHERE id = ?",
+                       (*fields.values(), job_id))
+            db.commit()
+
+    def remove(self, job_id: str):
+        with self._lock:
+            db = self._db()
+            db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+            db.commit()
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._db().execute(f"SELECT {', '.join(self.FIELDS)} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(zip(self.FIELDS, row))
+        job["result"] = json.loads(job["result"]) if job["result"] is not None else None
+        return job
+
+class JobQueue:
+    """有界任务队列 + 工作线程池：异步 /hook 立即返回202，由后台线程完成渲染和投递
+
+    队列满时 submit 抛出 queue.Full，由调用方返回503做背压；任务状态和结果记录在 JobStore 中，
+    任务在提交它的worker进程中执行，状态可以从任意worker查询。
+    """
+
+    def __init__(self, workers: int, maxsize: int, store: JobStore):
+        self.workers = workers
+        self.store = store
+        self._queue: "queue.Queue[tuple]" = queue.Queue(maxsize=maxsize)
+        self._lock = threading.Lock()
+        self._threads = []
+        self.accepting = True
+
+    def after_fork(self):
+        # 队列中的任务和工作线程属于父进程
+        self._queue = queue.Queue(maxsize=self._queue.maxsize)
+        self._lock = threading.Lock()
+        self._threads = []
+        self.store.after_fork()
+
+    def _ensure_workers(self):
+        # 延迟启动，避免在fork之前创建线程
+        with self._lock:
+            self._threads = [t for t in self._threads if t.is_alive()]
+            for i in range(len(self._threads), self.workers):
+                t = threading.Thread(target=self._run, name=f"hook-job-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    def submit(self, fn, *args) -> Dict[str, Any]:
+        if not self.accepting:
+            raise queue.Full("job queue is draining")
+        self._ensure_workers()
+        job = {
+            "id": uuid.uuid4().hex,
+            "status": "queued",
+            "created_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+            "result": None,
+            "error": None,
+        }
+        self.store.add(job)
+        try:
+            # 带上提交时的上下文（关联ID），后台线程中的日志仍能对应到原请求
+            self._queue.put_nowait((job["id"], fn, args, contextvars.copy_context()))
+        except queue.Full:
+            self.store.remove(job["id"])
+            raise
+        return job
+
+    def _run(self):
+        while True:
+            job_id, fn, args, context = self._queue.get()
+            try:
+                self.store.update(job_id, status="running", started_at=time.time())
+                try:
+                    result = context.run(fn, *args)
+                    update = {"status": "done", "result": result.get("response")}
+                except Exception as e:
+                    logger.error("异步任务失败: %s", e, extra={"job_id": job_id})
+                    update = {"status": "failed", "error": str(e)}
+                self.store.update(job_id, finished_at=time.time(), **update)
+            except Exception as e:
+                logger.error("记录异步任务状态失败: %s", e, extra={"job_id": job_id})
+            finally:
+                self._queue.task_done()
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        return self.store.get(job_id)
+
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    def drain(self, timeout: float) -> bool:
+        """停止接收新任务并等待排队/运行中的任务完成；超时返回False"""
+        self.accepting = False
+        deadline = time.time() + timeout
+        while self._queue.unfinished_tasks and time.time() < deadline:
+            time.sleep(0.1)
+        return not self._queue.unfinished_tasks
+
+job_queue = JobQueue(JOB_WORKERS, JOB_QUEUE_SIZE, JobStore(JOB_STORE_PATH, JOB_TTL))
+metrics.gauge("mbti_card_job_queue_depth", "Async /hook jobs waiting in the queue", fn=lambda: job_queue.depth())
+
+# ----------------------- Fork safety -----------------------
+def reinit_after_fork():
+    """fork出的子进程（gunicorn worker、渲染进程池、批量渲染）中只有调用fork的线程
+
+    fork时其他线程持有的锁在子进程中永远不会释放，后台线程、线程池和进程池也不存在；
+    在这里统一重建模块级对象的锁、队列和执行器，各对象在首次使用时再按需启动线程。
+    """
+    components = [metrics] + [handler for handler in logger.handlers if isinstance(handler, NonBlockingQueueHandler)]
+    components += [feishu, token_manager, font_registry, card_writer, feishu_image_cache, qr_prefetcher,
+                   template_cache, band_cache, layout_registry, result_cache, contact_resolver,
+                   render_memory, render_engine, job_queue]
+    # 逐个重建，一个失败不影响其余的；失败记录在 after_fork_errors 中（日志处理器重建之后再写日志）
+    errors = []
+    for component in components:
+        if component is None:
+            continue
+        try:
+            component.after_fork()
+        except Exception as e:
+            errors.append(f"{type(component).__name__}: {e!r}")
+    after_fork_errors[:] = errors
+    for error in errors:
+        logger.error("fork后重建失败: %s", error)
+
+# 当前进程最近一次 reinit_after_fork 中失败的对象
+after_fork_errors: list = []
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=reinit_after_fork)
 
 # ----------------------- Flask routes -----------------------
+REQUEST_ID_PATTERN = re.compile(r"^[A-Za-z0-9_.\-]{1,64}$")
+
+@app.before_request
+def start_request_log():
+    # 沿用上游传入的 X-Request-ID（格式合法时），否则生成新的关联ID
+    incoming = request.headers.get("X-Request-ID", "")
+    g.request_id = begin_request_context(incoming if REQUEST_ID_PATTERN.match(incoming) else None)
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def finish_request_log(response):
+    response.headers["X-Request-ID"] = g.get("request_id", request_id_var.get())
+    duration = time.perf_counter() - g.get("request_started", time.perf_counter())
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    REQUEST_SECONDS.observe(duration, endpoint=endpoint)
+    REQUESTS_TOTAL.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+    if SERVER_TIMING:
+        timings = request_timings_var.get() or []
+        response.headers["Server-Timing"] = server_timing_header(timings + [("total", duration)])
+    if request.path not in ("/healthz", "/metrics"):
+        logger.info("request", extra={
+            "method": request.method,
+            "path": request.path,
+            "status": response.status_code,
+            "duration_ms": round(duration * 1000, 1),
+        })
+    return response
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    """Prometheus 抓取入口"""
+    return app.response_class(metrics.render(), mimetype="text/plain; version=0.0.4")
+
 @app.route("/healthz", methods=["GET"])
 def healthz():
     return jsonify({"ok": True})
@@ -319,61 +3070,110 @@ def serve_image(filename):
     try:
         # URL解码文件名以支持中文
         decoded_filename = unquote(filename)
-        image_path = os.path.join(OUTPUT_DIR, decoded_filename)
+        image_path = card_image_path(decoded_filename)
+        if image_path is None:
+            # 缓存数据库等非名片文件一律按不存在处理
+            return jsonify({"error": "image_not_found", "filename": decoded_filename}), 404
+        mimetype = guess_image_mimetype(decoded_filename)
+        as_attachment = request.args.get("format") == "png"
+        
+        # 后台写盘尚未完成时直接返回内存中的内容
+        pending = card_writer.pending(image_path)
+        if pending is not None:
+            return send_file(io.BytesIO(pending), mimetype=mimetype, as_attachment=as_attachment,
+                             download_name=decoded_filename, conditional=True, last_modified=time.time())
         
         if not os.path.exists(image_path):
             return jsonify({"error": "image_not_found", "filename": decoded_filename}), 404
         
+        # send_file 分块读取文件，并处理 Range / If-None-Match / If-Modified-Since
         # 检查是否请求PNG下载格式
-        if request.args.get("format") == "png":
-            return send_file(image_path, mimetype="image/png", as_attachment=True, download_name=decoded_filename)
+        if as_attachment:
+            return send_file(image_path, mimetype=mimetype, as_attachment=True, download_name=decoded_filename, conditional=True)
         
         # 默认在浏览器中显示
-        return send_file(image_path, mimetype="image/png")
+        return send_file(image_path, mimetype=mimetype, conditional=True)
     except Exception as e:
         return jsonify({"error": "serve_image_failed", "detail": str(e)}), 500
 
 @app.route("/feishu-image/<image_key>", methods=["GET"])
 def serve_feishu_image(image_key):
-    """通过飞书API代理访问云端图片"""
+    """通过飞书API代理访问云端图片（image_key不可变，命中本地缓存时不回源）"""
     try:
-        print(f"🔍 请求飞书图片: {image_key}")
+        logger.debug("请求飞书图片", extra={"image_key": image_key})
+        
+        # image_key 对应的内容不会变化，ETag 直接使用 image_key
+        if request.if_none_match.contains(image_key):
+            response = app.response_class(status=304)
+            response.set_etag(image_key)
+            response.headers["Cache-Control"] = "public, max-age=86400, immutable"
+            return response
+        
+        data, path, cache_source = feishu_image_cache.get(image_key)
+        CACHE_LOOKUPS.inc(cache="feishu_image", result="miss" if cache_source == "miss" else "hit")
+        if data is not None or path is not None:
+            # 本地命中：内存内容或本地文件，支持 Range 和条件请求
+            if data is not None:
+                mimetype = sniff_image_mimetype(data)
+                source = io.BytesIO(data)
+            else:
+                with open(path, "rb") as f:
+                    mimetype = sniff_image_mimetype(f.read(16))
+                source = path
+            ext = mimetype.split("/")[-1].replace("jpeg", "jpg")
+            response = send_file(source, mimetype=mimetype, download_name=f"feishu-card-{image_key}.{ext}",
+                                 conditional=True, etag=image_key, max_age=86400)
+            response.headers["Cache-Control"] = "public, max-age=86400, immutable"
+            response.headers["X-Cache"] = cache_source
+            return response
         
         # 获取飞书访问token
         if not APP_ID or not APP_SECRET:
             return jsonify({"error": "feishu_not_configured", "detail": "飞书应用未配置"}), 500
             
-        token = get_tenant_access_token()
-        
-        # 调用飞书图片下载API
-        url = f"https://open.feishu.cn/open-apis/im/v1/images/{image_key}"
-        headers = {"Authorization": f"Bearer {token}"}
-        
-        print(f"📥 从飞书获取图片: {url}")
-        r = requests.get(url, headers=headers, timeout=15)
+        # 调用飞书图片下载API（token失效时自动刷新重试）
+        r = call_with_token(download_feishu_image, image_key)
         
-        if r.status_code == 200:
-            print(f"✅ 飞书图片获取成功: {len(r.content)} bytes")
-            # 直接返回飞书的图片内容
-            response = app.response_class(
-                r.content,
-                mimetype="image/png",
-                headers={
-                    "Cache-Control": "public, max-age=3600",  # 缓存1小时
-                    "Content-Disposition": f'inline; filename="feishu-card-{image_key}.png"'
-                }
-            )
-            return response
-        else:
-            print(f"❌ 飞书图片获取失败: {r.status_code} - {r.text}")
+        if r.status_code != 200:
+            logger.warning("飞书图片获取失败", extra={"image_key": image_key, "status": r.status_code})
+            r.close()
             return jsonify({
                 "error": "feishu_image_not_found", 
                 "detail": f"飞书API返回: {r.status_code}",
                 "image_key": image_key
             }), 404
+        
+        # 回源：分块转发，内存占用与图片大小无关，同时写入缓存
+        chunks = r.iter_content(chunk_size=STREAM_CHUNK_SIZE)
+        first = next(chunks, b"")
+        mimetype = sniff_image_mimetype(first)
+        ext = mimetype.split("/")[-1].replace("jpeg", "jpg")
+
+        def generate():
+            try:
+                yield first
+                yield from chunks
+            finally:
+                r.close()
+
+        headers = {
+            "Cache-Control": "public, max-age=86400, immutable",
+            "Content-Disposition": f'inline; filename="feishu-card-{image_key}.{ext}"',
+            "X-Cache": cache_source,
+        }
+        if r.headers.get("Content-Length") and "Content-Encoding" not in r.headers:
+            headers["Content-Length"] = r.headers["Content-Length"]
+        response = app.response_class(
+            stream_with_context(feishu_image_cache.stream_through(image_key, generate())),
+            mimetype=mimetype,
+            headers=headers,
+            direct_passthrough=True,
+        )
+        response.set_etag(image_key)
+        return response
             
     except Exception as e:
-        print(f"❌ 飞书图片代理异常: {e}")
+        logger.exception("飞书图片代理异常", extra={"image_key": image_key})
         return jsonify({
             "error": "feishu_proxy_failed", 
             "detail": str(e),
@@ -382,12 +3182,6 @@ def serve_feishu_image(image_key):
 
 @app.route("/hook", methods=["GET", "POST"])
 def hook():
-    # 记录请求详细信息用于调试
-    print(f"🔍 收到请求: {request.method} {request.url}")
-    print(f"📋 请求头: {dict(request.headers)}")
-    print(f"🌐 客户端IP: {request.remote_addr}")
-    print(f"📝 Content-Type: {request.content_type}")
-    
     # 处理GET请求（飞书可能的预检查）
     if request.method == "GET":
         return jsonify({
@@ -395,14 +3189,20 @@ def hook():
             "message": "飞书MBTI名片生成服务运行中",
             "methods_supported": ["GET", "POST"],
             "webhook_endpoint": "/hook",
+            "jobs_endpoint": "/jobs/<job_id>",
+            "batch_endpoint": "/hook/batch",
             "health_endpoint": "/healthz",
             "version": "2.0",
             "features": {
                 "mbti_types": 16,
-                "fields_supported": ["nickname", "gender", "profession", "interests", "mbti", "introduction"],
+                "fields_supported": ["nickname", "gender", "profession", "interests", "mbti", "introduction", "wechat_url"],
                 "wechat_qr_support": True,
-                "image_formats": ["PNG"],
-                "feishu_integration": bool(APP_ID and APP_SECRET)
+                "local_qr_generation": qrcode is not None,
+                "image_formats": [fmt.upper() for fmt in IMAGE_FORMATS],
+                "render_profiles": list(RENDER_PROFILES),
+                "default_render_profile": RENDER_PROFILE,
+                "feishu_integration": bool(APP_ID and APP_SECRET),
+                "async_mode": HOOK_ASYNC
             }
         })
     
@@ -411,38 +3211,36 @@ def hook():
     payload = {}
     
     try:
-        print(f"📦 开始解析POST数据...")
         # 尝试解析JSON格式
         if request.content_type and 'application/json' in request.content_type:
             payload = request.get_json(force=True, silent=False) or {}
-            print(f"✅ JSON数据解析成功: {len(str(payload))} 字符")
         # 处理表单数据格式（multipart/form-data 或 application/x-www-form-urlencoded）
         elif request.form:
             payload = dict(request.form)
-            print(f"✅ Form数据解析成功: {len(payload)} 个字段")
         # 处理原始数据
         elif request.get_data():
             # 尝试解析为JSON
             raw_data = request.get_data().decode('utf-8')
-            print(f"📄 原始数据: {raw_data[:200]}...")
             try:
                 import json as json_module
                 payload = json_module.loads(raw_data)
-                print(f"✅ 原始JSON解析成功")
             except:
                 # 如果不是JSON，返回错误信息用于调试
-                print(f"❌ 无法解析为JSON格式")
+                logger.info("无法解析为JSON格式", extra={"content_type": request.content_type, "bytes": len(raw_data)})
                 return jsonify({
                     "error": "unsupported_format", 
                     "detail": f"Content-Type: {request.content_type}",
                     "raw_data": raw_data[:200]
                 }), 400
         else:
-            print(f"❌ 未收到任何数据")
             return jsonify({"error": "empty_request", "detail": "No data received"}), 400
         
-        # 打印解析后的数据用于调试
-        print(f"🎯 解析后的payload: {json.dumps(payload, ensure_ascii=False, indent=2) if payload else 'Empty'}")
+        # 调试信息只记录字段名和长度，不记录填写内容
+        if debug_enabled():
+            logger.debug("解析后的payload", extra={
+                "content_type": request.content_type,
+                "fields": {k: len(str(v)) for k, v in payload.items()} if isinstance(payload, dict) else type(payload).__name__,
+            })
             
     except Exception as e:
         return jsonify({
@@ -453,97 +3251,107 @@ def hook():
         }), 400
 
     user = extract_user_info(payload)
+    try:
+        profile = resolve_render_profile(request.args.get("profile") or payload.get("profile"))
+    except ValueError as e:
+        return jsonify({"error": "unknown_profile", "detail": str(e)}), 400
     
-    # 1) 获取微信二维码图片（如果有attachment_id）
-    wechat_qr_image = None
-    if user.get("wechatQrAttachmentId") and APP_ID and APP_SECRET:
+    # 异步模式：校验后入队，立即返回202和任务ID（?format=png 需要同步返回图片）
+    use_async = request.args.get("async", "1" if HOOK_ASYNC else "0") != "0"
+    if use_async and request.args.get("format") != "png":
         try:
-            token = get_tenant_access_token()
-            wechat_qr_image = get_wechat_qr_from_attachment(token, user["wechatQrAttachmentId"])
-            user["wechat_qr_image"] = wechat_qr_image
-        except Exception as e:
-            print(f"获取微信二维码失败: {e}")
-    
-    # 2) Generate card
+            job = job_queue.submit(process_card, user, profile, public_base_url())
+        except queue.Full:
+            response = jsonify({
+                "error": "queue_full",
+                "detail": "渲染队列已满，请稍后重试",
+                "queue_depth": job_queue.depth()
+            })
+            response.headers["Retry-After"] = str(JOB_RETRY_AFTER)
+            return response, 503
+        # 入队成功且未生成过时即开始下载二维码，与排队并行（任务中按附件ID复用同一下载）
+        if result_cache is None or not result_cache.get(result_cache_key(user, profile)):
+            qr_prefetcher.start(dict(user))  # user 已交给后台任务，不在这里修改
+        return jsonify({
+            "status": "accepted",
+            "job_id": job["id"],
+            "status_url": f"{public_base_url()}/jobs/{job['id']}",
+            "queue_depth": job_queue.depth()
+        }), 202
+
+    want_png = request.args.get("format") == "png"
     try:
-        png_bytes, saved_path = generate_card(user)
-    except Exception as e:
+        lookup = lookup_result(user, profile)
+        if want_png and STREAM_ENCODE and not lookup[1]:
+            # 未生成过：边编码边返回图片，发送完成后再上传飞书和私信
+            response = stream_card_response(user, profile, public_base_url(), lookup[0])
+            if response is not None:
+                return response
+            lookup = None  # 等待期间相同内容的请求已生成名片
+        result = process_card(user, profile, public_base_url(), lookup)
+    except RenderError as e:
         return jsonify({"error": "render_failed", "detail": str(e)}), 500
 
-    # 3) 生成本地备用URL
-    image_filename = os.path.basename(saved_path)
-    # URL编码文件名以支持中文
-    encoded_filename = quote(image_filename)
-    # 生成本地访问URL作为备用
-    if 'ngrok' in request.host:
-        local_image_url = f"https://{request.host}/image/{encoded_filename}"
-    else:
-        base_url = request.url_root.rstrip('/')
-        local_image_url = f"{base_url}/image/{encoded_filename}"
+    # 5) Support returning PNG directly if client requests it
+    if want_png:
+        download_name = os.path.basename(result["saved_path"])
+        if result["card_bytes"] is None:
+            return send_file(result["saved_path"], mimetype=result["mimetype"], as_attachment=False, download_name=download_name)
+        return send_file(io.BytesIO(result["card_bytes"]), mimetype=result["mimetype"], as_attachment=False, download_name=download_name)
 
-    # 4) 尝试上传到飞书并生成飞书代理URL（推荐）
-    image_key = None
-    image_url = local_image_url  # 默认使用本地URL
-    send_result = None
-    feishu_enabled = bool(APP_ID and APP_SECRET)
-    
-    if feishu_enabled:
-        try:
-            token = get_tenant_access_token()
-            image_key = upload_image_to_feishu(token, png_bytes)
-            
-            # 生成飞书代理URL（优先使用）
-            if 'ngrok' in request.host:
-                image_url = f"https://{request.host}/feishu-image/{image_key}"
-            else:
-                base_url = request.url_root.rstrip('/')
-                image_url = f"{base_url}/feishu-image/{image_key}"
-            
-            print(f"✅ 优先使用飞书代理URL: {image_url}")
+    return jsonify(result["response"])
 
-            # Determine receiver open_id
-            recv_open_id = DEBUG_OPEN_ID or user.get("open_id")
-            if not recv_open_id and user.get("email"):
-                recv_open_id = batch_get_open_id_by_email_or_mobile(token, email=user["email"])
+@app.route("/hook/batch", methods=["POST"])
+def hook_batch():
+    """批量生成名片：请求体为JSON数组或JSONL，逐条以NDJSON流式返回结果"""
+    try:
+        records = parse_batch_records(request.get_data(as_text=True))
+        profile = resolve_render_profile(request.args.get("profile"))
+        workers = max(1, min(int(request.args.get("workers", BATCH_WORKERS)), BATCH_WORKERS))
+    except ValueError as e:
+        return jsonify({"error": "invalid_batch", "detail": str(e)}), 400
+    
+    pdf_path = None
+    if request.args.get("pdf") == "1":
+        ts = datetime.now().strftime("%Y%m%d-%H%M%S")
+        pdf_path = os.path.join(OUTPUT_DIR, f"{ts}_batch_{profile}.pdf")
+    
+    def generate():
+        for result in run_batch(records, profile, workers, pdf_path):
+            yield json.dumps(result, ensure_ascii=False) + "\n"
+    
+    return app.response_class(stream_with_context(generate()), mimetype="application/x-ndjson")
 
-            if recv_open_id:
-                send_result = send_image_message_to_open_id(token, recv_open_id, image_key)
-        except Exception as e:
-            send_result = {"warn": f"feishu_upload_failed: {e}"}
-    else:
-        send_result = {"info": "feishu_disabled: APP_ID or APP_SECRET not configured"}
+@app.route("/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    """查询异步渲染任务状态和结果（image_key, saved_path）"""
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({"error": "job_not_found", "job_id": job_id}), 404
+    return jsonify(job)
 
-    # 5) Support returning PNG directly if client requests it
-    if request.args.get("format") == "png":
-        return send_file(io.BytesIO(png_bytes), mimetype="image/png", as_attachment=False, download_name="card.png")
+# ----------------------- Server lifecycle -----------------------
+def create_app() -> Flask:
+    """WSGI入口（gunicorn: app:create_app()）：在fork之前加载字体和底图，子进程以copy-on-write共享"""
+    font_registry.resolve()
+    layout_registry.load()  # 规格无效时启动失败，而不是在请求中报错
+    preload_templates()
+    return app
 
-    # 构建响应数据
-    response_data = {
-        "status": "ok",
-        "saved_path": os.path.abspath(saved_path),
-        "image_url": image_url,  # 优先使用飞书代理URL
-        "image_key": image_key,
-        "send_result": send_result,
-        "suggestions": {
-            "view_image": f"访问 {image_url} 查看生成的名片",
-            "feishu_setup": get_feishu_setup_suggestions(send_result)
-        }
-    }
-    
-    # 如果有飞书代理URL，提供更多选项
-    if image_key and feishu_enabled:
-        response_data["local_image_url"] = local_image_url  # 本地备用URL
-        response_data["suggestions"].update({
-            "feishu_cloud": f"访问 {image_url} 查看云端名片（推荐）",
-            "local_backup": f"访问 {local_image_url} 查看本地备份",
-            "download_png": f"访问 {local_image_url}?format=png 下载名片"
-        })
-    else:
-        # 无飞书时使用本地URL
-        response_data["suggestions"]["download_png"] = f"访问 {image_url}?format=png 下载名片"
-    
-    return jsonify(response_data)
+def shutdown_gracefully(timeout: float = GRACEFUL_TIMEOUT):
+    """进程退出前：拒绝新的异步任务，等待在途渲染完成，刷完后台写盘；各步骤共用 timeout 秒"""
+    deadline = time.time() + timeout
+    if not job_queue.drain(timeout):
+        logger.warning("异步任务未在 %ss 内全部完成", timeout, extra={"queue_depth": job_queue.depth()})
+    render_engine.shutdown(wait=time.time() < deadline)
+    if not card_writer.flush(max(deadline - time.time(), 0)):
+        logger.warning("后台写盘未在 %ss 内全部完成", timeout)
 
 if __name__ == "__main__":
+    # 本地开发服务器；生产环境使用 gunicorn -c gunicorn.conf.py
     port = int(os.getenv("PORT", "3000"))
-    app.run(host="0.0.0.0", port=port, debug=True)
+    debug = os.getenv("FLASK_DEBUG", "1") == "1"
+    create_app()
+    if not debug or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        render_engine.start()  # debug模式下只在reloader子进程中启动
+    app.run(host="0.0.0.0", port=port, debug=debug)
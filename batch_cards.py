@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+批量生成名片 - 活动前预先打印整份名单
+- 输入：JSON数组或JSONL文件（每行一个与 /hook 相同格式的JSON对象），"-" 表示标准输入
+- 多进程渲染（默认CPU核数），每条结果以NDJSON输出到标准输出或 --output 文件
+- 可选 --pdf 合并为一份多页印刷PDF
+
+示例:
+    python batch_cards.py roster.jsonl --pdf output/roster.pdf
+    python batch_cards.py roster.json --profile preview --workers 2 --output results.ndjson
+"""
+import sys
+import json
+import argparse
+
+import app as card_app
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="批量生成MBTI名片")
+    parser.add_argument("input", help="JSON数组或JSONL文件路径，'-' 表示标准输入")
+    parser.add_argument("--profile", default=None, help=f"渲染档位: {', '.join(card_app.RENDER_PROFILES)}（默认 {card_app.RENDER_PROFILE}）")
+    parser.add_argument("--workers", type=int, default=card_app.BATCH_WORKERS, help="渲染进程数（默认CPU核数）")
+    parser.add_argument("--pdf", default=None, help="合并输出的多页PDF路径")
+    parser.add_argument("--output", default=None, help="NDJSON结果输出文件（默认标准输出）")
+    args = parser.parse_args(argv)
+
+    if args.input == "-":
+        text = sys.stdin.read()
+    else:
+        with open(args.input, "r", encoding="utf-8") as f:
+            text = f.read()
+
+    try:
+        records = card_app.parse_batch_records(text)
+        profile = card_app.resolve_render_profile(args.profile)
+    except ValueError as e:
+        print(f"❌ 输入无效: {e}", file=sys.stderr)
+        return 2
+
+    out = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+    failed = 0
+    try:
+        for result in card_app.run_batch(records, profile, max(1, args.workers), args.pdf):
+            out.write(json.dumps(result, ensure_ascii=False) + "\n")
+            out.flush()
+            if "summary" in result:
+                failed = result["summary"]["failed"]
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
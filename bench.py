@@ -0,0 +1,441 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+离线渲染基准测试 - 不需要启动服务，也不访问飞书
+- 进程内直接调用 generate_card 和 /hook（Flask test client），飞书接口替换为本地桩
+- 覆盖16种MBTI底图 × 短文本 / 长文本 / 中文为主三类内容
+- 统计 p50/p95/p99 延迟、每核每秒名片数（名片数 / CPU秒）和峰值RSS，结果为JSON
+- memory 场景在子进程中测量各档位单次渲染的峰值内存，超过 estimate_render_bytes 的估算或fork钩子出错时退出码为1
+- --baseline 与之前保存的结果比较，任一指标退化超过 --threshold 时退出码为1（可用于CI）
+
+示例:
+    python bench.py --profile preview --output bench-baseline.json
+    python bench.py --profile preview --baseline bench-baseline.json --threshold 0.15
+"""
+import os
+import sys
+import json
+import time
+import ctypes
+import argparse
+import platform
+import tempfile
+import multiprocessing
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# 必须在导入 app 之前设置：不读写结果缓存（否则重复内容直接命中），生成的名片写到临时目录
+os.environ["RESULT_CACHE"] = "0"
+os.environ.setdefault("OUTPUT_DIR", tempfile.mkdtemp(prefix="mbti-bench-"))
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+import requests
+import PIL
+
+import app as card_app
+
+SCENARIOS = ("generate", "hook", "memory")
+PAYLOAD_KINDS = ("short", "long", "cjk")
+
+# 延迟越大越差；吞吐越小越差
+LOWER_IS_BETTER = ("p50_ms", "p95_ms", "p99_ms", "peak_render_mb")
+HIGHER_IS_BETTER = ("cards_per_core_s",)
+
+
+# ----------------------- Payloads -----------------------
+def make_payload(kind: str, mbti: str, seq: int) -> dict:
+    """三类内容：short 单行短字段；long 英文长文本（缩小字号、截断、本地二维码）；cjk 中文长文本（逐字断行、避头尾）"""
+    if kind == "short":
+        return {
+            "nickname": f"Amy{seq}",
+            "gender": "女",
+            "profession": "PM",
+            "interests": "跑步",
+            "mbti": mbti,
+            "introduction": "Hi!",
+        }
+    if kind == "long":
+        return {
+            "nickname": f"Maximilian Alexander Featherstonehaugh-{seq}",
+            "gender": "Prefer not to say",
+            "profession": "Principal Site Reliability Engineer, Internationalization Platform",
+            "interests": "rock climbing, long-distance cycling, analog photography, sourdough baking, "
+                         "competitive crosswords, supercalifragilisticexpialidocious vocabulary",
+            "mbti": mbti,
+            "introduction": "Builds distributed systems by day and restores vintage synthesizers by night; "
+                            "happy to talk about observability, latency budgets, and why every queue "
+                            "eventually needs backpressure. " * 2,
+            "wechat_url": f"https://u.wechat.com/bench-{mbti}-{seq}",
+        }
+    if kind == "cjk":
+        return {
+            "nickname": f"欧阳思睿{seq}",
+            "gender": "男",
+            "profession": "高级产品经理（用户增长与商业化方向）",
+            "interests": "阅读、编程、旅行、摄影、咖啡、徒步、围棋、书法、做饭、看展、听播客、“慢跑”",
+            "mbti": mbti,
+            "introduction": "热爱技术和产品设计的理想主义者，相信好的产品来自对用户的长期观察。"
+                            "工作之余喜欢在城市里散步，记录街角的小店和路人的故事；"
+                            "最近在学习日语（《深夜食堂》看了三遍），欢迎一起交流！",
+        }
+    raise ValueError(f"未知内容类型: {kind}")
+
+
+# ----------------------- Feishu stub -----------------------
+def _json_response(url: str, data: dict, status: int = 200) -> requests.Response:
+    r = requests.Response()
+    r.status_code = status
+    r.url = url
+    r.headers["Content-Type"] = "application/json"
+    r._content = json.dumps(data).encode("utf-8")
+    return r
+
+
+class StubFeishuClient:
+    """替换 app.feishu：按路径返回固定结果，不发出网络请求
+
+    上传图片时照常构造multipart请求体（与真实上传的编码开销一致），latency 模拟每次调用的网络往返。
+    """
+
+    def __init__(self, base_url: str, latency: float = 0.0):
+        self.base_url = base_url
+        self.latency = latency
+        self.calls = 0
+        self.uploaded_bytes = 0
+
+    def request(self, method: str, path: str, read_timeout: float = 10, **kwargs) -> requests.Response:
+        url = path if path.startswith("http") else f"{self.base_url}{path}"
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if path.startswith("/auth/v3/tenant_access_token"):
+            return _json_response(url, {"code": 0, "tenant_access_token": "t-bench", "expire": 7200})
+        if path.startswith("/im/v1/images") and method == "POST":
+            prepared = requests.Request(method, url, headers=kwargs.get("headers"),
+                                        files=kwargs.get("files"), data=kwargs.get("data")).prepare()
+            body = prepared.body
+            if hasattr(body, "read"):
+                # 从文件流式上传的请求体：像真实发送一样分块读完
+                for block in iter(lambda: body.read(64 * 1024), b""):
+                    self.uploaded_bytes += len(block)
+            else:
+                self.uploaded_bytes += len(body or b"")
+            return _json_response(url, {"code": 0, "data": {"image_key": f"img_bench_{self.calls}"}})
+        if path.startswith("/im/v1/messages"):
+            return _json_response(url, {"code": 0, "data": {"message_id": f"om_bench_{self.calls}"}})
+        if path.startswith("/contact/v3/users/batch_get_id"):
+            emails = (kwargs.get("json") or {}).get("emails") or []
+            users = [{"email": email, "user_id": f"ou_bench_{i}"} for i, email in enumerate(emails)]
+            return _json_response(url, {"code": 0, "data": {"user_list": users}})
+        return _json_response(url, {"code": 404, "msg": "not stubbed"}, 404)
+
+    def after_fork(self):
+        """没有连接池和锁，fork后不需要重建（app.reinit_after_fork 会调用）"""
+
+    def get(self, path: str, **kwargs) -> requests.Response:
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path: str, **kwargs) -> requests.Response:
+        return self.request("POST", path, **kwargs)
+
+
+def install_feishu_stub(latency: float) -> StubFeishuClient:
+    """启用飞书上传与私信流程，但所有调用都落到本地桩上"""
+    stub = StubFeishuClient(card_app.FEISHU_BASE_URL, latency)
+    card_app.feishu = stub
+    card_app.APP_ID = card_app.APP_ID or "cli_bench"
+    card_app.APP_SECRET = card_app.APP_SECRET or "bench"
+    card_app.DEBUG_OPEN_ID = "ou_bench"
+    card_app.token_manager.invalidate()
+    return stub
+
+
+# ----------------------- Measurement -----------------------
+def percentile(values, q: float) -> float:
+    """线性插值百分位（q 取 0~100）"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    pos = (len(ordered) - 1) * q / 100
+    lo = int(pos)
+    hi = min(lo + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (pos - lo)
+
+
+def peak_rss_mb() -> float:
+    if resource is None:
+        return 0.0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 单位为KB，macOS 为字节
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def summarize(latencies, wall: float, cpu: float, errors: int) -> dict:
+    cards = len(latencies)
+    ms = [s * 1000 for s in latencies]
+    return {
+        "cards": cards,
+        "errors": errors,
+        "p50_ms": round(percentile(ms, 50), 2),
+        "p95_ms": round(percentile(ms, 95), 2),
+        "p99_ms": round(percentile(ms, 99), 2),
+        "mean_ms": round(sum(ms) / cards, 2) if cards else 0.0,
+        "max_ms": round(max(ms), 2) if ms else 0.0,
+        "wall_s": round(wall, 3),
+        "cpu_s": round(cpu, 3),
+        "cards_per_s": round(cards / wall, 3) if wall else 0.0,
+        "cards_per_core_s": round(cards / cpu, 3) if cpu else 0.0,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def run_scenario(name: str, kinds, mbtis, iterations: int, profile: str, client=None) -> dict:
+    """逐张渲染并计时；按内容类型分别汇总，另给出全部内容的合计"""
+    results = {}
+    all_latencies = []
+    total_wall = total_cpu = 0.0
+    total_errors = 0
+    seq = 0
+    for kind in kinds:
+        latencies = []
+        errors = 0
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        for _ in range(iterations):
+            for mbti in mbtis:
+                seq += 1
+                payload = make_payload(kind, mbti, seq)
+                start = time.perf_counter()
+                if name == "generate":
+                    card_app.generate_card(card_app.extract_user_info(payload), profile)
+                    ok = True
+                else:
+                    resp = client.post(f"/hook?async=0&profile={profile}", json=payload)
+                    ok = resp.status_code == 200 and resp.get_json().get("image_key") is not None
+                elapsed = time.perf_counter() - start
+                if ok:
+                    latencies.append(elapsed)
+                else:
+                    errors += 1
+        # 写盘在后台线程：算进本组的CPU和墙钟时间
+        card_app.card_writer.flush()
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+        results[kind] = summarize(latencies, wall, cpu, errors)
+        all_latencies.extend(latencies)
+        total_wall += wall
+        total_cpu += cpu
+        total_errors += errors
+        print(f"  {name}/{kind}: p50={results[kind]['p50_ms']}ms p95={results[kind]['p95_ms']}ms "
+              f"{results[kind]['cards_per_core_s']} cards/core·s", file=sys.stderr)
+    results["all"] = summarize(all_latencies, total_wall, total_cpu, total_errors)
+    return results
+
+
+def _proc_status_mb(field: str) -> float:
+    with open("/proc/self/status", "r") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1]) / 1024
+    raise KeyError(field)
+
+
+def _render_memory_child(profile: str, mbti: str, conn):
+    # 先把父进程已释放、但仍驻留的堆内存还给系统，否则这次渲染会复用它们而显得偏小
+    try:
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+    # 重置本进程的峰值RSS（VmHWM），此后的增量就是这一次渲染的峰值
+    with open("/proc/self/clear_refs", "w") as f:
+        f.write("5")
+    before = _proc_status_mb("VmRSS")
+    card_app.generate_card(card_app.extract_user_info(make_payload("long", mbti, 0)), profile)
+    card_app.card_writer.flush()
+    # fork钩子中重建失败的对象一并返回，由父进程判定失败
+    conn.send((_proc_status_mb("VmHWM") - before, list(card_app.after_fork_errors)))
+    conn.close()
+
+
+def run_memory(mbti: str) -> dict:
+    """各档位单次渲染的峰值内存：底图在父进程中预加载，fork出的子进程只渲染一张长文本名片（仅Linux）"""
+    results = {}
+    if not os.path.exists("/proc/self/clear_refs") or "fork" not in multiprocessing.get_all_start_methods():
+        print("  memory: 需要Linux的 /proc/self/clear_refs，跳过", file=sys.stderr)
+        return results
+    ctx = multiprocessing.get_context("fork")
+    card_app.template_cache.preload([mbti], tuple(card_app.RENDER_PROFILES))
+    card_app.band_cache.preload([mbti], tuple(card_app.RENDER_PROFILES))
+    for profile in card_app.RENDER_PROFILES:
+        parent_conn, child_conn = ctx.Pipe(duplex=False)
+        process = ctx.Process(target=_render_memory_child, args=(profile, mbti, child_conn))
+        process.start()
+        peak, fork_errors = parent_conn.recv()
+        process.join()
+        estimate = card_app.estimate_render_bytes(mbti, profile) / (1024 * 1024)
+        results[profile] = {
+            "peak_render_mb": round(peak, 1),
+            "estimate_mb": round(estimate, 1),
+            "within_estimate": peak <= estimate,
+            "fork_errors": fork_errors,
+        }
+        print(f"  memory/{profile}: 峰值 {peak:.1f}MB（估算 {estimate:.1f}MB）", file=sys.stderr)
+        for error in fork_errors:
+            print(f"  memory/{profile}: fork后重建失败 {error}", file=sys.stderr)
+    return results
+
+
+def warm_up(profile: str, mbtis) -> float:
+    """预加载字体、底图（及其条带压缩结果）和排版规格，首张渲染的解码开销不计入延迟"""
+    start = time.perf_counter()
+    card_app.create_app()
+    card_app.template_cache.preload(mbtis, (profile,))
+    card_app.band_cache.preload(mbtis, (profile,))
+    for mbti in mbtis:
+        card_app.render_card_image(card_app.extract_user_info(make_payload("short", mbti, 0)), profile)
+    return time.perf_counter() - start
+
+
+def environment(args, profile: str) -> dict:
+    return {
+        "python": platform.python_version(),
+        "pillow": PIL.__version__,
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "profile": profile,
+        "iterations": args.iterations,
+        "templates": len(args.mbti),
+        "payloads": list(args.payloads),
+        "feishu_latency_ms": args.feishu_latency,
+        "font": card_app.font_registry.resolve(),
+    }
+
+
+# ----------------------- Compare -----------------------
+def compare(baseline: dict, current: dict, threshold: float) -> dict:
+    """逐项比较 current 与 baseline，相对变化超过 threshold 视为退化"""
+    checks = []
+    for scenario, groups in current.get("results", {}).items():
+        for group, stats in groups.items():
+            base = baseline.get("results", {}).get(scenario, {}).get(group)
+            if not base:
+                continue
+            for metric in LOWER_IS_BETTER + HIGHER_IS_BETTER:
+                old, new = base.get(metric), stats.get(metric)
+                if not old or new is None:
+                    continue
+                change = (new - old) / old
+                worse = change if metric in LOWER_IS_BETTER else -change
+                checks.append({
+                    "metric": f"{scenario}.{group}.{metric}",
+                    "baseline": old,
+                    "current": new,
+                    "change": round(change, 4),
+                    "regressed": worse > threshold,
+                })
+    old_rss, new_rss = baseline.get("peak_rss_mb"), current.get("peak_rss_mb")
+    if old_rss and new_rss is not None:
+        change = (new_rss - old_rss) / old_rss
+        checks.append({
+            "metric": "peak_rss_mb",
+            "baseline": old_rss,
+            "current": new_rss,
+            "change": round(change, 4),
+            "regressed": change > threshold,
+        })
+    mismatched = sorted(
+        key for key in ("profile", "iterations", "templates", "payloads", "feishu_latency_ms", "cpu_count", "pillow")
+        if baseline.get("environment", {}).get(key) != current["environment"].get(key)
+    )
+    return {
+        "threshold": threshold,
+        "environment_mismatch": mismatched,
+        "regressions": [c["metric"] for c in checks if c["regressed"]],
+        "checks": checks,
+    }
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="MBTI名片离线渲染基准测试")
+    parser.add_argument("--profile", default="preview", help=f"渲染档位: {', '.join(card_app.RENDER_PROFILES)}（默认 preview）")
+    parser.add_argument("--iterations", type=int, default=1, help="每个底图 × 内容类型渲染的次数（默认1）")
+    parser.add_argument("--scenario", nargs="+", choices=SCENARIOS, default=list(SCENARIOS), help="要运行的场景")
+    parser.add_argument("--payloads", nargs="+", choices=PAYLOAD_KINDS, default=list(PAYLOAD_KINDS), help="内容类型")
+    parser.add_argument("--mbti", nargs="+", type=str.upper, choices=card_app.MBTI_TYPES,
+                        default=list(card_app.MBTI_TYPES), help="只测部分底图（默认全部16种）")
+    parser.add_argument("--feishu-latency", type=float, default=0.0, help="模拟每次飞书调用的网络耗时（毫秒，默认0）")
+    parser.add_argument("--output", default=None, help="JSON结果输出文件（默认标准输出）")
+    parser.add_argument("--baseline", default=None, help="与之前保存的JSON结果比较")
+    parser.add_argument("--threshold", type=float, default=0.15, help="允许的相对退化（默认0.15即15%%）")
+    args = parser.parse_args(argv)
+
+    try:
+        profile = card_app.resolve_render_profile(args.profile)
+    except ValueError as e:
+        print(f"❌ {e}", file=sys.stderr)
+        return 2
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+
+    stub = install_feishu_stub(args.feishu_latency / 1000)
+    results = {}
+    if "memory" in args.scenario:
+        # 在预热渲染之前测量，父进程中还没有渲染留下的已释放内存
+        print("场景 memory:", file=sys.stderr)
+        results["memory"] = run_memory(args.mbti[0])
+    print(f"预热: {len(args.mbti)} 个底图 ({profile})", file=sys.stderr)
+    warmup = warm_up(profile, args.mbti)
+
+    for name in args.scenario:
+        if name == "memory":
+            continue
+        print(f"场景 {name}:", file=sys.stderr)
+        client = card_app.app.test_client() if name == "hook" else None
+        results[name] = run_scenario(name, args.payloads, args.mbti, args.iterations, profile, client)
+
+    report = {
+        "environment": environment(args, profile),
+        "warmup_s": round(warmup, 3),
+        "results": results,
+        "feishu_stub": {"calls": stub.calls, "uploaded_bytes": stub.uploaded_bytes},
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    exit_code = 0
+    over = [p for p, stats in results.get("memory", {}).items() if not stats["within_estimate"]]
+    if over:
+        print(f"❌ 单次渲染峰值内存超过估算: {', '.join(over)}", file=sys.stderr)
+        exit_code = 1
+    fork_failed = [p for p, stats in results.get("memory", {}).items() if stats["fork_errors"]]
+    if fork_failed:
+        print(f"❌ 子进程中fork钩子出错: {', '.join(fork_failed)}", file=sys.stderr)
+        exit_code = 1
+    if baseline is not None:
+        report["comparison"] = compare(baseline, report, args.threshold)
+        comparison = report["comparison"]
+        if comparison["environment_mismatch"]:
+            print(f"⚠️ 与基线的运行条件不同: {', '.join(comparison['environment_mismatch'])}", file=sys.stderr)
+        for check in comparison["checks"]:
+            if check["regressed"]:
+                print(f"❌ {check['metric']}: {check['baseline']} → {check['current']} "
+                      f"({check['change']:+.1%})", file=sys.stderr)
+        if comparison["regressions"]:
+            exit_code = 1
+        else:
+            print(f"✅ 没有超过 {args.threshold:.0%} 的退化", file=sys.stderr)
+
+    text = json.dumps(report, ensure_ascii=False, indent=2) + "\n"
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        sys.stdout.write(text)
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
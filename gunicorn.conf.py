@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+gunicorn 生产服务配置
+启动: gunicorn -c gunicorn.conf.py
+
+- preload_app: master进程先加载字体和底图（TEMPLATE_PRELOAD），fork后各worker以copy-on-write共享
+- WEB_WORKERS / WEB_THREADS: worker进程数与每个worker的线程数
+- RENDER_MEMORY_MB 是所有worker合计的渲染内存预算：每个worker按 RENDER_MEMORY_MB / WEB_WORKERS 限制自己的在途渲染
+- 收到SIGTERM时worker停止接收新请求，等待在途请求与异步渲染任务完成：
+  从收到SIGTERM起总共最长 GRACEFUL_TIMEOUT 秒（master到时会强制结束worker）
+"""
+import os
+import time
+import signal
+import multiprocessing
+
+bind = f"0.0.0.0:{os.getenv('PORT', '3000')}"
+wsgi_app = "app:create_app()"
+preload_app = True
+
+workers = int(os.getenv("WEB_WORKERS", str(min(multiprocessing.cpu_count(), 4))))
+worker_class = "gthread"
+threads = int(os.getenv("WEB_THREADS", "4"))
+# 渲染内存预算在进程内计算，告诉app由几个worker均分（须在加载app之前设置）
+os.environ["RENDER_MEMORY_PROCESSES"] = str(workers)
+
+# 打印尺寸的名片渲染+上传可能耗时数秒
+timeout = int(os.getenv("WEB_TIMEOUT", "120"))
+graceful_timeout = int(os.getenv("GRACEFUL_TIMEOUT", "30"))
+keepalive = 5
+
+# 请求大小限制（请求体上限由 MAX_REQUEST_MB 在Flask中控制）
+limit_request_line = 8190
+limit_request_fields = 100
+limit_request_field_size = 8190
+
+accesslog = "-"
+errorlog = "-"
+
+
+# 排空时预留给进程退出的时间，避免在master强制结束前来不及退出
+SHUTDOWN_MARGIN = 1.0
+
+
+def post_worker_init(worker):
+    """记录worker收到SIGTERM的时刻：master从发出SIGTERM起计算 graceful_timeout"""
+    handle_exit = worker.handle_exit
+
+    def on_term(sig, frame):
+        worker.shutdown_deadline = time.monotonic() + graceful_timeout
+        handle_exit(sig, frame)
+
+    signal.signal(signal.SIGTERM, on_term)
+
+
+def worker_exit(server, worker):
+    """worker退出前排空异步任务队列、渲染进程池和后台写盘，只使用 graceful_timeout 剩余的时间"""
+    import app as card_app
+    deadline = getattr(worker, "shutdown_deadline", None)
+    # 不是由SIGTERM触发的退出（如 max_requests 重启）不受master的时限约束
+    remaining = graceful_timeout if deadline is None else deadline - time.monotonic()
+    card_app.shutdown_gracefully(max(remaining - SHUTDOWN_MARGIN, 0))
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+名片文字排版
+- 按字形实际宽度（每个字体缓存一份字形宽度表）测量文字，而不是按单个"测"字估算字符数
+- 中日韩文字逐字可断行，英文按单词断行，超长单词按字符强制断行
+- 避头尾：标点不出现在行首，左括号/引号不出现在行尾；emoji组合序列不拆开
+- 支持最大行数（超出部分以省略号结尾）和自动缩小字号以适应区域
+- 单次排版为线性时间，相同文本的排版结果会被缓存复用
+"""
+import unicodedata
+from functools import lru_cache
+from typing import Any, Callable, Dict, NamedTuple, Tuple
+
+ELLIPSIS = "…"
+
+# 不能出现在行首的字符（标点、右括号、小写假名等）
+NO_LINE_START = set(
+    "，。、．,.!?！？：；:;)）]］}｝」』》〉】〕〗’”…‥%％·・ー々〻"
+    "ぁぃぅぇぉっゃゅょゎァィゥェォッャュョヮヵヶ"
+)
+# 不能出现在行尾的字符（左括号、左引号等）
+NO_LINE_END = set("(（[［{｛「『《〈【〔〖‘“")
+
+ZWJ = "\u200d"
+
+_advances: Dict[Tuple, Dict[str, float]] = {}
+
+
+class TextLayout(NamedTuple):
+    lines: Tuple[str, ...]
+    font: Any
+    size: int
+    line_height: int
+    truncated: bool
+
+
+def font_key(font) -> Tuple:
+    path = getattr(font, "path", None)
+    if path is None:
+        return ("id", id(font))
+    return (path, getattr(font, "size", None), getattr(font, "index", 0))
+
+
+def glyph_advance(font, ch: str) -> float:
+    """单个字符的宽度（按字体缓存）"""
+    table = _advances.get(font_key(font))
+    if table is None:
+        table = _advances.setdefault(font_key(font), {})
+    width = table.get(ch)
+    if width is None:
+        width = font.getlength(ch)
+        table[ch] = width
+    return width
+
+
+def measure(font, text: str) -> float:
+    return sum(glyph_advance(font, ch) for ch in text)
+
+
+def _is_wide(ch: str) -> bool:
+    """中日韩文字、全角符号、emoji：每个字符前后都可以断行"""
+    cp = ord(ch)
+    return (
+        0x2E80 <= cp <= 0x9FFF
+        or 0xAC00 <= cp <= 0xD7AF
+        or 0xF900 <= cp <= 0xFAFF
+        or 0xFF00 <= cp <= 0xFFEF
+        or 0x1F000 <= cp <= 0x1FAFF
+        or 0x20000 <= cp <= 0x3FFFF
+    )
+
+
+def _is_attached(ch: str) -> bool:
+    """必须与前一个字符放在一起的字符：组合附加符、ZWJ、变体选择符、肤色修饰符、标签字符"""
+    cp = ord(ch)
+    return (
+        ch == ZWJ
+        or unicodedata.combining(ch) != 0
+        or 0xFE00 <= cp <= 0xFE0F
+        or 0x1F3FB <= cp <= 0x1F3FF
+        or 0xE0020 <= cp <= 0xE007F
+    )
+
+
+def _tokenize(text: str):
+    """切分为不可再断开的片段，片段之间是允许断行的位置"""
+    tokens = []
+    word = ""      # 正在累积的英文单词（含末尾空格）
+    prefix = ""    # 不能放在行尾的字符，需要和下一个片段连在一起
+    prev = ""
+    for ch in text:
+        if tokens or word or prefix:
+            if _is_attached(ch) or prev == ZWJ or ch in NO_LINE_START:
+                # 与前一个字符连在一起；前一个字符还在 prefix 中时一起等待下一个片段，保持原有顺序
+                if prefix:
+                    prefix += ch
+                elif word:
+                    word += ch
+                else:
+                    tokens[-1] += ch
+                prev = ch
+                continue
+        if ch in NO_LINE_END:
+            if word:
+                tokens.append(word)
+                word = ""
+            prefix += ch
+        elif ch.isspace():
+            if prefix:
+                word = prefix + ch
+                prefix = ""
+            elif word:
+                word += ch
+            elif tokens:
+                tokens[-1] += ch
+            else:
+                word = ch
+        elif _is_wide(ch):
+            if word:
+                tokens.append(word)
+                word = ""
+            tokens.append(prefix + ch)
+            prefix = ""
+        else:
+            if word and word[-1].isspace():
+                tokens.append(word)
+                word = ""
+            word += prefix + ch
+            prefix = ""
+        prev = ch
+    if word or prefix:
+        tokens.append(word + prefix)
+    return tokens
+
+
+def _hard_break(token: str, font, max_width: float):
+    """超长片段按字符强制断开"""
+    pieces = []
+    current = ""
+    width = 0.0
+    for ch in token:
+        advance = glyph_advance(font, ch)
+        if current and width + advance > max_width and not _is_attached(ch):
+            pieces.append(current)
+            current, width = "", 0.0
+        current += ch
+        width += advance
+    if current:
+        pieces.append(current)
+    return pieces
+
+
+def _truncate(line: str, font, max_width: float, ellipsis: str) -> str:
+    """截断到加上省略号后不超过 max_width"""
+    budget = max_width - measure(font, ellipsis)
+    line = line.rstrip()
+    width = measure(font, line)
+    end = len(line)
+    while end > 0 and width > budget:
+        end -= 1
+        width -= glyph_advance(font, line[end])
+    return line[:end].rstrip() + ellipsis
+
+
+@lru_cache(maxsize=4096)
+def break_lines(text: str, font, max_width: float, max_lines: int = 0, ellipsis: str = ELLIPSIS) -> Tuple[str, ...]:
+    """按像素宽度断行；max_lines>0 时超出的部分截断并以省略号结尾"""
+    lines = []
+    for paragraph in text.split("\n"):
+        line = ""
+        width = 0.0
+        for token in _tokenize(paragraph):
+            token_width = measure(font, token)
+            stripped = token.rstrip()
+            # 行尾空格不计入是否放得下
+            trailing = measure(font, stripped) if stripped != token else token_width
+            if not line or width + trailing <= max_width:
+                if not line and trailing > max_width:
+                    # 单个片段就放不下一行（末尾空格留在最后一段，与下一个片段隔开）
+                    *full, last = _hard_break(stripped, font, max_width)
+                    lines.extend(full)
+                    token = last + token[len(stripped):]
+                    token_width = measure(font, token)
+                line += token
+                width += token_width
+                continue
+            lines.append(line.rstrip())
+            if trailing > max_width:
+                *full, last = _hard_break(stripped, font, max_width)
+                lines.extend(full)
+                token = last + token[len(stripped):]
+                token_width = measure(font, token)
+            line, width = token, token_width
+        lines.append(line.rstrip())
+        if max_lines and len(lines) > max_lines:
+            break
+
+    if max_lines and len(lines) > max_lines:
+        lines = lines[:max_lines]
+        lines[-1] = _truncate(lines[-1], font, max_width, ellipsis)
+    return tuple(lines)
+
+
+@lru_cache(maxsize=4096)
+def fit_text(text: str, get_font: Callable[[int], Any], size: int, max_width: float,
+             max_lines: int = 0, min_size: int = 0, line_spacing: float = 1.125) -> TextLayout:
+    """在 max_width × max_lines 的区域内排版：放不下时逐步缩小字号（不小于 min_size），仍放不下则截断"""
+    min_size = min(min_size or size, size)
+    step = max(1, size // 20)
+    current = size
+    while True:
+        font = get_font(current)
+        lines = break_lines(text, font, max_width)
+        if not max_lines or len(lines) <= max_lines:
+            return TextLayout(lines, font, current, int(current * line_spacing), False)
+        if current <= min_size:
+            lines = break_lines(text, font, max_width, max_lines)
+            return TextLayout(lines, font, current, int(current * line_spacing), True)
+        current = max(min_size, current - step)
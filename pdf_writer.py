@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+多页印刷PDF写入器
+- 每页一张JPEG图片（DCTDecode，直接嵌入JPEG字节，不重新解码）
+- 页面边写边落盘，已写入的页面不会留在内存里，适合数百张印刷尺寸的名片
+"""
+from typing import BinaryIO, List, Tuple
+
+MM_PER_INCH = 25.4
+POINTS_PER_INCH = 72
+
+
+def mm_to_points(mm: float) -> float:
+    return mm / MM_PER_INCH * POINTS_PER_INCH
+
+
+class JpegPdfWriter:
+    """把JPEG页面逐页写入PDF文件，调用 close() 时写出页面树和xref"""
+
+    def __init__(self, f: BinaryIO, page_size: Tuple[float, float]):
+        self._f = f
+        self.page_width, self.page_height = page_size
+        self._offsets: List[int] = []
+        self._page_ids: List[int] = []
+        self._pos = 0
+        self._closed = False
+        self._write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+        # 对象1为Catalog，对象2为页面树（页面树在close时写出）
+        self._catalog_id = self._reserve()
+        self._pages_id = self._reserve()
+        self._begin(self._catalog_id)
+        self._write(f"<< /Type /Catalog /Pages {self._pages_id} 0 R >>\nendobj\n".encode("ascii"))
+
+    def _write(self, data: bytes):
+        self._f.write(data)
+        self._pos += len(data)
+
+    def _reserve(self) -> int:
+        self._offsets.append(0)
+        return len(self._offsets)
+
+    def _begin(self, obj_id: int):
+        self._offsets[obj_id - 1] = self._pos
+        self._write(f"{obj_id} 0 obj\n".encode("ascii"))
+
+    def _stream(self, obj_id: int, header: str, data: bytes):
+        self._begin(obj_id)
+        self._write(f"<< {header} /Length {len(data)} >>\nstream\n".encode("ascii"))
+        self._write(data)
+        self._write(b"\nendstream\nendobj\n")
+
+    def add_page(self, jpeg_bytes: bytes, width_px: int, height_px: int):
+        """追加一页：JPEG铺满整页"""
+        image_id = self._reserve()
+        content_id = self._reserve()
+        page_id = self._reserve()
+        self._stream(
+            image_id,
+            f"/Type /XObject /Subtype /Image /Width {width_px} /Height {height_px} "
+            f"/ColorSpace /DeviceRGB /BitsPerComponent 8 /Filter /DCTDecode",
+            jpeg_bytes,
+        )
+        content = f"q {self.page_width:.2f} 0 0 {self.page_height:.2f} 0 0 cm /Im0 Do Q".encode("ascii")
+        self._stream(content_id, "", content)
+        self._begin(page_id)
+        self._write((
+            f"<< /Type /Page /Parent {self._pages_id} 0 R "
+            f"/MediaBox [0 0 {self.page_width:.2f} {self.page_height:.2f}] "
+            f"/Resources << /XObject << /Im0 {image_id} 0 R >> >> "
+            f"/Contents {content_id} 0 R >>\nendobj\n"
+        ).encode("ascii"))
+        self._page_ids.append(page_id)
+        self._f.flush()
+
+    @property
+    def page_count(self) -> int:
+        return len(self._page_ids)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        kids = " ".join(f"{page_id} 0 R" for page_id in self._page_ids)
+        self._begin(self._pages_id)
+        self._write(f"<< /Type /Pages /Kids [{kids}] /Count {len(self._page_ids)} >>\nendobj\n".encode("ascii"))
+        xref_pos = self._pos
+        self._write(f"xref\n0 {len(self._offsets) + 1}\n".encode("ascii"))
+        self._write(b"0000000000 65535 f \n")
+        for offset in self._offsets:
+            self._write(f"{offset:010d} 00000 n \n".encode("ascii"))
+        self._write((
+            f"trailer\n<< /Size {len(self._offsets) + 1} /Root {self._catalog_id} 0 R >>\n"
+            f"startxref\n{xref_pos}\n%%EOF\n"
+        ).encode("ascii"))
+        self._f.flush()
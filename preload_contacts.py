@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+预先导入参会名单的 open_id - 活动前运行，活动中 /hook 不再为已知参会者调用通讯录接口
+- 输入：JSON数组、JSONL或CSV文件（含 email / mobile 列，可选 open_id 列），"-" 表示标准输入（JSON/JSONL）
+- 已带 open_id 的记录直接写入联系人缓存；其余未缓存的邮箱/手机号按每批50个调用 batch_get_id
+- 结果写入 CONTACT_CACHE_PATH（与服务共用），统计以JSON输出
+
+示例:
+    python preload_contacts.py roster.csv
+    python preload_contacts.py roster.jsonl
+"""
+import sys
+import csv
+import json
+import argparse
+
+import app as card_app
+
+
+def read_records(path: str) -> list:
+    if path == "-":
+        return card_app.parse_batch_records(sys.stdin.read())
+    with open(path, "r", encoding="utf-8-sig", newline="") as f:
+        if path.lower().endswith(".csv"):
+            return [{k.strip().lower(): (v or "").strip() for k, v in row.items() if k} for row in csv.DictReader(f)]
+        return card_app.parse_batch_records(f.read())
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="预先解析参会名单的飞书open_id")
+    parser.add_argument("input", help="JSON数组、JSONL或CSV文件路径，'-' 表示标准输入")
+    args = parser.parse_args(argv)
+
+    try:
+        records = read_records(args.input)
+    except (ValueError, OSError) as e:
+        print(f"❌ 输入无效: {e}", file=sys.stderr)
+        return 2
+
+    try:
+        stats = card_app.contact_resolver.preload(records)
+    except Exception as e:
+        print(f"❌ 查询通讯录失败: {e}", file=sys.stderr)
+        return 1
+    print(json.dumps(stats, ensure_ascii=False))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -134,13 +134,23 @@ show_test_options() {
     print_msg "\n💡 推荐先运行本地测试验证功能正常！" $CYAN
 }
 
+# 启动Web服务：已安装gunicorn时使用生产模式（SERVER_MODE=dev 强制使用Flask开发服务器）
+start_server() {
+    if [[ "${SERVER_MODE:-}" != "dev" ]] && [[ -x .venv/bin/gunicorn ]]; then
+        print_msg "🚀 启动gunicorn服务..." $BLUE
+        .venv/bin/gunicorn -c gunicorn.conf.py &
+    else
+        print_msg "🚀 启动Flask应用..." $BLUE
+        .venv/bin/python app.py &
+    fi
+    FLASK_PID=$!
+}
+
 # 本地运行模式
 run_local() {
     print_header "本地开发模式"
     
-    print_msg "🚀 启动Flask应用..." $BLUE
-    .venv/bin/python app.py &
-    FLASK_PID=$!
+    start_server
     
     if check_service; then
         print_msg "🌐 本地访问地址:" $GREEN
@@ -180,9 +190,7 @@ run_ngrok() {
         exit 1
     fi
     
-    print_msg "🚀 启动Flask应用..." $BLUE
-    .venv/bin/python app.py &
-    FLASK_PID=$!
+    start_server
     
     if ! check_service; then
         print_msg "❌ Flask应用启动失败" $RED
@@ -250,9 +258,7 @@ run_localtunnel() {
     
     print_msg "⚠️ 注意: localtunnel稳定性较差，建议优先使用ngrok" $YELLOW
     
-    print_msg "🚀 启动Flask应用..." $BLUE
-    .venv/bin/python app.py &
-    FLASK_PID=$!
+    start_server
     
     if ! check_service; then
         print_msg "❌ Flask应用启动失败" $RED
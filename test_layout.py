@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试名片文字断行：不改变文字顺序，只去掉断行处的空白
+"""
+
+import random
+
+from layout import _is_wide, break_lines
+
+
+class FixedWidthFont:
+    """等宽测试字体：全角字符宽2，其余宽1，组合附加符和ZWJ宽0"""
+
+    def getlength(self, text: str) -> float:
+        return sum(0 if ch in "‍́️" else 2 if _is_wide(ch) else 1 for ch in text)
+
+
+FONT = FixedWidthFont()
+
+SAMPLES = [
+    "call f() please",
+    "你好(。・ω・。)",
+    "喜欢「」符号",
+    "hello (:",
+    "（「你好」）。",
+    "été café́",
+    "👨‍👩‍👧 家庭 family",
+    "supercalifragilisticexpialidocious word",
+    "  leading spaces and trailing  ",
+]
+
+ALPHABET = "ab xyz你好。，、)（(「」『』:!?・ー́‍👍️"
+
+
+def assert_same_text(text: str, lines):
+    """依次拼回各行：每行都是原文的连续片段，行与行之间只跳过空白"""
+    pos = 0
+    for line in lines:
+        while pos < len(text) and text[pos].isspace() and not text.startswith(line, pos):
+            pos += 1
+        assert text.startswith(line, pos), (text, lines)
+        pos += len(line)
+    assert not text[pos:].strip(), (text, lines)
+
+
+def test_no_wrap_keeps_text():
+    """放得下时原样输出（只去掉行尾空白）"""
+    for text in SAMPLES:
+        assert break_lines(text, FONT, 1000) == (text.rstrip(),)
+
+
+def test_wrapped_lines_keep_order():
+    """各种宽度下断行，拼回的文字与原文一致"""
+    for text in SAMPLES:
+        for width in (3, 5, 8, 13):
+            assert_same_text(text, break_lines(text, FONT, width))
+
+
+def test_random_strings_keep_order():
+    rng = random.Random(15)
+    for _ in range(3000):
+        text = "".join(rng.choice(ALPHABET) for _ in range(rng.randrange(1, 24)))
+        assert break_lines(text, FONT, 1000) == (text.rstrip(),)
+        assert_same_text(text, break_lines(text, FONT, rng.choice((4, 7, 10))))
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试按条带流式编码和片段拼接的PNG：解码后与原图逐像素一致
+"""
+
+import io
+import random
+import struct
+import zlib
+
+from PIL import Image, ImageDraw, ImageFont
+
+from png_stream import adler32_combine, iter_png, iter_png_segments, strip_segment
+
+
+def make_image(mode: str, size=(173, 211), seed: int = 1) -> Image.Image:
+    """纯色底 + 随机噪点和色块，既有可压缩的大面积纯色，也有不可压缩的部分"""
+    rng = random.Random(seed)
+    im = Image.new(mode, size, (230, 240, 250, 255)[:len(mode)] if mode != "L" else 235)
+    draw = ImageDraw.Draw(im)
+    for _ in range(40):
+        x, y = rng.randrange(size[0]), rng.randrange(size[1])
+        fill = tuple(rng.randrange(256) for _ in mode) if mode != "L" else rng.randrange(256)
+        draw.rectangle((x, y, x + rng.randrange(1, 30), y + rng.randrange(1, 30)), fill=fill)
+    noise = Image.frombytes(mode, (size[0], 20), bytes(rng.randrange(256) for _ in range(size[0] * 20 * len(mode))))
+    im.paste(noise, (0, size[1] // 2))
+    return im
+
+
+def decode(chunks) -> Image.Image:
+    """解码PNG；另外用 zlib 完整解压IDAT数据，校验Pillow不检查的adler32"""
+    data = b"".join(chunks)
+    idat, pos = [], 8
+    while pos < len(data):
+        length, tag = struct.unpack(">I4s", data[pos:pos + 8])
+        if tag == b"IDAT":
+            idat.append(data[pos + 8:pos + 8 + length])
+        pos += 12 + length
+    zlib.decompress(b"".join(idat))
+    im = Image.open(io.BytesIO(data))
+    im.load()
+    return im
+
+
+def test_adler32_combine():
+    """拼接两段数据的adler32与直接计算整段的结果相同（含空段和超过65521字节的长段）"""
+    rng = random.Random(2)
+    data = bytes(rng.randrange(256) for _ in range(200000))
+    for split in (0, 1, 17, 65521, 100000, len(data)):
+        a, b = data[:split], data[split:]
+        assert adler32_combine(zlib.adler32(a), zlib.adler32(b), len(b)) == zlib.adler32(data)
+
+
+def test_iter_png_roundtrip():
+    """各颜色模式、条带行数和压缩级别下，流式编码的PNG解码后与原图一致"""
+    for mode in ("L", "RGB", "RGBA"):
+        im = make_image(mode)
+        for strip_rows in (1, 7, 64, 1000):
+            for level in (1, 6, 9):
+                out = decode(iter_png(im, level, strip_rows))
+                assert out.mode == mode and out.size == im.size
+                assert out.tobytes() == im.tobytes()
+
+
+def test_iter_png_segments_roundtrip():
+    """逐条带独立压缩、再拼接成一个zlib流的PNG解码后与原图一致"""
+    for mode in ("RGB", "RGBA"):
+        im = make_image(mode, seed=3)
+        for strip_rows in (1, 13, 64):
+            for level in (-1, 1, 6, 9):
+                segments = [strip_segment(im.crop((0, y, im.width, min(im.height, y + strip_rows))), level)
+                            for y in range(0, im.height, strip_rows)]
+                out = decode(iter_png_segments(im.width, im.height, mode, segments, level))
+                assert out.tobytes() == im.tobytes()
+
+
+def test_layer_chunks_match_flatten():
+    """复用底图条带拼接出的名片与 CardLayers.flatten() 合成的整张图逐像素一致"""
+    import app as card_app
+
+    base = make_image("RGB", size=(240, 420), seed=4)
+    font = ImageFont.load_default()
+    qr = make_image("RGBA", size=(50, 50), seed=5)
+    qr.putalpha(Image.linear_gradient("L").resize(qr.size))
+    for level in (6, 9):
+        layers = card_app.CardLayers(base, key=("TEST", f"unit-{level}"))
+        layers.add_text((20, 30), "MBTI Card", font, "#3B536A")
+        layers.add_text((200, 130), "clipped at the edge", font, "#34495E")
+        layers.add_image((150, 60), qr)  # 与文字所在条带重叠
+        layers.add_image((-10, 400), qr)  # 超出左下边界
+        expected = layers.flatten().tobytes()
+        assert layers.dirty_bands()
+        # 第二次编码命中条带缓存
+        for _ in range(2):
+            out = decode(card_app.iter_layer_chunks(layers, level))
+            assert out.size == base.size and out.tobytes() == expected